@@ -0,0 +1,126 @@
+"""
+Compares the batched CTD loader used by ItpQuery.fetch (and the columnar
+ItpQuery.fetch_batch) against the original approach of one SELECT per
+profile and per extra variable.
+
+    python benchmarks/bench_fetch.py [path/to/itp.db]
+
+Every query reads SQLite, even if the database has a binary archive (see
+itp.archive). Defaults to the small database used by the test suite.
+
+Batching saves the cost of a statement per profile (and per extra
+variable), so it wins where that cost is a large share of the total: many
+profiles with few samples each (a narrow pressure window or a single
+level), and extra variables. Fetching whole profiles is bound by sqlite3
+decoding every row into Python objects, which batching does not change;
+there both loaders take about as long. On a synthetic database of 2000
+profiles of 1000-2000 samples (benchmarks/synthetic.py) the speedups were
+about 1.5x for a single level, 1.2x for a 100 dbar window, 18x for extra
+variables in a 50 dbar window and 0.95x for all profiles. The 60 profiles
+of the test database are too few to show a difference.
+"""
+import sqlite3
+import sys
+import timeit
+import numpy as np
+from pathlib import Path
+from itp.filters import PressureFilter
+from itp.itp_query import ItpQuery
+from itp.profile import Profile
+
+
+DEFAULT_DB = Path(__file__).parent.parent / 'tests' / 'testdb.db'
+REPEAT = 5
+NUMBER = 10
+
+
+class PerProfileQuery(ItpQuery):
+    # the loader ItpQuery used before CTD rows were fetched in batches
+    def fetch(self):
+        with sqlite3.connect(str(self.db_path.absolute())) as connection:
+            cursor = connection.cursor()
+            self._validate_extra_fields(cursor)
+            self._profiles = self._query_profile_objects(cursor)
+            self._load_profiles(cursor)
+        return [p for p in self._profiles if p.pressure is not None]
+
+    def _query_profile_objects(self, cursor):
+        fields, rows = self._query_metadata(cursor)
+        profiles = []
+        for row in rows:
+            this_profile = Profile()
+            for field, value in zip(fields, row):
+                setattr(this_profile, field, value)
+            profiles.append(this_profile)
+        return profiles
+
+    def _load_profiles(self, cursor):
+        for profile in self._profiles:
+            sql_args = [profile._id]
+            fields = ['pressure', 'temperature', 'salinity']
+            format_str = '{0}/10000.0 as {0}'
+            query = 'SELECT '
+            query += ', '.join([format_str.format(x) for x in fields])
+            query += ' FROM ctd'
+            query += ' WHERE profile_id = ?'
+            if 'pressure' in self.args:
+                sql, args = PressureFilter(self.args['pressure']).value()
+                query += ' AND ' + sql
+                sql_args.extend(args)
+            query += ' ORDER BY pressure'
+            results = cursor.execute(query, sql_args)
+            values = np.array(results.fetchall(), dtype=float)
+            if values.size == 0:
+                continue
+            for i, field in enumerate(fields):
+                setattr(profile, field, values[:, i])
+            if 'extra_variables' in self.args:
+                self._load_extra_variables(cursor, profile)
+
+    def _load_extra_variables(self, cursor, profile):
+        for var in self.args['extra_variables']:
+            sql = 'SELECT value/10000.0 val FROM ctd '
+            sql += 'LEFT JOIN other_variables '
+            sql += 'ON ctd.id == other_variables.ctd_id AND variable_id == '
+            sql += '(SELECT id FROM variable_names WHERE name == ?) '
+            sql += 'WHERE ctd.profile_id == ? '
+            sql += 'ORDER BY pressure'
+            results = cursor.execute(sql, [var, profile._id])
+            values = np.array(results.fetchall(), dtype=float)
+            profile.set_field(var, values[:, 0])
+
+
+CASES = {
+    'all profiles': {},
+    'pressure window': {'pressure': [0, 100]},
+    'single level': {'pressure': [400, 402]},
+    'extra variables': {'extra_variables': ['vert', 'north', 'east']},
+    'extra, window': {'pressure': [0, 50],
+                      'extra_variables': ['dissolved_oxygen']},
+}
+
+
+def best_time(klass, db_path, args, method='fetch'):
+    query = klass(db_path, **args)
+    query.set_max_results(sys.maxsize)
+    # always SQLite, even if the database has a binary archive
+    query.set_use_archive(False)
+    times = timeit.repeat(
+        getattr(query, method), repeat=REPEAT, number=NUMBER)
+    return min(times) / NUMBER
+
+
+def main():
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB
+    print('{:<18}{:>14}{:>14}{:>14}{:>10}'.format(
+        'case', 'per profile', 'fetch', 'fetch_batch', 'speedup'))
+    for name, args in CASES.items():
+        old = best_time(PerProfileQuery, db_path, args)
+        new = best_time(ItpQuery, db_path, args)
+        batch = best_time(ItpQuery, db_path, args, 'fetch_batch')
+        print('{:<18}{:>12.2f}ms{:>12.2f}ms{:>12.2f}ms{:>9.1f}x'.format(
+            name, old * 1000, new * 1000, batch * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+"""
+Import time of the package, with pytest-benchmark:
+
+    python -m pytest benchmarks/bench_import.py
+
+Each round imports in a fresh interpreter. The interpreter start up and
+NumPy are measured too (test_startup), to tell them apart from the time
+spent in the package itself. tests/test_imports.py checks that no slow,
+optional module (gsw, multiprocessing, ...) is imported by a search.
+"""
+import subprocess
+import sys
+import pytest
+
+
+@pytest.mark.parametrize('module', [
+    'numpy, sqlite3',
+    'itp',
+    'itp.itp_query',
+    'itp.profile',
+])
+def test_import(benchmark, module):
+    benchmark.pedantic(
+        subprocess.check_call, ([sys.executable, '-c', 'import ' + module],),
+        rounds=10)
+
+
+def test_startup(benchmark):
+    benchmark.pedantic(
+        subprocess.check_call, ([sys.executable, '-c', 'pass'],), rounds=10)
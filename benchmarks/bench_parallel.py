@@ -0,0 +1,48 @@
+"""
+Measures how ItpQuery.fetch_batch scales with the number of worker
+processes loading CTD data.
+
+    python benchmarks/bench_parallel.py [path/to/itp.db] [max_workers]
+
+Every profile in the database is fetched. max_workers defaults to the
+number of CPUs. The test database used by default holds only 60 profiles,
+so starting the processes dominates there; run it against the full
+database to see the scaling. Process start up is included in the timings,
+as it is part of every parallel fetch.
+"""
+import os
+import sys
+import timeit
+from pathlib import Path
+from itp.itp_query import ItpQuery
+
+
+DEFAULT_DB = Path(__file__).parent.parent / 'tests' / 'testdb.db'
+REPEAT = 3
+
+
+def main():
+    db_path = Path(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_DB
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    query = ItpQuery(db_path)
+    query.set_max_results(None)
+    query.set_use_archive(False)
+
+    n_profiles = len(query.fetch_batch(metadata_only=True))
+    print('{}: {} profiles, {} CPUs'.format(
+        db_path, n_profiles, os.cpu_count()))
+    print('{:>8} {:>10} {:>8}'.format('workers', 'seconds', 'speedup'))
+    workers = 1
+    serial = None
+    while workers <= max_workers:
+        seconds = min(timeit.repeat(
+            lambda: query.fetch_batch(workers=workers),
+            number=1, repeat=REPEAT))
+        serial = serial or seconds
+        print('{:>8} {:>10.3f} {:>7.2f}x'.format(
+            workers, seconds, serial / seconds))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmarks of the searches and derived values that matter at the scale of
+the full archive, with pytest-benchmark (pip install pytest-benchmark):
+
+    python -m pytest benchmarks/bench_queries.py
+
+They run against a synthetic database (see synthetic.py), written on the
+first run and kept in benchmarks/.data. Its size is set with
+--itp-profiles (default 2000) and --itp-levels (default 1000-2000); pass
+--itp-db path/to/itp.db to measure a real database instead. Every search is
+measured on SQLite and on the binary archive.
+
+To catch regressions, save a baseline and compare later runs against it:
+
+    python -m pytest benchmarks/bench_queries.py --benchmark-autosave
+    python -m pytest benchmarks/bench_queries.py \\
+        --benchmark-compare --benchmark-compare-fail=mean:10%
+"""
+from datetime import datetime
+import pytest
+from itp.batch import ProfileBatch
+from itp.itp_query import ItpQuery
+
+
+BOX = {
+    'latitude': [75, 80],
+    'longitude': [-170, -140],
+    'date_time': [datetime(2006, 1, 1), datetime(2012, 12, 31)],
+}
+# the derived values benchmarks use the profiles of these systems
+DERIVED_SYSTEMS = [1, 2]
+
+
+def test_metadata_all(benchmark, make_query):
+    query = make_query()
+    benchmark(query.fetch_batch, metadata_only=True)
+
+
+def test_metadata_box(benchmark, make_query):
+    query = make_query(**BOX)
+    benchmark(query.fetch_batch, metadata_only=True)
+
+
+def test_fetch_system(benchmark, make_query):
+    query = make_query(system=[1])
+    benchmark(query.fetch)
+
+
+def test_fetch_batch_systems(benchmark, make_query):
+    query = make_query(system=list(range(1, 11)))
+    benchmark(query.fetch_batch)
+
+
+def test_fetch_box(benchmark, make_query):
+    query = make_query(**BOX)
+    benchmark(query.fetch_batch)
+
+
+def test_pressure_window(benchmark, make_query):
+    query = make_query(system=list(range(1, 31)), pressure=[400, 410])
+    benchmark(query.fetch_batch)
+
+
+def test_extra_variables(benchmark, make_query):
+    query = make_query(
+        system=[3, 6, 9, 12], extra_variables=['dissolved_oxygen'])
+    benchmark(query.fetch_batch)
+
+
+def test_fetch_level(benchmark, make_query):
+    query = make_query()
+    benchmark(query.fetch_level, 400, window=2)
+
+
+@pytest.fixture(scope='module')
+def derived_batch(db_path):
+    query = ItpQuery(db_path, system=DERIVED_SYSTEMS)
+    query.set_max_results(None)
+    return query.fetch_batch()
+
+
+def _fresh(batch):
+    # derived values are cached, so each round needs a new batch
+    return (ProfileBatch(batch.metadata, batch.offsets, batch.values),), {}
+
+
+@pytest.mark.parametrize('method', [
+    'density', 'potential_temperature', 'conservative_temperature', 'depth'])
+def test_batch_derived(benchmark, derived_batch, method):
+    benchmark.pedantic(
+        lambda batch: getattr(batch, method)(),
+        setup=lambda: _fresh(derived_batch), rounds=10)
+
+
+def test_profile_density(benchmark, derived_batch):
+    # the same values computed one Profile at a time
+    def densities(profiles):
+        return [p.density() for p in profiles]
+    benchmark.pedantic(
+        densities, setup=lambda: ((derived_batch.to_profiles(),), {}),
+        rounds=5)
@@ -0,0 +1,75 @@
+import os
+import sys
+from pathlib import Path
+import pytest
+from itp import archive, maintenance
+from itp.itp_query import ItpQuery
+
+sys.path.insert(0, str(Path(__file__).parent))
+import synthetic  # noqa: E402
+
+
+# The synthetic databases are kept here between runs, one per scale, as
+# writing them takes much longer than the benchmarks
+DATA_DIRECTORY = Path(__file__).parent / '.data'
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('itp benchmarks')
+    group.addoption(
+        '--itp-db', default=os.environ.get('ITP_BENCH_DB'),
+        help='benchmark this database (e.g. the real archive) instead of '
+             'a synthetic one')
+    group.addoption(
+        '--itp-profiles', type=int,
+        default=int(os.environ.get('ITP_BENCH_PROFILES', 2000)),
+        help='profiles in the synthetic database')
+    group.addoption(
+        '--itp-levels', default=os.environ.get('ITP_BENCH_LEVELS', '1000-2000'),
+        help='samples per profile in the synthetic database, e.g. 1000-2000')
+
+
+@pytest.fixture(scope='session')
+def db_path(request):
+    path = request.config.getoption('--itp-db')
+    if path:
+        return Path(path)
+    n_profiles = request.config.getoption('--itp-profiles')
+    levels = request.config.getoption('--itp-levels')
+    bounds = [int(x) for x in levels.split('-')]
+    levels = (bounds[0], bounds[-1])
+    path = DATA_DIRECTORY / 'synthetic_{}_{}-{}_{}.db'.format(
+        n_profiles, levels[0], levels[1], synthetic.SEED)
+    if not path.exists():
+        DATA_DIRECTORY.mkdir(exist_ok=True)
+        partial = path.with_suffix('.partial')
+        if partial.exists():
+            partial.unlink()
+        synthetic.create_database(partial, n_profiles, levels)
+        partial.rename(path)
+    return path
+
+
+@pytest.fixture(scope='session', params=['sqlite', 'archive'])
+def backend(request, db_path):
+    # every search is measured reading SQLite and reading the binary
+    # archive. The archive of a synthetic database is written on first
+    # use; that of a database given with --itp-db must already exist.
+    if request.param == 'archive':
+        path = archive.archive_path(db_path)
+        if not (path / 'manifest.json').exists():
+            if request.config.getoption('--itp-db'):
+                pytest.skip('{} has no binary archive'.format(db_path))
+            maintenance.build_archive(db_path)
+    return request.param
+
+
+@pytest.fixture
+def make_query(db_path, backend):
+    # ItpQuery on the benchmark database, with no result limit
+    def make(**filters):
+        query = ItpQuery(db_path, **filters)
+        query.set_max_results(None)
+        query.set_use_archive(backend == 'archive')
+        return query
+    return make
@@ -0,0 +1,150 @@
+"""
+Writes a synthetic ITP database with the same schema as the real one, at
+any scale, for benchmarking.
+
+    python benchmarks/synthetic.py path/to/synthetic.db [profiles] [levels]
+
+profiles defaults to 130000, about the size of the full archive, and
+levels (the number of samples per profile, chosen uniformly from a range)
+to 1000-2000, e.g. "1000-2000" or "1500". The profiles are spread over 121
+systems drifting around the Arctic, four profiles a day. Some systems also
+measure dissolved oxygen, and some velocities (vert, nacm, north, east), as
+in the real archive. The same arguments and seed always write the same
+data. The recommended indexes are created afterwards (see itp-maintenance).
+
+Writing the full size database takes a while and about 10 GB of disk.
+"""
+import sqlite3
+import sys
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+import numpy as np
+from itp.ingest import ingest
+from itp import maintenance
+
+
+N_PROFILES = 130000
+LEVELS = (1000, 2000)
+N_SYSTEMS = 121
+SEED = 0
+FIRST_DEPLOYMENT = datetime(2004, 8, 15)
+PROFILE_INTERVAL = timedelta(hours=6)
+
+# the tables and indexes of the distributed database
+SCHEMA = [
+    'CREATE TABLE profiles (id INTEGER PRIMARY KEY, system_number INTEGER, '
+    'profile_number INTEGER, source TEXT, date_time TEXT, latitude REAL, '
+    'longitude REAL, direction TEXT)',
+    'CREATE TABLE ctd (id INTEGER PRIMARY KEY, profile_id INTEGER, '
+    'pressure INTEGER, temperature INTEGER, salinity INTEGER)',
+    'CREATE INDEX idx_profile_id ON ctd(profile_id)',
+    'CREATE TABLE other_variables (ctd_id INTEGER, variable_id INTEGER, '
+    'value INTEGER)',
+    'CREATE TABLE variable_names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+    'CREATE TABLE profile_extra_variables (profile_id INTEGER, '
+    'variable_id INTEGER)',
+    'CREATE INDEX idx_variable_name_pid ON other_variables(ctd_id)',
+    'CREATE INDEX idx_variable_id ON profile_extra_variables(variable_id)',
+]
+VELOCITIES = ['vert', 'nacm', 'north', 'east']
+EXTRA_VARIABLES = ['dissolved_oxygen'] + VELOCITIES
+
+
+def create_database(path, n_profiles=N_PROFILES, levels=LEVELS,
+                    n_systems=N_SYSTEMS, seed=SEED, optimize=True):
+    # Writes the database at path, which must not exist yet. levels is
+    # (fewest, most) samples per profile.
+    path = Path(path)
+    if path.exists():
+        raise ValueError('{} already exists'.format(path))
+    with closing(sqlite3.connect(str(path))) as connection:
+        for sql in SCHEMA:
+            connection.execute(sql)
+        connection.executemany(
+            'INSERT INTO variable_names (name) VALUES (?)',
+            [[name] for name in EXTRA_VARIABLES])
+        connection.commit()
+    ingest(path, generate_profiles(n_profiles, levels, n_systems, seed),
+           defer_indexes=True)
+    if optimize:
+        maintenance.optimize(path)
+    return path
+
+
+def generate_profiles(n_profiles, levels=LEVELS, n_systems=N_SYSTEMS,
+                      seed=SEED):
+    # the profiles, as dictionaries for itp.ingest
+    random = np.random.RandomState(seed)
+    n_systems = max(1, min(n_systems, n_profiles))
+    per_system = np.full(n_systems, n_profiles // n_systems)
+    per_system[:n_profiles % n_systems] += 1
+    for system_index, count in enumerate(per_system):
+        system_number = system_index + 1
+        start = FIRST_DEPLOYMENT + timedelta(days=30 * system_index)
+        # a random walk from a random starting point
+        latitude = random.uniform(72, 84) + np.cumsum(
+            random.normal(0, 0.03, count))
+        latitude = np.clip(latitude, 65, 89.9)
+        longitude = random.uniform(-180, 180) + np.cumsum(
+            random.normal(0, 0.1, count))
+        longitude = (longitude + 180) % 360 - 180
+        extras = []
+        if system_number % 3 == 0:
+            extras.append('dissolved_oxygen')
+        if system_number % 5 == 0:
+            extras.extend(VELOCITIES)
+        for i in range(count):
+            profile_number = i + 1
+            profile = {
+                'system_number': system_number,
+                'profile_number': profile_number,
+                'source': 'itp{}grd{:04d}.dat'.format(
+                    system_number, profile_number),
+                'date_time': start + i * PROFILE_INTERVAL,
+                'latitude': round(float(latitude[i]), 4),
+                'longitude': round(float(longitude[i]), 4),
+                'direction': 'up' if i % 2 == 0 else 'down',
+            }
+            profile.update(_samples(random, levels, extras))
+            yield profile
+
+
+def _samples(random, levels, extras):
+    # 1 dbar bins from near the surface, with a cold surface layer over
+    # warm Atlantic water
+    n_levels = random.randint(levels[0], levels[1] + 1)
+    pressure = random.randint(5, 10) + np.arange(n_levels, dtype=float)
+    temperature = -1.6 + 2.4 * np.exp(-((pressure - 400) / 250) ** 2) \
+        + random.normal(0, 0.01, n_levels)
+    salinity = 28 + 6.9 * (1 - np.exp(-pressure / 200)) \
+        + random.normal(0, 0.005, n_levels)
+    samples = {
+        'pressure': pressure,
+        'temperature': temperature,
+        'salinity': salinity,
+    }
+    for name in extras:
+        if name == 'dissolved_oxygen':
+            samples[name] = 340 - 0.05 * pressure \
+                + random.normal(0, 1, n_levels)
+        else:
+            samples[name] = random.normal(0, 2, n_levels)
+    return samples
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+    path = Path(sys.argv[1])
+    n_profiles = int(sys.argv[2]) if len(sys.argv) > 2 else N_PROFILES
+    levels = LEVELS
+    if len(sys.argv) > 3:
+        bounds = [int(x) for x in sys.argv[3].split('-')]
+        levels = (bounds[0], bounds[-1])
+    create_database(path, n_profiles, levels)
+    print('wrote {} profiles to {}'.format(n_profiles, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,10 @@ import matplotlib.pyplot as plt
 
 path = 'J:/ITP Data/itp_final_2021_11_09.db'
 query = ItpQuery(path, system=[1])
-results = query.fetch()
+results = query.fetch_batch(metadata_only=True)
 
-longitude = [p.longitude for p in results]
-latitude = [p.latitude for p in results]
+longitude = results.longitude
+latitude = results.latitude
 m = Basemap(projection='npstere', boundinglat=70, lon_0=0, resolution='i')
 m.drawcoastlines()
 m.fillcontinents()
@@ -1,4 +1,3 @@
-import numpy as np
 import matplotlib.pyplot as plt
 from itp.itp_query import ItpQuery
 from datetime import datetime
@@ -11,17 +10,13 @@ TIME_RANGE = [datetime(2006, 1, 1), datetime(2007, 12, 31)]
 query = ItpQuery(
     PATH, latitude=[70, 80],
     longitude=[-180, -130],
-    date_time=TIME_RANGE,
-    pressure=[400, 402])
-query.set_max_results(10000)  # override the 5000 result limit
-results = query.fetch()
+    date_time=TIME_RANGE)
+# the sample closest to 400 dbar (within 2 dbar) of every profile
+results = query.fetch_level(400, variables=['temperature'], window=2)
+temp_400 = results.temperature
 
-temp_400 = []
-for profile in results:
-    temp_400.append(profile.temperature[0])
-
-longitude = np.array([p.longitude for p in results])
-latitude = np.array([p.latitude for p in results])
+longitude = results.longitude
+latitude = results.latitude
 
 m = Basemap(projection='npstere', boundinglat=70, lon_0=0, resolution='i')
 m.drawcoastlines()
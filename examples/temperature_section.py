@@ -1,7 +1,8 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from itp.itp_query import ItpQuery
-from geopy.distance import distance
+from itp.grid import ProfileGrid
+from itp.track import drift
 
 
 PATH = 'J:/ITP Data/itp_final_2021_11_09.db'
@@ -9,32 +10,18 @@ DEPTH_GRID = np.arange(0, 301)
 
 # Create an ItpQuery object
 query = ItpQuery(PATH, system=[1], pressure=[0, DEPTH_GRID.max()])
-results = query.fetch()
+results = query.fetch_batch()
 
-# extract lat and lon from results
-longitude = np.array([p.longitude for p in results])
-latitude = np.array([p.latitude for p in results])
-
-# calculate distance between stations
-dist = []
-for i in range(len(latitude)-1):
-    p1 = (latitude[i], longitude[i])
-    p2 = (latitude[i+1], longitude[i+1])
-    dist.append(distance(p1, p2).km)
-
-# cumulative drift distance
-cumulative_dist = np.hstack([0, np.cumsum(dist)])
+# cumulative drift distance between stations
+cumulative_dist = drift(results)['cumulative_distance']
 
 # make grids from distance and depth (to be used with contourf)
 dist_grid, depth_grid = np.meshgrid(cumulative_dist, DEPTH_GRID)
-temp_grid = np.zeros(np.shape(dist_grid))
 
-# interpolate profiles to a 0 to 300 meter depth grid
-for i in range(len(results)):
-    temp_grid[:, i] = np.interp(
-        DEPTH_GRID,
-        results[i].depth(),
-        results[i].potential_temperature())
+# interpolate all profiles to a 0 to 300 meter depth grid
+grid = ProfileGrid.from_profiles(
+    results, DEPTH_GRID, ['potential_temperature'], axis='depth')
+temp_grid = grid.potential_temperature.T
 
 fig, ax = plt.subplots()
 contour = ax.contourf(dist_grid, depth_grid, temp_grid)
@@ -23,8 +23,18 @@ setuptools.setup(
     package_dir={'': 'src'},
     packages=['itp'],
     python_requires='>=3.6',
+    entry_points={
+        'console_scripts': [
+            'itp=itp.cli:main',
+            'itp-maintenance=itp.maintenance:main',
+            'itp-export=itp.export:main',
+        ],
+    },
     install_requires=[
         'numpy',
         'gsw@git+https://github.com/TEOS-10/python-gsw@master'
-    ]
+    ],
+    extras_require={
+        'export': ['netCDF4', 'pyarrow'],
+    }
 )
@@ -0,0 +1,42 @@
+import importlib
+import sys
+
+
+# The package namespace is kept light: importing itp imports neither NumPy
+# nor SQLite. The main classes are imported from their modules on first
+# access, e.g. itp.ItpQuery (PEP 562). tests/test_imports.py checks that
+# this stays so.
+_LAZY = {
+    'ItpQuery': 'itp.itp_query',
+    'Profile': 'itp.profile',
+    'ProfileBatch': 'itp.batch',
+    'ProfileGrid': 'itp.grid',
+    'ItpDatabase': 'itp.database',
+    'AsyncItpQuery': 'itp.async_query',
+}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ is not supported before Python 3.7
+    from itp.itp_query import ItpQuery  # noqa: F401
+    from itp.profile import Profile  # noqa: F401
+    from itp.batch import ProfileBatch  # noqa: F401
+    from itp.grid import ProfileGrid  # noqa: F401
+    from itp.database import ItpDatabase  # noqa: F401
+    from itp.async_query import AsyncItpQuery  # noqa: F401
@@ -0,0 +1,209 @@
+import json
+import numpy as np
+from pathlib import Path
+from itp.batch import ProfileBatch, METADATA_DTYPES, _ranges
+from itp.filters import pre_filter_factory, PressureFilter
+
+
+# The archive is a directory of .npy files holding the same data as the
+# database, decoded and laid out like a ProfileBatch of every profile:
+#
+#   manifest.json            format version, fields, extra variables, and
+#                            the fingerprint of the database it was built from
+#   profiles.<field>.npy     one element per profile, in the order of a
+#                            query (system_number, profile_number)
+#   offsets.npy              CTD samples of profile i are [offsets[i],
+#                            offsets[i + 1]), sorted by pressure
+#   ctd.<variable>.npy       pressure, temperature, salinity and one array per
+#                            extra variable (NaN where it was not measured)
+#   has.<variable>.npy       whether a profile is listed as having an extra
+#                            variable (the extra_variables filter)
+#
+# Files are memory mapped, so only the pages a query touches are read.
+# Text fields are stored as fixed width strings, with '' for NULL.
+FORMAT_VERSION = 1
+MEASURED = ['pressure', 'temperature', 'salinity']
+
+
+def archive_path(db_path):
+    # the archive of itp.db is the directory itp.archive next to it
+    return Path(db_path).with_suffix('.archive')
+
+
+def database_fingerprint(cursor):
+    # Changes whenever profiles are added or removed. Cheap to compute, so
+    # it is checked every time ItpQuery opens an archive.
+    profiles = cursor.execute(
+        'SELECT count(*), max(id) FROM profiles').fetchone()
+    ctd = cursor.execute('SELECT max(id) FROM ctd').fetchone()
+    return [profiles[0], profiles[1], ctd[0]]
+
+
+def open_archive(db_path, cursor):
+    # The archive of the database, or None if it has none or the database
+    # has changed since the archive was written
+    path = archive_path(db_path)
+    if not (path / 'manifest.json').is_file():
+        return None
+    archive = Archive(path)
+    if archive.manifest['fingerprint'] != database_fingerprint(cursor):
+        return None
+    return archive
+
+
+def write_archive(path, fields, rows, offsets, fingerprint, variables):
+    # Writes the metadata and manifest of an archive, and returns a dict of
+    # writable memory mapped arrays, one per CTD variable, for the caller
+    # to fill. offsets must already be known so the files can be sized.
+    path = Path(path)
+    path.mkdir(parents=True)
+    columns = list(zip(*rows)) or [[] for _ in fields]
+    for field, column in zip(fields, columns):
+        if field in METADATA_DTYPES:
+            array = np.array(column, dtype=METADATA_DTYPES[field])
+        else:
+            array = np.array(
+                ['' if x is None else str(x) for x in column], dtype=str)
+        np.save(str(path / 'profiles.{}.npy'.format(field)), array)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    np.save(str(path / 'offsets.npy'), offsets)
+    manifest = {
+        'version': FORMAT_VERSION,
+        'fields': fields,
+        'variables': variables,
+        'fingerprint': fingerprint,
+    }
+    with open(str(path / 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return {
+        v: np.lib.format.open_memmap(
+            str(path / 'ctd.{}.npy'.format(v)), mode='w+',
+            dtype=np.float64, shape=(offsets[-1],))
+        for v in MEASURED + variables
+    }
+
+
+def write_has_variable(path, variable, has_variable):
+    np.save(
+        str(Path(path) / 'has.{}.npy'.format(variable)),
+        np.asarray(has_variable, dtype=bool))
+
+
+class Archive:
+    # Answers ItpQuery searches from an archive directory. Filters are
+    # evaluated as masks over the metadata arrays. The samples of a
+    # contiguous run of profiles are returned as views of the memory
+    # mapped files, without copying; any other selection copies only the
+    # samples selected. The arrays of a batch are read only either way;
+    # Profile objects get copies of their own (see
+    # ProfileBatch.profile_values), as they do from SQLite.
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(str(self.path / 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported archive version {}'.format(
+                self.manifest['version']))
+        self.metadata = {
+            f: self._load('profiles.' + f) for f in self.manifest['fields']}
+        self.offsets = self._load('offsets')
+        self.values = {
+            v: self._load('ctd.' + v)
+            for v in MEASURED + self.manifest['variables']
+        }
+        self.columns = dict(self.metadata)
+        for v in self.manifest['variables']:
+            self.columns['has_' + v] = self._load('has.' + v)
+        self._id_order = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _load(self, name):
+        array = np.load(str(self.path / (name + '.npy')), mmap_mode='r')
+        # a plain ndarray view, so results aren't np.memmap instances
+        return np.asarray(array)
+
+    def select(self, args):
+        # Returns the indices of the profiles matching the filters. With a
+        # pressure filter, also returns the indices of their samples within
+        # the pressure range and the number of them in each profile.
+        keep = np.ones(len(self), dtype=bool)
+        for argument, values in args.items():
+            if argument != 'pressure':
+                keep &= pre_filter_factory(argument, values).mask(self.columns)
+        indices = np.flatnonzero(keep)
+        if 'pressure' not in args:
+            return indices, None, None
+        sizes = np.diff(self.offsets)[indices]
+        samples = _ranges(self.offsets[indices], sizes)
+        in_range = PressureFilter(args['pressure']).sample_mask(
+            self.values['pressure'][samples])
+        counted = np.concatenate([[0], np.cumsum(in_range)])
+        ends = np.cumsum(sizes)
+        counts = counted[ends] - counted[ends - sizes]
+        # only profiles with samples in the range are selected
+        return indices[counts > 0], samples[in_range], counts[counts > 0]
+
+    def batch(self, args, indices, samples=None, sizes=None,
+              metadata_only=False):
+        # a ProfileBatch of the selected profiles (see select), with the
+        # variables the query asks for
+        metadata = {
+            f: self._metadata_column(f, indices) for f in self.metadata}
+        if metadata_only:
+            offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+            loader = _ArchiveLoader(self, args)
+            return ProfileBatch(metadata, offsets, {}, loader)
+        if samples is None:
+            sizes = np.diff(self.offsets)[indices]
+            if len(indices) and indices[-1] - indices[0] == len(indices) - 1:
+                # a contiguous run of profiles: views of the files
+                samples = slice(
+                    self.offsets[indices[0]], self.offsets[indices[-1] + 1])
+            else:
+                samples = _ranges(self.offsets[indices], sizes)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        variables = MEASURED + args.get('extra_variables', [])
+        values = {v: self.values[v][samples] for v in variables}
+        for array in values.values():
+            array.setflags(write=False)
+        return ProfileBatch(metadata, offsets, values)
+
+    def profile_values(self, profile_id, args):
+        # the samples of one profile, as views of the files
+        if self._id_order is None:
+            self._id_order = np.argsort(self.metadata['_id'], kind='stable')
+        ids = self.metadata['_id']
+        index = self._id_order[
+            np.searchsorted(ids, profile_id, sorter=self._id_order)]
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if 'pressure' in args:
+            in_range = np.flatnonzero(PressureFilter(
+                args['pressure']).sample_mask(
+                    self.values['pressure'][start:end]))
+            if len(in_range):
+                start, end = start + in_range[0], start + in_range[-1] + 1
+            else:
+                end = start
+        variables = MEASURED + args.get('extra_variables', [])
+        return {v: self.values[v][start:end] for v in variables}
+
+    def _metadata_column(self, field, indices):
+        column = self.metadata[field][indices]
+        if column.dtype.kind == 'U':
+            column = np.array(
+                [x or None for x in column.tolist()], dtype=object)
+        return column
+
+
+class _ArchiveLoader:
+    # the ctd_loader of a metadata only batch read from an archive
+    def __init__(self, archive, args):
+        self._archive = archive
+        self._args = dict(args)
+
+    def profile_values(self, profile_id):
+        # copies, so the profile can be modified
+        values = self._archive.profile_values(profile_id, self._args)
+        return {k: v.copy() for k, v in values.items()}
@@ -0,0 +1,65 @@
+import argparse
+from datetime import datetime
+
+
+# formats accepted for --date-time
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S']
+
+
+def add_filter_arguments(parser):
+    # Adds an option for each ItpQuery filter to an argparse parser. The
+    # values are read back as a filter dictionary by filters_from_arguments.
+    group = parser.add_argument_group(
+        'filters', 'select profiles like the ItpQuery filters')
+    group.add_argument(
+        '--system', type=int, nargs='+', metavar='N',
+        help='system numbers')
+    group.add_argument(
+        '--latitude', type=float, nargs=2, metavar=('MIN', 'MAX'))
+    group.add_argument(
+        '--longitude', type=float, nargs=2, metavar=('WEST', 'EAST'),
+        help='WEST may be greater than EAST to cross the dateline')
+    group.add_argument(
+        '--date-time', type=parse_date_time, nargs=2,
+        metavar=('START', 'END'),
+        help='YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS')
+    group.add_argument(
+        '--pressure', type=float, nargs=2, metavar=('MIN', 'MAX'),
+        help='only the samples in this pressure range (dbar)')
+    group.add_argument(
+        '--radius', type=float, nargs=3, metavar=('LAT', 'LON', 'KM'),
+        help='profiles within KM kilometers of a point')
+    group.add_argument(
+        '--polygon', type=float, nargs='+', metavar='LAT LON',
+        help='profiles inside a polygon, given as LAT LON pairs')
+    group.add_argument(
+        '--extra-variables', nargs='+', metavar='NAME',
+        help='extra variables to load, e.g. dissolved_oxygen')
+    return group
+
+
+def filters_from_arguments(args):
+    # the filter dictionary for ItpQuery of the parsed options
+    filters = {}
+    for name in ['system', 'latitude', 'longitude', 'date_time', 'pressure',
+                 'radius', 'extra_variables']:
+        value = getattr(args, name, None)
+        if value is not None:
+            filters[name] = list(value)
+    polygon = getattr(args, 'polygon', None)
+    if polygon is not None:
+        if len(polygon) % 2:
+            raise ValueError('--polygon needs LAT LON pairs')
+        filters['polygon'] = [
+            [polygon[i], polygon[i + 1]] for i in range(0, len(polygon), 2)]
+    return filters
+
+
+def parse_date_time(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        'invalid date {!r}, expected YYYY-MM-DD[THH:MM:SS]'.format(text))
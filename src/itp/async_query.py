@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from itp.instrumentation import NULL_STATS
+from itp.itp_query import ItpQuery, CHUNK_SIZE
+from itp.pool import ConnectionPool
+
+
+# threads (and connections per database) of the default QueryExecutor
+DEFAULT_WORKERS = 4
+
+
+class QueryExecutor:
+    # Runs the blocking parts of AsyncItpQuery searches. At most max_workers
+    # searches run at once; the others wait their turn, so a burst of
+    # requests can't open an unbounded number of threads or connections.
+    # Each database gets a pool of max_workers read only connections.
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self.threads = ThreadPoolExecutor(max_workers)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, db_path):
+        key = Path(db_path).absolute()
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(key, self.max_workers)
+            return self._pools[key]
+
+    def shutdown(self):
+        self.threads.shutdown()
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = {}
+
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def default_executor():
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = QueryExecutor()
+        return _default_executor
+
+
+class AsyncItpQuery(ItpQuery):
+    # ItpQuery for asyncio programs. The filters and settings are the same;
+    # fetch, fetch_batch and fetch_level are coroutines, and iter_profiles and
+    # iter_batches are asynchronous generators. The queries run on the
+    # threads of a QueryExecutor, shared by all queries unless
+    # set_executor is called, using its pooled connections (or those of the
+    # ItpDatabase given in place of a path).
+    #
+    # The measurements of a metadata only fetch are still loaded by a
+    # blocking call when first accessed.
+    #
+    # Searches of one query may run at once on several threads, and each
+    # runs on one thread from start to end, so the stats of the search
+    # being profiled are kept per thread.
+    def __init__(self, db_path, **kwargs):
+        self._local = threading.local()
+        super().__init__(db_path, **kwargs)
+        self._executor = None
+
+    @property
+    def _stats(self):
+        return getattr(self._local, 'stats', NULL_STATS)
+
+    @_stats.setter
+    def _stats(self, stats):
+        self._local.stats = stats
+
+    def set_executor(self, executor):
+        self._executor = executor
+
+    async def fetch(self, metadata_only=False):
+        return await self._run(ItpQuery.fetch, self, metadata_only)
+
+    async def fetch_batch(self, metadata_only=False):
+        return await self._run(ItpQuery.fetch_batch, self, metadata_only)
+
+    async def fetch_level(self, pressure, variables=None, method='nearest',
+                          window=10):
+        return await self._run(
+            ItpQuery.fetch_level, self, pressure, variables, method, window)
+
+    async def iter_batches(self, chunk_size=CHUNK_SIZE):
+        # Each batch is read on an executor thread. An iteration keeps its
+        # connection open between batches, so it opens its own rather than
+        # tying up one of the pool's while the caller is busy, with the
+        # settings of the pooled connections.
+        query = _IterationQuery(
+            self._open_connection, self.database or self.db_path,
+            **self.args)
+        query.set_use_archive(self._use_archive)
+        query._profiler = self._profiler
+        query._qc = self._qc
+        batches = query.iter_batches(chunk_size)
+        try:
+            while True:
+                batch = await self._run(next, batches, None)
+                if batch is None:
+                    break
+                yield batch
+        finally:
+            await self._run(batches.close)
+
+    async def iter_profiles(self, chunk_size=CHUNK_SIZE):
+        async for batch in self.iter_batches(chunk_size):
+            for profile in batch:
+                yield profile
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._get_executor().threads, func, *args)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = default_executor()
+        return self._executor
+
+    def _connect(self):
+        if self.database is not None:
+            return self.database.connection()
+        return self._get_executor().pool(self.db_path).connection()
+
+    def _open_connection(self):
+        if self.database is not None:
+            return self.database.open()
+        return self._get_executor().pool(self.db_path).open()
+
+
+class _IterationQuery(ItpQuery):
+    # The steps of an iteration may run on different executor threads, so
+    # it uses a connection of its own, opened by opener, that any thread
+    # may use.
+    def __init__(self, opener, db_path, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self._opener = opener
+
+    def _connect(self):
+        return closing(self._opener())
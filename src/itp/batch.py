@@ -0,0 +1,247 @@
+import numpy as np
+from itp.profile import DerivedValues, Profile
+
+
+# dtypes of the metadata columns. Any other column of the profiles table
+# is kept as an object array.
+METADATA_DTYPES = {
+    '_id': np.int64,
+    'system_number': np.int64,
+    'profile_number': np.int64,
+    'date_time': 'datetime64[s]',
+    'latitude': np.float64,
+    'longitude': np.float64,
+}
+
+
+class ProfileBatch(DerivedValues):
+    # A set of profiles stored column-wise. Metadata are NumPy arrays with
+    # one element per profile. The samples of all profiles are stored end
+    # to end in one contiguous array per variable; the samples of profile i
+    # are values[offsets[i]:offsets[i + 1]]. Profile objects are only
+    # created when a profile is accessed by index or iteration, and their
+    # arrays are views into the batch.
+    #
+    # The derived value methods (density() etc.) work on all the samples
+    # of the batch at once and return one array in the same layout as the
+    # measured variables. The arrays of a batch are not meant to be
+    # modified, so those results are never invalidated.
+    #
+    # A metadata only batch has no values and every profile has a size of
+    # zero. Its ctd_loader provides the measurements of the profiles it
+    # creates, on first access, keyed by profile id.
+    def __init__(self, metadata, offsets, values, ctd_loader=None):
+        self._cache = {}
+        self.metadata = metadata
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = values
+        self.ctd_loader = ctd_loader
+
+    @classmethod
+    def from_rows(cls, fields, rows, offsets, values, ctd_loader=None):
+        columns = list(zip(*rows)) or [[] for _ in fields]
+        metadata = {}
+        for field, column in zip(fields, columns):
+            dtype = METADATA_DTYPES.get(field, object)
+            metadata[field] = np.array(column, dtype=dtype)
+        return cls(metadata, offsets, values, ctd_loader)
+
+    @classmethod
+    def from_profiles(cls, profiles, variables=None):
+        # copies a list of Profile objects (e.g. from ItpQuery.fetch) into
+        # a batch. Only pressure, temperature and salinity are copied
+        # unless other variables are named.
+        profiles = list(profiles)
+        if variables is None:
+            variables = ['pressure', 'temperature', 'salinity']
+        fields = [
+            f for f in METADATA_DTYPES
+            if all(getattr(p, f, None) is not None for p in profiles)
+        ]
+        rows = [[getattr(p, f) for f in fields] for p in profiles]
+        sizes = [len(p.pressure) for p in profiles]
+        offsets = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+        values = {
+            v: np.concatenate(
+                [np.asarray(getattr(p, v), dtype=float) for p in profiles]
+                + [np.zeros(0)])
+            for v in variables
+        }
+        return cls.from_rows(fields, rows, offsets, values)
+
+    @classmethod
+    def load(cls, file):
+        # reads a batch written by save()
+        metadata = {}
+        values = {}
+        with np.load(file) as arrays:
+            offsets = arrays['offsets']
+            for name in arrays.files:
+                kind, _, key = name.partition('.')
+                if kind == 'metadata':
+                    column = arrays[name]
+                    if column.dtype.kind == 'U':
+                        column = np.array(
+                            [x or None for x in column.tolist()], dtype=object)
+                    metadata[key] = column
+                elif kind == 'values':
+                    values[key] = arrays[name]
+        return cls(metadata, offsets, values)
+
+    def save(self, file):
+        # Writes the batch to an uncompressed .npz file, which load() reads
+        # without any per profile work. Text metadata are stored as fixed
+        # width strings, with '' for None.
+        if self.ctd_loader is not None:
+            raise ValueError('A metadata only batch can not be saved')
+        arrays = {'offsets': self.offsets}
+        for field, column in self.metadata.items():
+            if column.dtype == object:
+                column = np.array(
+                    ['' if x is None else str(x) for x in column.tolist()],
+                    dtype=str)
+            arrays['metadata.' + field] = column
+        for variable, column in self.values.items():
+            arrays['values.' + variable] = column
+        np.savez(file, **arrays)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup fails
+        if name.startswith('_') or name in ('metadata', 'values', 'ctd_loader'):
+            raise AttributeError(name)
+        if name in self.metadata:
+            return self.metadata[name]
+        if name in self.values:
+            return self.values[name]
+        raise AttributeError(
+            "'ProfileBatch' object has no attribute '{}'".format(name))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('profile index out of range')
+        return self._profile(index, self._python_metadata(index), 0)
+
+    def __iter__(self):
+        metadata = self._python_metadata()
+        for i in range(len(self)):
+            yield self._profile(i, metadata, i)
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def profile_index(self):
+        # the index of the owning profile for every sample
+        return np.repeat(np.arange(len(self)), self.sizes())
+
+    def variables(self):
+        return list(self.values.keys())
+
+    def split(self, values):
+        # splits an array in the layout of the measured variables, such as
+        # the result of density(), into a list of per profile views
+        return np.split(values, self.offsets[1:-1])
+
+    def get(self, variable, index):
+        # a view of one variable of one profile
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.values[variable][start:end]
+
+    def variable_values(self, name):
+        # the samples of a measured variable, or the result of a derived
+        # value method such as density, as a float array
+        if name in self.values:
+            return np.asarray(self.values[name], dtype=float)
+        method = getattr(DerivedValues, name, None)
+        if name.startswith('_') or not callable(method):
+            raise ValueError('Unknown variable {}'.format(name))
+        return np.asarray(method(self), dtype=float)
+
+    def take(self, indices):
+        # a new batch holding the selected profiles, in the given order.
+        # indices may also be a boolean mask.
+        indices = np.arange(len(self))[indices]
+        metadata = {k: v[indices] for k, v in self.metadata.items()}
+        sizes = self.sizes()[indices]
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        samples = _ranges(self.offsets[indices], sizes)
+        values = {k: v[samples] for k, v in self.values.items()}
+        return ProfileBatch(metadata, offsets, values, self.ctd_loader)
+
+    def to_profiles(self):
+        return list(self)
+
+    def profile_values(self, index):
+        # the measured values of one profile, as views, or as copies where
+        # the arrays of the batch are read only (e.g. from the archive),
+        # so a profile can always be modified
+        values = {v: self.get(v, index) for v in self.values}
+        return {
+            k: v if v.flags.writeable else v.copy()
+            for k, v in values.items()
+        }
+
+    def _sample_latitude(self):
+        return self._cached('sample_latitude', lambda: np.repeat(
+            self.metadata['latitude'], self.sizes()))
+
+    def _sample_longitude(self):
+        return self._cached('sample_longitude', lambda: np.repeat(
+            self.metadata['longitude'], self.sizes()))
+
+    def _python_metadata(self, index=None):
+        # metadata converted to the plain Python values Profile uses,
+        # either for every profile or for a single one
+        metadata = {}
+        for field, column in self.metadata.items():
+            if index is not None:
+                column = column[index:index + 1]
+            if field == 'date_time':
+                column = np.datetime_as_string(column, unit='s')
+            metadata[field] = column.tolist()
+        return metadata
+
+    def _profile(self, index, metadata, row):
+        # row is the position of this profile within the metadata lists
+        profile = Profile()
+        for field, column in metadata.items():
+            profile.set_field(field, column[row])
+        if self.ctd_loader is None:
+            profile._set_loader(self, index)
+        else:
+            profile._set_loader(self.ctd_loader, profile._id)
+        return profile
+
+
+def concatenate(batches):
+    batches = list(batches)
+    if not batches:
+        raise ValueError('need at least one batch to concatenate')
+    metadata = {
+        k: np.concatenate([b.metadata[k] for b in batches])
+        for k in batches[0].metadata
+    }
+    values = {
+        k: np.concatenate([b.values[k] for b in batches])
+        for k in batches[0].values
+    }
+    sizes = np.concatenate([b.sizes() for b in batches])
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    return ProfileBatch(metadata, offsets, values, batches[0].ctd_loader)
+
+
+def _ranges(starts, lengths):
+    # concatenation of arange(start, start + length) for every pair,
+    # without a Python level loop
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # position of each output element within its own range
+    run_starts = np.cumsum(lengths) - lengths
+    within = np.arange(total) - np.repeat(run_starts, lengths)
+    return np.repeat(np.asarray(starts, dtype=np.int64), lengths) + within
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from itp.batch import ProfileBatch
+
+
+# Bytes of the SQLite file header included in the database fingerprint. It
+# holds the file change counter, which SQLite increments on every commit.
+HEADER_SIZE = 100
+
+
+def file_fingerprint(db_path):
+    # Identifies a version of the database without opening it: size and
+    # modification time, and a hash of the SQLite header. A new release of
+    # the database has a different fingerprint, so the results cached for
+    # the old one are never returned (they are evicted in time).
+    path = Path(db_path)
+    stat = path.stat()
+    with open(str(path), 'rb') as f:
+        header = hashlib.sha1(f.read(HEADER_SIZE)).hexdigest()
+    return '{}:{}:{}'.format(stat.st_size, stat.st_mtime_ns, header)
+
+
+class QueryCache:
+    # An on-disk cache of query results, one .npz file (see
+    # ProfileBatch.save) per distinct query. When the files take more than
+    # max_bytes, the least recently used are deleted. Several processes
+    # may share a directory; entries are written to a temporary file and
+    # renamed into place.
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be greater than zero')
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        # the cached ProfileBatch, or None
+        path = self._path(key)
+        try:
+            batch = ProfileBatch.load(str(path))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # missing, evicted by another process, or partially written
+            return None
+        # the modification time records the last use
+        try:
+            os.utime(str(path))
+        except OSError:
+            pass
+        return batch
+
+    def put(self, key, batch):
+        handle, temporary = tempfile.mkstemp(
+            dir=str(self.directory), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                batch.save(f)
+            os.replace(temporary, str(self._path(key)))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def evict(self):
+        # deletes the least recently used entries until the cache fits
+        entries = []
+        for path in self.directory.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    def size(self):
+        return sum(p.stat().st_size for p in self.directory.glob('*.npz'))
+
+    def clear(self):
+        for path in self.directory.glob('*.npz'):
+            path.unlink()
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.directory / (name + '.npz')
@@ -0,0 +1,174 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import numpy as np
+from pathlib import Path
+from itp.arguments import add_filter_arguments, filters_from_arguments
+from itp.itp_query import ItpQuery, CHUNK_SIZE
+
+
+FORMATS = ['csv', 'jsonl', 'npz']
+# the metadata columns of the profiles table, for the header of an empty
+# CSV result
+FIELDS = ['system_number', 'profile_number', 'source', 'date_time',
+          'latitude', 'longitude', 'direction']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='itp',
+        description='Search an ITP database and write the profiles found. '
+                    'CSV has one line per sample (or per profile with '
+                    '--metadata-only), JSON lines one object per profile, '
+                    'and NPZ is a ProfileBatch file (see ProfileBatch.load).')
+    parser.add_argument('db_path', help='path to the ITP database')
+    parser.add_argument(
+        '-f', '--format', choices=FORMATS, default='csv',
+        help='output format (default csv)')
+    parser.add_argument(
+        '-o', '--output',
+        help='output file, by default standard output (except for npz)')
+    parser.add_argument(
+        '--metadata-only', action='store_true',
+        help='only the time, position, system and profile numbers')
+    parser.add_argument(
+        '--count', action='store_true',
+        help='only print the number of profiles found')
+    parser.add_argument(
+        '--chunk-size', type=int, default=CHUNK_SIZE,
+        help='profiles read and written at a time (default %(default)s)')
+    add_filter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    db_path = Path(args.db_path)
+    if not db_path.is_file():
+        parser.error('{} does not exist'.format(db_path))
+    if args.format == 'npz' and not args.output and not args.count:
+        parser.error('npz output needs --output')
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+    try:
+        query = ItpQuery(db_path, **filters_from_arguments(args))
+        if args.count:
+            print(len(query.fetch_batch(metadata_only=True)))
+            return 0
+        if args.output:
+            newline = '' if args.format == 'csv' else None
+            with open(args.output, 'w', newline=newline) as output:
+                return _write(query, args, output)
+        return _write(query, args, sys.stdout)
+    except ValueError as e:
+        parser.error(str(e))
+    except BrokenPipeError:
+        # the reader went away, e.g. piped into head. Python would print
+        # an error when flushing stdout at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+
+
+def _write(query, args, output):
+    if args.metadata_only:
+        # max_results does not apply, and the measurements are never loaded
+        batch = query.fetch_batch(metadata_only=True)
+        batch.ctd_loader = None
+        batches = [batch]
+    else:
+        batches = query.iter_batches(args.chunk_size)
+    if args.format == 'npz':
+        return write_npz(batches, args.output)
+    if args.format == 'jsonl':
+        return write_jsonl(batches, output)
+    return write_csv(batches, output, query._variables(), args.metadata_only)
+
+
+def write_csv(batches, output, variables, metadata_only=False):
+    # One line per sample, with the metadata of its profile, or per profile
+    # if metadata_only. Missing values are empty. Written one batch at a
+    # time.
+    writer = csv.writer(output, lineterminator='\n')
+    header = None
+    for batch in batches:
+        fields = _fields(batch)
+        if header is None:
+            header = fields + ([] if metadata_only else variables)
+            writer.writerow(header)
+        sizes = None if metadata_only else batch.sizes()
+        columns = [_metadata_column(batch, field, sizes) for field in fields]
+        if not metadata_only:
+            columns += [_nullable(batch.values[v]) for v in variables]
+        writer.writerows(zip(*columns))
+    if header is None:
+        writer.writerow(FIELDS + ([] if metadata_only else variables))
+    return 0
+
+
+def write_jsonl(batches, output):
+    # one JSON object per profile, with its metadata and the measurements
+    # as lists. Missing values are null.
+    for batch in batches:
+        fields = _fields(batch)
+        metadata = [_metadata_column(batch, field) for field in fields]
+        values = {
+            variable: batch.split(np.asarray(_nullable_array(column)))
+            for variable, column in batch.values.items()
+        }
+        for i in range(len(batch)):
+            record = {field: column[i] for field, column in zip(
+                fields, metadata)}
+            for variable, profiles in values.items():
+                record[variable] = profiles[i].tolist()
+            output.write(json.dumps(record))
+            output.write('\n')
+    return 0
+
+
+def write_npz(batches, path):
+    # The batches as one ProfileBatch file. Unlike the text formats, the
+    # whole result is held in memory before writing.
+    from itp.batch import concatenate, ProfileBatch
+    batches = list(batches)
+    if batches:
+        batch = concatenate(batches)
+    else:
+        batch = ProfileBatch({}, [0], {})
+    batch.ctd_loader = None
+    batch.save(path)
+    return 0
+
+
+def _fields(batch):
+    # the metadata columns written, without the database id
+    return [f for f in batch.metadata if f != '_id']
+
+
+def _metadata_column(batch, field, sizes=None):
+    column = batch.metadata[field]
+    if field == 'date_time':
+        column = np.datetime_as_string(column, unit='s')
+    elif column.dtype.kind == 'f':
+        column = _nullable_array(column)
+    if sizes is not None:
+        column = np.repeat(column, sizes)
+    return column.tolist()
+
+
+def _nullable(values):
+    return _nullable_array(values).tolist()
+
+
+def _nullable_array(values):
+    # values as Python floats, with None for NaN
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    values = values.astype(object)
+    values[missing] = None
+    return values
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
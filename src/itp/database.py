@@ -0,0 +1,78 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from itp.pool import ConnectionPool, TIMEOUT
+
+
+# SQLite page cache per connection, in KiB, and the size of the database
+# that is memory mapped instead of read with system calls
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE = 256 * 1024 ** 2
+
+
+class ItpDatabase:
+    # A handle on an ITP database for programs that make many queries. Pass
+    # it to ItpQuery (or AsyncItpQuery) in place of the path:
+    #
+    #     database = ItpDatabase('itp.db')
+    #     ItpQuery(database, system=[1]).fetch()
+    #
+    # Queries then borrow read only connections from a pool instead of
+    # opening their own, so SQLite's page cache and the statements it has
+    # compiled are kept between queries, and the variable_names table is
+    # read once, when the handle is opened. A query waits up to timeout
+    # seconds for a connection when all pool_size are in use.
+    #
+    # With immutable (the default), SQLite assumes nothing changes the file
+    # while it is open and skips locking. Close the handle before updating
+    # the database (e.g. with itp.ingest) and open a new one afterwards.
+    def __init__(self, db_path, pool_size=4, immutable=True,
+                 cache_size_kib=CACHE_SIZE_KIB, mmap_size=MMAP_SIZE,
+                 timeout=TIMEOUT):
+        self.db_path = Path(db_path)
+        if not self.db_path.is_file():
+            raise ValueError('{} does not exist'.format(self.db_path))
+        self.immutable = immutable
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+        self._pool = ConnectionPool(
+            self.db_path, pool_size, self._open, timeout)
+        # read on a connection of its own, as queries ask for the ids while
+        # they hold a pooled connection
+        with closing(self._open()) as connection:
+            self._variable_ids = dict(
+                connection.execute('SELECT name, id FROM variable_names'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connection(self):
+        # a context manager lending one of the pooled connections
+        return self._pool.connection()
+
+    def open(self):
+        # a connection of its own with the settings of the pooled ones,
+        # e.g. to hold open for a long time. The caller closes it.
+        return self._pool.open()
+
+    def variable_ids(self):
+        # {name: id} of the variable_names table
+        return dict(self._variable_ids)
+
+    def close(self):
+        self._pool.close()
+
+    def _open(self):
+        uri = self.db_path.absolute().as_uri() + '?mode=ro'
+        if self.immutable:
+            uri += '&immutable=1'
+        connection = sqlite3.connect(
+            uri, uri=True, check_same_thread=False, cached_statements=256)
+        connection.execute('PRAGMA cache_size = -{:d}'.format(
+            self.cache_size_kib))
+        connection.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        return connection
@@ -0,0 +1,272 @@
+import argparse
+import json
+import numpy as np
+from pathlib import Path
+from itp.arguments import add_filter_arguments, filters_from_arguments
+from itp.itp_query import ItpQuery, CHUNK_SIZE
+
+
+# output formats by file suffix
+FORMATS = {'.nc': 'netcdf', '.nc4': 'netcdf', '.parquet': 'parquet'}
+
+# NetCDF chunk sizes, in samples (1 MiB of packed values) and profiles
+SAMPLE_CHUNK = 262144
+PROFILE_CHUNK = 4096
+COMPLEVEL = 4
+# Measured values are stored like in the database, as integers scaled by
+# 10000 (CF packing), which is exact and compresses far better than floats
+SCALE_FACTOR = 0.0001
+FILL_VALUE = -2147483647
+
+# rows (samples) per Parquet row group
+ROW_GROUP_SIZE = 1000000
+
+# CF attributes of the measured variables; extra variables only get a
+# long_name
+VARIABLE_ATTRIBUTES = {
+    'pressure': {
+        'standard_name': 'sea_water_pressure', 'units': 'dbar',
+        'positive': 'down', 'axis': 'Z'},
+    'temperature': {
+        'standard_name': 'sea_water_temperature', 'units': 'degree_Celsius'},
+    'salinity': {
+        'standard_name': 'sea_water_practical_salinity', 'units': '1'},
+}
+
+
+def export(query, path, file_format=None, chunk_size=CHUNK_SIZE, **options):
+    # Writes the profiles an ItpQuery finds to a NetCDF or Parquet file,
+    # chosen by file_format ('netcdf' or 'parquet') or by the suffix of
+    # path. options are passed on to export_netcdf or export_parquet.
+    # Returns the number of profiles written.
+    if file_format is None:
+        file_format = FORMATS.get(Path(path).suffix.lower())
+        if file_format is None:
+            raise ValueError(
+                'Unknown file type {}, use .nc or .parquet'.format(path))
+    if file_format == 'netcdf':
+        return export_netcdf(query, path, chunk_size, **options)
+    if file_format == 'parquet':
+        return export_parquet(query, path, chunk_size, **options)
+    raise ValueError("file_format must be 'netcdf' or 'parquet'")
+
+
+def export_netcdf(query, path, chunk_size=CHUNK_SIZE, complevel=COMPLEVEL,
+                  sample_chunk=SAMPLE_CHUNK):
+    # A CF-1.8 profile collection in the contiguous ragged array
+    # representation: one row_size per profile, and the samples of all
+    # profiles end to end along the obs dimension. Profiles are read
+    # chunk_size at a time (see ItpQuery.iter_batches) and appended, so
+    # memory use does not depend on the size of the export. Requires the
+    # netCDF4 package.
+    try:
+        import netCDF4
+    except ImportError:
+        raise ImportError(
+            'NetCDF export requires the netCDF4 package') from None
+
+    variables = query._variables()
+    n_profiles = 0
+    n_samples = 0
+    with netCDF4.Dataset(str(path), 'w', format='NETCDF4') as dataset:
+        _netcdf_header(dataset, query)
+        dataset.createDimension('profile', None)
+        dataset.createDimension('obs', None)
+        profile_options = {'zlib': True, 'complevel': complevel,
+                           'chunksizes': (PROFILE_CHUNK,)}
+        sample_options = {'zlib': True, 'complevel': complevel,
+                          'shuffle': True, 'chunksizes': (sample_chunk,)}
+
+        name = dataset.createVariable('profile', str, ('profile',))
+        name.cf_role = 'profile_id'
+        name.long_name = 'ITP system and profile number'
+        system = dataset.createVariable(
+            'system_number', 'i4', ('profile',), **profile_options)
+        system.long_name = 'ITP system number'
+        number = dataset.createVariable(
+            'profile_number', 'i4', ('profile',), **profile_options)
+        number.long_name = 'profile number of the system'
+        time = dataset.createVariable(
+            'time', 'f8', ('profile',), **profile_options)
+        time.standard_name = 'time'
+        time.units = 'seconds since 1970-01-01 00:00:00'
+        time.calendar = 'standard'
+        latitude = dataset.createVariable(
+            'lat', 'f8', ('profile',), **profile_options)
+        latitude.standard_name = 'latitude'
+        latitude.units = 'degrees_north'
+        longitude = dataset.createVariable(
+            'lon', 'f8', ('profile',), **profile_options)
+        longitude.standard_name = 'longitude'
+        longitude.units = 'degrees_east'
+        text = {}
+        for field in ('source', 'direction'):
+            text[field] = dataset.createVariable(field, str, ('profile',))
+        text['source'].long_name = 'ITP data file of the profile'
+        text['direction'].long_name = 'direction of the profile (up/down)'
+        row_size = dataset.createVariable(
+            'row_size', 'i4', ('profile',), **profile_options)
+        row_size.long_name = 'number of samples of the profile'
+        row_size.sample_dimension = 'obs'
+
+        samples = {}
+        for variable in variables:
+            samples[variable] = dataset.createVariable(
+                variable, 'i4', ('obs',), fill_value=FILL_VALUE,
+                **sample_options)
+            samples[variable].scale_factor = SCALE_FACTOR
+            samples[variable].long_name = variable.replace('_', ' ')
+            for key, value in VARIABLE_ATTRIBUTES.get(variable, {}).items():
+                samples[variable].setncattr(key, value)
+            samples[variable].coordinates = 'time lat lon pressure'
+
+        for batch in query.iter_batches(chunk_size):
+            profiles = slice(n_profiles, n_profiles + len(batch))
+            metadata = batch.metadata
+            system[profiles] = metadata['system_number']
+            number[profiles] = metadata['profile_number']
+            name[profiles] = np.array([
+                'itp{}-{}'.format(s, p) for s, p in zip(
+                    metadata['system_number'].tolist(),
+                    metadata['profile_number'].tolist())], dtype=object)
+            seconds = metadata['date_time'].astype('datetime64[s]')
+            time[profiles] = seconds.astype(np.int64).astype(float)
+            latitude[profiles] = metadata['latitude']
+            longitude[profiles] = metadata['longitude']
+            for field, netcdf_variable in text.items():
+                column = metadata.get(field)
+                if column is not None:
+                    netcdf_variable[profiles] = np.array(
+                        ['' if x is None else str(x) for x in column.tolist()],
+                        dtype=object)
+            row_size[profiles] = batch.sizes()
+            end = n_samples + int(batch.offsets[-1])
+            for variable in variables:
+                samples[variable][n_samples:end] = np.ma.masked_invalid(
+                    batch.values[variable])
+            n_profiles += len(batch)
+            n_samples = end
+    return n_profiles
+
+
+def _netcdf_header(dataset, query):
+    dataset.Conventions = 'CF-1.8'
+    dataset.featureType = 'profile'
+    dataset.title = 'Ice-Tethered Profiler data'
+    dataset.institution = 'Woods Hole Oceanographic Institution'
+    dataset.source = 'Ice-Tethered Profiler'
+    dataset.references = 'https://www2.whoi.edu/site/itp/'
+    dataset.itp_filters = json.dumps(query.args, default=str)
+
+
+def export_parquet(query, path, chunk_size=CHUNK_SIZE, compression='zstd',
+                   row_group_size=ROW_GROUP_SIZE):
+    # A table with one row per sample: the profile's metadata (system
+    # number, profile number, source, date_time, latitude, longitude,
+    # direction) followed by pressure, temperature, salinity and the extra
+    # variables. The metadata are dictionary encoded, so repeating them per
+    # sample costs little. At most row_group_size rows are held in memory
+    # before being written as a row group. Requires the pyarrow package.
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            'Parquet export requires the pyarrow package') from None
+
+    schema = _parquet_schema(pa, query._variables())
+    schema = schema.with_metadata(
+        {'itp_filters': json.dumps(query.args, default=str)})
+    n_profiles = 0
+    with pq.ParquetWriter(
+            str(path), schema, compression=compression) as writer:
+        pending = []
+        n_rows = 0
+        for batch in query.iter_batches(chunk_size):
+            table = _parquet_table(pa, schema, batch)
+            pending.append(table)
+            n_rows += table.num_rows
+            n_profiles += len(batch)
+            if n_rows >= row_group_size:
+                writer.write_table(
+                    pa.concat_tables(pending), row_group_size=row_group_size)
+                pending = []
+                n_rows = 0
+        if pending:
+            writer.write_table(
+                pa.concat_tables(pending), row_group_size=row_group_size)
+    return n_profiles
+
+
+def _parquet_schema(pa, variables):
+    text = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        pa.field('system_number', pa.int32()),
+        pa.field('profile_number', pa.int32()),
+        pa.field('source', text),
+        pa.field('date_time', pa.timestamp('s')),
+        pa.field('latitude', pa.float64()),
+        pa.field('longitude', pa.float64()),
+        pa.field('direction', text),
+    ]
+    fields += [pa.field(v, pa.float64()) for v in variables]
+    return pa.schema(fields)
+
+
+def _parquet_table(pa, schema, batch):
+    sizes = batch.sizes()
+    # the profile of each sample, which also indexes the dictionaries of
+    # the text columns
+    index = np.repeat(np.arange(len(batch), dtype=np.int32), sizes)
+    columns = []
+    for field in schema:
+        if field.name in batch.values:
+            columns.append(pa.array(batch.values[field.name]))
+            continue
+        column = batch.metadata.get(field.name)
+        if column is None:
+            columns.append(pa.nulls(len(index), field.type))
+        elif pa.types.is_dictionary(field.type):
+            # missing text is a null index, as dictionaries can't hold nulls
+            text = column.tolist()
+            missing = np.array([x is None for x in text], dtype=bool)
+            indices = pa.array(index, mask=np.repeat(missing, sizes))
+            dictionary = pa.array(
+                ['' if x is None else str(x) for x in text], pa.string())
+            columns.append(
+                pa.DictionaryArray.from_arrays(indices, dictionary))
+        else:
+            columns.append(
+                pa.array(np.repeat(column, sizes)).cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='itp-export',
+        description='Export ITP profiles to CF NetCDF or Parquet.')
+    parser.add_argument('db_path', help='path to the ITP database')
+    parser.add_argument('output', help='output file, .nc or .parquet')
+    parser.add_argument(
+        '--format', choices=['netcdf', 'parquet'],
+        help='output format, by default from the suffix of output')
+    parser.add_argument(
+        '--chunk-size', type=int, default=CHUNK_SIZE,
+        help='profiles read at a time (default %(default)s)')
+    add_filter_arguments(parser)
+    args = parser.parse_args(argv)
+
+    db_path = Path(args.db_path)
+    if not db_path.is_file():
+        parser.error('{} does not exist'.format(db_path))
+    try:
+        query = ItpQuery(db_path, **filters_from_arguments(args))
+        count = export(query, args.output, args.format, args.chunk_size)
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+    print('wrote {} profiles to {}'.format(count, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,12 +1,33 @@
 
 
+import calendar
+import math
+from itertools import product
+import numpy as np
+
+
+# name of the optional R*Tree index over profile position and time. See
+# itp.maintenance.build_rtree.
+RTREE_TABLE = 'profiles_rtree'
+RTREE_COLUMNS = {
+    'latitude': ('min_latitude', 'max_latitude'),
+    'longitude': ('min_longitude', 'max_longitude'),
+    'time': ('min_time', 'max_time'),
+}
+
+# mean radius of the earth, used by RadiusFilter
+EARTH_RADIUS_KM = 6371.0
+
+
 def pre_filter_factory(parameter, values):
     parameter_classes = {
         'system': SystemFilter,
         'latitude': LatitudeFilter,
         'longitude': LongitudeFilter,
         'date_time': DateTimeFilter,
-        'extra_variables': ExtraVariableFilter
+        'extra_variables': ExtraVariableFilter,
+        'radius': RadiusFilter,
+        'polygon': PolygonFilter
     }
     # pressure is the only post filter, so we can simply check for it here
     # so it doesn't throw an unknown filter error
@@ -18,6 +39,10 @@ def pre_filter_factory(parameter, values):
 
 
 class SqlFilter:
+    # False for filters whose SQL only selects candidates. Their refine()
+    # method then selects the matches from the candidates' metadata.
+    exact = True
+
     def __init__(self, args):
         self.args = args
         self._check_list()
@@ -36,6 +61,24 @@ class SqlFilter:
         # be inserted where the ? occurs in the sql.
         raise NotImplementedError
 
+    def rtree_ranges(self):
+        # filters that can be answered by the R*Tree index return a dict
+        # of {dimension: [(low, high), ...]}. Several ranges in one
+        # dimension are alternatives (OR).
+        return None
+
+    def refine(self, latitude, longitude):
+        # a boolean mask of the candidates that match, given their
+        # latitude and longitude as arrays
+        raise NotImplementedError
+
+    def mask(self, columns):
+        # The same selection as value(), evaluated on NumPy arrays for the
+        # binary archive (see itp.archive). columns maps the profiles
+        # fields, and has_<variable> for each extra variable, to arrays.
+        # Returns a boolean mask of the matching profiles.
+        raise NotImplementedError
+
 
 class SystemFilter(SqlFilter):
     def _check(self):
@@ -45,6 +88,9 @@ class SystemFilter(SqlFilter):
         sql = '(system_number IN (' + ','.join('?' * len(self.args)) + '))'
         return sql, self.args
 
+    def mask(self, columns):
+        return np.isin(columns['system_number'], self.args)
+
 
 class LatitudeFilter(SqlFilter):
     def _check(self):
@@ -60,6 +106,13 @@ class LatitudeFilter(SqlFilter):
         sql = '(latitude >= ? AND latitude <= ?)'
         return sql, self.args
 
+    def rtree_ranges(self):
+        return {'latitude': [tuple(self.args)]}
+
+    def mask(self, columns):
+        latitude = columns['latitude']
+        return (latitude >= self.args[0]) & (latitude <= self.args[1])
+
 
 class LongitudeFilter(SqlFilter):
     def _check(self):
@@ -74,6 +127,17 @@ class LongitudeFilter(SqlFilter):
         sql = f'(longitude > ? {logical} longitude < ?)'
         return sql, self.args
 
+    def rtree_ranges(self):
+        return {'longitude': _longitude_ranges(*self.args)}
+
+    def mask(self, columns):
+        longitude = columns['longitude']
+        west = longitude > self.args[0]
+        east = longitude < self.args[1]
+        if self.args[1] < self.args[0]:
+            return west | east
+        return west & east
+
 
 class DateTimeFilter(SqlFilter):
     def _check(self):
@@ -87,6 +151,16 @@ class DateTimeFilter(SqlFilter):
         iso_times = [x.strftime('%Y-%m-%dT%H:%M:%S') for x in self.args]
         return sql, iso_times
 
+    def rtree_ranges(self):
+        # like value(), times are compared as UTC wall clock times
+        times = [calendar.timegm(x.timetuple()) for x in self.args]
+        return {'time': [tuple(times)]}
+
+    def mask(self, columns):
+        start, end = [np.datetime64(x, 's') for x in self.value()[1]]
+        date_time = columns['date_time']
+        return (date_time >= start) & (date_time <= end)
+
 
 class PressureFilter(SqlFilter):
     def _check(self):
@@ -100,6 +174,20 @@ class PressureFilter(SqlFilter):
         pressures = [self.args[0] * 10000.0, self.args[1] * 10000.0]
         return sql, pressures
 
+    def profile_value(self):
+        # selects the profiles that have samples in the pressure range
+        sql, pressures = self.value()
+        sql = '(EXISTS (SELECT 1 FROM ctd WHERE ' \
+            'ctd.profile_id == profiles.id AND ' + sql + '))'
+        return sql, pressures
+
+    def sample_mask(self, pressure):
+        # the samples in the pressure range, given unscaled pressures.
+        # Compared as scaled integers, exactly like value().
+        low, high = self.value()[1]
+        scaled = np.rint(np.asarray(pressure) * 10000.0)
+        return (scaled >= low) & (scaled <= high)
+
 
 class ExtraVariableFilter(SqlFilter):
     def _check(self):
@@ -113,3 +201,180 @@ class ExtraVariableFilter(SqlFilter):
         sql += 'WHERE variable_names.name IN '
         sql += '(' + ','.join('?' * len(self.args)) + '))'
         return sql, self.args
+
+    def mask(self, columns):
+        masks = [columns['has_' + name] for name in self.args]
+        return np.logical_or.reduce(masks) if masks else \
+            np.zeros(len(columns['system_number']), dtype=bool)
+
+
+class RadiusFilter(SqlFilter):
+    # [latitude, longitude, radius in km]. Selects the profiles within the
+    # great circle distance of a point. The SQL selects the bounding box
+    # of the circle and refine() checks the haversine distance.
+    exact = False
+
+    def _check(self):
+        if len(self.args) != 3:
+            raise ValueError(
+                'Radius must contain latitude, longitude and distance.')
+        latitude, longitude, radius = self.args
+        if latitude < -90 or latitude > 90:
+            raise ValueError('Latitude must be in range -90 to 90')
+        if longitude < -180 or longitude > 180:
+            raise ValueError('Longitude must be in range -180 to 180')
+        if radius <= 0:
+            raise ValueError('Radius must be greater than zero')
+
+    def bounds(self):
+        # the bounding box of the circle as (south, north, west, east). west
+        # and east are None if the box spans all longitudes, and west >
+        # east if it crosses the dateline.
+        latitude, longitude, radius = self.args
+        angle = math.degrees(radius / EARTH_RADIUS_KM)
+        south, north = latitude - angle, latitude + angle
+        if south <= -90 or north >= 90 or angle >= 90:
+            # the circle contains a pole
+            return max(south, -90), min(north, 90), None, None
+        half_width = math.degrees(math.asin(
+            math.sin(math.radians(angle)) / math.cos(math.radians(latitude))))
+        west = (longitude - half_width + 180) % 360 - 180
+        east = (longitude + half_width + 180) % 360 - 180
+        return south, north, west, east
+
+    def value(self):
+        south, north, west, east = self.bounds()
+        sql = '(latitude >= ? AND latitude <= ?'
+        sql_args = [south, north]
+        if west is not None:
+            logical = 'OR' if east < west else 'AND'
+            sql += f' AND (longitude >= ? {logical} longitude <= ?)'
+            sql_args.extend([west, east])
+        return sql + ')', sql_args
+
+    def rtree_ranges(self):
+        south, north, west, east = self.bounds()
+        ranges = {'latitude': [(south, north)]}
+        if west is not None:
+            ranges['longitude'] = _longitude_ranges(west, east)
+        return ranges
+
+    def refine(self, latitude, longitude):
+        return self.distance(latitude, longitude) <= self.args[2]
+
+    def mask(self, columns):
+        return self.refine(columns['latitude'], columns['longitude'])
+
+    def distance(self, latitude, longitude):
+        # great circle distance in km from the center to each point
+        lat0, lon0 = np.radians(self.args[0]), np.radians(self.args[1])
+        lat, lon = np.radians(latitude), np.radians(longitude)
+        a = np.sin((lat - lat0) / 2) ** 2 + \
+            np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class PolygonFilter(SqlFilter):
+    # A list of [latitude, longitude] vertices. Selects the profiles inside
+    # the polygon, with edges drawn as straight lines in latitude and
+    # longitude. A polygon whose longitudes span more than 180 degrees is
+    # taken to cross the dateline. The SQL selects the bounding box and
+    # refine() does the point in polygon test.
+    exact = False
+
+    def _check(self):
+        if len(self.args) < 3:
+            raise ValueError('Polygon must contain at least three vertices.')
+        for vertex in self.args:
+            if len(vertex) != 2:
+                raise ValueError('Polygon vertices must be [latitude, longitude]')
+            if vertex[0] < -90 or vertex[0] > 90:
+                raise ValueError('Latitude must be in range -90 to 90')
+            if vertex[1] < -180 or vertex[1] > 180:
+                raise ValueError('Longitude must be in range -180 to 180')
+        vertices = np.array(self.args, dtype=float)
+        self._latitude = vertices[:, 0]
+        longitude = vertices[:, 1]
+        self._crosses_dateline = longitude.max() - longitude.min() > 180
+        self._longitude = self._unwrap(longitude)
+
+    def _unwrap(self, longitude):
+        # makes longitudes continuous across the dateline
+        if not self._crosses_dateline:
+            return longitude
+        return np.where(longitude < 0, longitude + 360, longitude)
+
+    def bounds(self):
+        # (south, north, west, east) with west > east if the polygon
+        # crosses the dateline
+        west = self._longitude.min()
+        east = self._longitude.max()
+        if east > 180:
+            east -= 360
+        return self._latitude.min(), self._latitude.max(), west, east
+
+    def value(self):
+        south, north, west, east = self.bounds()
+        logical = 'OR' if east < west else 'AND'
+        sql = '(latitude >= ? AND latitude <= ? AND ' \
+            f'(longitude >= ? {logical} longitude <= ?))'
+        return sql, [south, north, west, east]
+
+    def rtree_ranges(self):
+        south, north, west, east = self.bounds()
+        return {
+            'latitude': [(south, north)],
+            'longitude': _longitude_ranges(west, east)
+        }
+
+    def refine(self, latitude, longitude):
+        # even-odd ray casting, vectorized over the points
+        x = self._unwrap(np.asarray(longitude, dtype=float))
+        y = np.asarray(latitude, dtype=float)
+        inside = np.zeros(x.shape, dtype=bool)
+        x_vertices, y_vertices = self._longitude, self._latitude
+        for i in range(len(x_vertices)):
+            x1, y1 = x_vertices[i - 1], y_vertices[i - 1]
+            x2, y2 = x_vertices[i], y_vertices[i]
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < x_cross)
+        return inside
+
+    def mask(self, columns):
+        return self.refine(columns['latitude'], columns['longitude'])
+
+
+def _longitude_ranges(west, east):
+    if east < west:
+        # the range crosses the dateline
+        return [(west, 180), (-180, east)]
+    return [(west, east)]
+
+
+def rtree_value(sql_filters):
+    # Builds one predicate that probes the R*Tree index with the ranges of
+    # all the given filters. The R*Tree stores 32 bit floats rounded
+    # outwards, so it selects a superset of the matches and the filters'
+    # own predicates must still be applied. A range split by the dateline
+    # becomes two probes.
+    ranges = {}
+    for sql_filter in sql_filters:
+        ranges.update(sql_filter.rtree_ranges() or {})
+    if not ranges:
+        return None
+    dimensions = sorted(ranges)
+    probes = []
+    sql_args = []
+    for box in product(*[ranges[d] for d in dimensions]):
+        conditions = []
+        for dimension, (low, high) in zip(dimensions, box):
+            min_column, max_column = RTREE_COLUMNS[dimension]
+            conditions.append(f'{max_column} >= ? AND {min_column} <= ?')
+            sql_args.extend([low, high])
+        probes.append(
+            f'profiles.id IN (SELECT id FROM {RTREE_TABLE} WHERE '
+            + ' AND '.join(conditions) + ')')
+    return '(' + ' OR '.join(probes) + ')', sql_args
@@ -0,0 +1,149 @@
+import numpy as np
+from itp.batch import ProfileBatch
+
+
+# the measured variables every batch has
+MEASURED = ['pressure', 'temperature', 'salinity']
+
+
+class ProfileGrid:
+    # Variables of many profiles on a common vertical grid. values holds one
+    # 2-D array per variable with a row for every profile and a column for
+    # every level; levels a profile does not cover are NaN. metadata holds
+    # the metadata columns of the profiles, as in ProfileBatch.
+    #
+    # All the profiles are gridded at once with NumPy, without a loop over
+    # profiles, so this scales to the whole archive.
+    def __init__(self, levels, axis, metadata, values):
+        self.levels = levels
+        self.axis = axis
+        self.metadata = metadata
+        self.values = values
+
+    @classmethod
+    def from_profiles(cls, profiles, grid, variables=None, axis='pressure',
+                      method='interp'):
+        # profiles is a ProfileBatch, or a list of Profile objects.
+        # variables are the names of measured variables or of derived value
+        # methods (e.g. 'potential_temperature'); by default every measured
+        # variable but the axis. axis is 'pressure' or 'depth'.
+        #
+        # method 'interp' interpolates linearly to the grid levels. Method
+        # 'bin' averages the samples between consecutive grid values
+        # instead, so there is one level less than grid values, at the
+        # centers of the bins.
+        if axis not in ('pressure', 'depth'):
+            raise ValueError("axis must be 'pressure' or 'depth'")
+        if method not in ('interp', 'bin'):
+            raise ValueError("method must be 'interp' or 'bin'")
+        grid = np.asarray(grid, dtype=float)
+        if grid.ndim != 1 or grid.size < 2 or np.any(np.diff(grid) <= 0):
+            raise ValueError('grid must contain increasing values')
+        batch = _as_batch(profiles, variables)
+        if variables is None:
+            variables = [v for v in batch.variables() if v != axis]
+
+        coordinate = batch.variable_values(axis)
+        profile_index = batch.profile_index()
+        # samples must be ordered by the axis within each profile. They
+        # already are in the batches ItpQuery returns.
+        order = slice(None)
+        ordered = (np.diff(coordinate) >= 0) | (np.diff(profile_index) != 0)
+        if not ordered.all():
+            order = np.lexsort((coordinate, profile_index))
+            coordinate = coordinate[order]
+            profile_index = profile_index[order]
+
+        values = {}
+        grid_function = _interpolate if method == 'interp' else _bin_average
+        for variable in variables:
+            y = batch.variable_values(variable)[order]
+            # missing samples are skipped, per variable
+            valid = ~np.isnan(coordinate) & ~np.isnan(y)
+            if valid.all():
+                values[variable] = grid_function(
+                    profile_index, coordinate, y, len(batch), grid)
+            else:
+                values[variable] = grid_function(
+                    profile_index[valid], coordinate[valid], y[valid],
+                    len(batch), grid)
+        levels = grid if method == 'interp' else (grid[:-1] + grid[1:]) / 2
+        metadata = {k: np.asarray(v) for k, v in batch.metadata.items()}
+        return cls(levels, axis, metadata, values)
+
+    def __len__(self):
+        return len(next(iter(self.metadata.values()), []))
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup fails
+        if name.startswith('_') or name in ('metadata', 'values'):
+            raise AttributeError(name)
+        if name in self.metadata:
+            return self.metadata[name]
+        if name in self.values:
+            return self.values[name]
+        raise AttributeError(
+            "'ProfileGrid' object has no attribute '{}'".format(name))
+
+    def variables(self):
+        return list(self.values.keys())
+
+
+def _as_batch(profiles, variables):
+    if isinstance(profiles, ProfileBatch):
+        return profiles
+    # only the measured variables that are asked for need to be copied
+    measured = list(MEASURED)
+    for variable in variables or []:
+        if variable not in measured and not hasattr(ProfileBatch, variable):
+            measured.append(variable)
+    return ProfileBatch.from_profiles(profiles, measured)
+
+
+def _interpolate(profile_index, x, y, n_profiles, grid):
+    # Linear interpolation of every profile to the grid. x is sorted within
+    # each profile. For each profile and level, the number of samples with
+    # x <= the level is found from a histogram of the first level each
+    # sample is <= to. That locates the bracketing samples without a
+    # search per profile.
+    n_levels = len(grid)
+    sizes = np.bincount(profile_index, minlength=n_profiles)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    first_level = np.searchsorted(grid, x, side='left')
+    counts = np.bincount(
+        profile_index * (n_levels + 1) + first_level,
+        minlength=n_profiles * (n_levels + 1))
+    counts = counts.reshape(n_profiles, n_levels + 1).cumsum(axis=1)
+    below = counts[:, :n_levels]
+    # below[i, j] samples of profile i are <= grid[j]. lo is the last of
+    # them and hi the next sample, which must be in the same profile.
+    lo = starts[:, None] + below - 1
+    hi = lo + 1
+    in_profile = (below > 0) & (below < sizes[:, None])
+    if len(x) == 0:
+        return np.full((n_profiles, n_levels), np.nan)
+    lo_clipped = np.clip(lo, 0, len(x) - 1)
+    hi_clipped = np.clip(hi, 0, len(x) - 1)
+    x_lo, x_hi = x[lo_clipped], x[hi_clipped]
+    y_lo, y_hi = y[lo_clipped], y[hi_clipped]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (grid[None, :] - x_lo) / (x_hi - x_lo)
+        result = y_lo + weight * (y_hi - y_lo)
+    # a level equal to the last sample of a profile is not bracketed
+    exact = (below > 0) & (x_lo == grid[None, :])
+    result = np.where(exact, y_lo, result)
+    return np.where(in_profile | exact, result, np.nan)
+
+
+def _bin_average(profile_index, x, y, n_profiles, grid):
+    # the mean of the samples in [grid[j], grid[j + 1]) for every profile
+    n_bins = len(grid) - 1
+    bins = np.searchsorted(grid, x, side='right') - 1
+    inside = (bins >= 0) & (bins < n_bins)
+    cells = profile_index[inside] * n_bins + bins[inside]
+    sums = np.bincount(
+        cells, weights=y[inside], minlength=n_profiles * n_bins)
+    counts = np.bincount(cells, minlength=n_profiles * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return means.reshape(n_profiles, n_bins)
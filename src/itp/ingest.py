@@ -0,0 +1,234 @@
+import sqlite3
+import numpy as np
+from contextlib import closing
+from datetime import datetime
+from itp.filters import RTREE_TABLE
+
+
+# profiles written per transaction
+BATCH_SIZE = 500
+# measured values are stored as integers scaled by this
+SCALE = 10000
+MEASURED = ['pressure', 'temperature', 'salinity']
+# the metadata of a profile, as columns of the profiles table
+METADATA = ['system_number', 'profile_number', 'source', 'date_time',
+            'latitude', 'longitude', 'direction']
+# fields every profile must have; the other METADATA may be missing (NULL)
+REQUIRED = ['system_number', 'profile_number'] + MEASURED
+# tables whose indexes defer_indexes drops during an ingest
+INDEXED_TABLES = ['profiles', 'ctd', 'other_variables',
+                  'profile_extra_variables']
+
+
+def ingest(db_path, profiles, batch_size=BATCH_SIZE, defer_indexes=False,
+           wal=True):
+    # Appends profiles to an existing ITP database, and returns the number
+    # that were added. Each profile is a dict with the METADATA fields
+    # (date_time a datetime or an ISO 8601 string; only system_number and
+    # profile_number are required), and pressure, temperature and salinity
+    # arrays. Any other array is an extra
+    # variable, added to variable_names if it is new. NaN values are
+    # stored as NULL.
+    #
+    # Profiles already in the database, by (system_number, profile_number,
+    # source), are skipped, as are repeats within profiles, so the same
+    # files can be ingested again without changing anything. Existing rows
+    # are never modified.
+    #
+    # Profiles are written batch_size at a time, each batch in one
+    # transaction with executemany, so an interrupted ingest keeps whole
+    # profiles only and can simply be run again. wal switches the database
+    # to write-ahead logging for the ingest, which makes the commits
+    # cheaper, and back to its previous journal mode afterwards so read
+    # only (and immutable) connections see every change in the database
+    # file.
+    #
+    # defer_indexes drops the indexes of the tables written to and creates
+    # them again at the end, which is faster when the ingest is a large
+    # part of the database (e.g. loading a new database). Leave it off for
+    # daily updates: rebuilding the indexes would take longer than the
+    # update itself.
+    #
+    # The R*Tree index is updated along with the profiles table when it
+    # exists. The binary archive and the drift table are ignored by
+    # ItpQuery and itp.track until they are built again.
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        journal_mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        if wal:
+            connection.execute('PRAGMA journal_mode=WAL')
+            # durable at every checkpoint rather than every commit
+            connection.execute('PRAGMA synchronous=NORMAL')
+        dropped = _drop_indexes(connection) if defer_indexes else []
+        try:
+            writer = _Writer(connection)
+            added = 0
+            batch = []
+            for profile in profiles:
+                batch.append(profile)
+                if len(batch) == batch_size:
+                    added += writer.write(batch)
+                    batch = []
+            added += writer.write(batch)
+        finally:
+            for sql in dropped:
+                connection.execute(sql)
+            connection.commit()
+            if wal:
+                connection.execute(
+                    'PRAGMA journal_mode={}'.format(journal_mode))
+    return added
+
+
+def _drop_indexes(connection):
+    # drops the indexes of INDEXED_TABLES, and returns the statements
+    # that create them again
+    sql = "SELECT name, sql FROM sqlite_master WHERE type == 'index' " \
+        'AND sql IS NOT NULL AND tbl_name IN ({})'.format(
+            ','.join('?' * len(INDEXED_TABLES)))
+    indexes = connection.execute(sql, INDEXED_TABLES).fetchall()
+    for name, _ in indexes:
+        connection.execute('DROP INDEX {}'.format(name))
+    connection.commit()
+    return [sql for _, sql in indexes]
+
+
+class _Writer:
+    # Writes batches of profiles. Row ids are assigned here rather than by
+    # SQLite, so the ctd and other_variables rows of a whole batch can be
+    # inserted with one executemany each.
+    def __init__(self, connection):
+        self.connection = connection
+        cursor = connection.cursor()
+        self.existing = set(cursor.execute(
+            'SELECT system_number, profile_number, source FROM profiles'))
+        self.variable_ids = dict(cursor.execute(
+            'SELECT name, id FROM variable_names'))
+        self.next_variable_id = _next_id(cursor, 'variable_names')
+        self.next_profile_id = _next_id(cursor, 'profiles')
+        self.next_ctd_id = _next_id(cursor, 'ctd')
+        sql = "SELECT count(*) FROM sqlite_master WHERE name == ?"
+        self.has_rtree = cursor.execute(sql, [RTREE_TABLE]).fetchone()[0] > 0
+
+    def write(self, profiles):
+        profile_rows = []
+        ctd_rows = []
+        variable_rows = []
+        listed_rows = []
+        # variables first seen in this batch, added with its profiles
+        new_variables = {}
+        for profile in profiles:
+            missing = [name for name in REQUIRED if name not in profile]
+            if missing:
+                raise ValueError('profile {} has no {}'.format(
+                    profile.get('profile_number'), ', '.join(missing)))
+            key = (profile['system_number'], profile['profile_number'],
+                   profile.get('source'))
+            if key in self.existing:
+                continue
+            self.existing.add(key)
+            profile_id = self.next_profile_id
+            self.next_profile_id += 1
+            profile_rows.append([profile_id] + _metadata_row(profile))
+
+            n_samples = len(profile['pressure'])
+            ctd_ids = np.arange(
+                self.next_ctd_id, self.next_ctd_id + n_samples)
+            self.next_ctd_id += n_samples
+            ctd_rows.extend(zip(
+                ctd_ids.tolist(), [profile_id] * n_samples,
+                *[_scaled(profile[name]) for name in MEASURED]))
+
+            for name in profile:
+                if name in METADATA or name in MEASURED:
+                    continue
+                values = np.asarray(profile[name], dtype=float)
+                if len(values) != n_samples:
+                    raise ValueError(
+                        '{} of profile {} does not have a value per '
+                        'pressure'.format(name, key))
+                measured = ~np.isnan(values)
+                if not measured.any():
+                    continue
+                variable_id = self._variable_id(name, new_variables)
+                listed_rows.append([profile_id, variable_id])
+                variable_rows.extend(zip(
+                    ctd_ids[measured].tolist(),
+                    [variable_id] * int(measured.sum()),
+                    _scaled(values[measured])))
+
+        if not profile_rows:
+            return 0
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO variable_names (id, name) VALUES (?, ?)',
+                [[i, name] for name, i in new_variables.items()])
+            self.connection.executemany(
+                'INSERT INTO profiles (id, {}) VALUES ({})'.format(
+                    ', '.join(METADATA), ','.join('?' * (len(METADATA) + 1))),
+                profile_rows)
+            self.connection.executemany(
+                'INSERT INTO ctd (id, profile_id, {}) '
+                'VALUES (?, ?, ?, ?, ?)'.format(', '.join(MEASURED)),
+                ctd_rows)
+            self.connection.executemany(
+                'INSERT INTO other_variables (ctd_id, variable_id, value) '
+                'VALUES (?, ?, ?)', variable_rows)
+            self.connection.executemany(
+                'INSERT INTO profile_extra_variables (profile_id, variable_id) '
+                'VALUES (?, ?)', listed_rows)
+            if self.has_rtree:
+                self._index(profile_rows)
+        self.variable_ids.update(new_variables)
+        return len(profile_rows)
+
+    def _variable_id(self, name, new_variables):
+        # ids of new variables are assigned here, and the rows inserted
+        # in the transaction of the batch
+        if name in self.variable_ids:
+            return self.variable_ids[name]
+        if name not in new_variables:
+            new_variables[name] = self.next_variable_id
+            self.next_variable_id += 1
+        return new_variables[name]
+
+    def _index(self, profile_rows):
+        # the same entries as maintenance.build_rtree
+        ids = [[row[0]] for row in profile_rows]
+        self.connection.executemany(
+            'INSERT INTO {} SELECT id, '
+            'coalesce(latitude, 0), coalesce(latitude, 0), '
+            'coalesce(longitude, 0), coalesce(longitude, 0), '
+            "coalesce(strftime('%s', date_time), 0), "
+            "coalesce(strftime('%s', date_time), 0) "
+            'FROM profiles WHERE id == ?'.format(RTREE_TABLE), ids)
+
+
+def _next_id(cursor, table):
+    sql = 'SELECT max(id) FROM {}'.format(table)
+    return (cursor.execute(sql).fetchone()[0] or 0) + 1
+
+
+def _metadata_row(profile):
+    row = []
+    for field in METADATA:
+        value = profile.get(field)
+        if field == 'date_time' and isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%dT%H:%M:%S')
+        elif isinstance(value, float) and np.isnan(value):
+            value = None
+        elif isinstance(value, np.generic):
+            value = value.item()
+        row.append(value)
+    return row
+
+
+def _scaled(values):
+    # scaled integers, None for NaN
+    values = np.asarray(values, dtype=float)
+    missing = np.isnan(values)
+    scaled = np.rint(np.where(missing, 0, values) * SCALE).astype(np.int64)
+    scaled = scaled.astype(object)
+    scaled[missing] = None
+    return scaled.tolist()
@@ -0,0 +1,233 @@
+import json
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# the logger QueryStats.log writes to by default
+logger = logging.getLogger('itp.query')
+# rows fetched at a time when iterating over an instrumented cursor
+ITERATION_ROWS = 1000
+
+
+class QueryStats:
+    # What one search (fetch, fetch_batch, fetch_level or iter_batches) of
+    # an ItpQuery did, passed to the callback given to set_profiler:
+    #
+    #   stages      wall time in seconds of each stage the search went
+    #               through: metadata (the profiles table), ctd (the CTD
+    #               statements, including their extra variable joins),
+    #               numpy (converting rows to arrays), archive, cache,
+    #               parallel, levels, qc (quality control, see
+    #               ItpQuery.set_qc) and profiles (creating Profile
+    #               objects)
+    #   statements  for each distinct SQL statement, the number of
+    #               executions, rows read, seconds spent executing and
+    #               reading, and its EXPLAIN QUERY PLAN
+    #   profiles    profiles returned
+    #   result_bytes  size of the returned arrays
+    #   allocated_bytes, peak_bytes  memory allocated by the search (still
+    #               held at the end, and at most), when traced
+    #
+    # seconds is the wall time of the whole search. For iter_batches it
+    # includes the time the caller spent between batches, which the stages
+    # do not.
+    def __init__(self, search, filters, explain=True):
+        self.search = search
+        self.filters = filters
+        self.explain = explain
+        self.seconds = 0.0
+        self.stages = {}
+        self.statements = {}
+        self.profiles = 0
+        self.result_bytes = 0
+        self.allocated_bytes = None
+        self.peak_bytes = None
+        self.error = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def add_result(self, batch):
+        self.profiles += len(batch)
+        arrays = [batch.offsets] + list(batch.metadata.values()) \
+            + list(batch.values.values())
+        self.result_bytes += sum(a.nbytes for a in arrays)
+
+    def cursor(self, cursor):
+        return _InstrumentedCursor(cursor, self)
+
+    @property
+    def executions(self):
+        return sum(s['executions'] for s in self.statements.values())
+
+    @property
+    def rows(self):
+        return sum(s['rows'] for s in self.statements.values())
+
+    def to_dict(self):
+        return {
+            'search': self.search,
+            'filters': self.filters,
+            'seconds': self.seconds,
+            'stages': dict(self.stages),
+            'executions': self.executions,
+            'rows': self.rows,
+            'profiles': self.profiles,
+            'result_bytes': self.result_bytes,
+            'allocated_bytes': self.allocated_bytes,
+            'peak_bytes': self.peak_bytes,
+            'error': self.error,
+            'statements': [
+                dict(record, sql=sql)
+                for sql, record in self.statements.items()
+            ],
+        }
+
+    def to_json(self, **kwargs):
+        # filter values such as datetimes are written as text
+        return json.dumps(self.to_dict(), default=str, **kwargs)
+
+    def log(self, log=logger, level=logging.INFO):
+        # One line summary. The full statistics are attached to the record
+        # as itp_stats, for handlers that ship structured logs.
+        stages = ' '.join(
+            '{}={:.4f}s'.format(name, seconds)
+            for name, seconds in self.stages.items())
+        log.log(
+            level, '%s of %d profiles in %.4fs (%s), %d statements, %d rows',
+            self.search, self.profiles, self.seconds, stages,
+            self.executions, self.rows,
+            extra={'itp_stats': self.to_dict()})
+
+    def _record(self, cursor, sql, args):
+        if sql not in self.statements:
+            plan = None
+            if self.explain:
+                plan = query_plan(cursor.connection.cursor(), sql, args)
+            self.statements[sql] = {
+                'executions': 0, 'rows': 0, 'seconds': 0.0, 'plan': plan}
+        return self.statements[sql]
+
+
+class NullStats:
+    # stands in for QueryStats when a query is not profiled
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_result(self, batch):
+        pass
+
+    def cursor(self, cursor):
+        return cursor
+
+
+NULL_STATS = NullStats()
+
+
+@contextmanager
+def profile_search(stats, callback, trace_memory=False):
+    # times a search, and passes its stats to callback at the end, even if
+    # it failed
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if trace_memory:
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield stats
+    except BaseException as e:
+        stats.error = repr(e)
+        raise
+    finally:
+        stats.seconds = time.perf_counter() - start
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            stats.allocated_bytes = current - base
+            stats.peak_bytes = max(peak - base, 0)
+            if started:
+                tracemalloc.stop()
+        callback(stats)
+
+
+def query_plan(cursor, sql, sql_args):
+    # the EXPLAIN QUERY PLAN of a statement, one line per step, indented by
+    # depth
+    rows = cursor.execute('EXPLAIN QUERY PLAN ' + sql, sql_args).fetchall()
+    # each row is (id, parent, notused, detail)
+    depth = {0: -1}
+    lines = []
+    for row_id, parent, _, detail in rows:
+        depth[row_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[row_id] + detail)
+    return lines
+
+
+class _InstrumentedCursor:
+    # A sqlite3 cursor that records its statements in a QueryStats.
+    # Rows are counted as they are fetched, and the time SQLite spends
+    # stepping through a statement is counted with its execution.
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._record = None
+
+    @property
+    def connection(self):
+        return self._cursor.connection
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql, args=()):
+        self._record = self._stats._record(self._cursor, sql, args)
+        with self._timed():
+            self._cursor.execute(sql, args)
+        self._record['executions'] += 1
+        return self
+
+    def fetchone(self):
+        with self._timed():
+            row = self._cursor.fetchone()
+        if row is not None:
+            self._record['rows'] += 1
+        return row
+
+    def fetchmany(self, size):
+        with self._timed():
+            rows = self._cursor.fetchmany(size)
+        self._record['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        with self._timed():
+            rows = self._cursor.fetchall()
+        self._record['rows'] += len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(ITERATION_ROWS)
+            if not rows:
+                return
+            yield from rows
+
+    @contextmanager
+    def _timed(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record['seconds'] += time.perf_counter() - start
@@ -1,20 +1,89 @@
+import json
 import sqlite3
 import numpy as np
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
-from itp.filters import pre_filter_factory, PressureFilter
-from itp.profile import Profile
+from itp.filters import (
+    pre_filter_factory,
+    rtree_value,
+    PressureFilter,
+    RTREE_TABLE
+)
+from itp.batch import ProfileBatch, _ranges
+from itp.archive import open_archive
+from itp.cache import file_fingerprint
+from itp.database import ItpDatabase
+from itp.instrumentation import QueryStats, NULL_STATS, profile_search
+from itp.qc import quality_control, ACTIONS, SUSPECT, BAD
+
+
+# number of profiles requested per CTD query
+CHUNK_SIZE = 500
 
 
 class ItpQuery:
     def __init__(self, db_path, **kwargs):
-        self.db_path = Path(db_path)
+        # db_path may also be an ItpDatabase, whose pooled connections are
+        # then used
+        if isinstance(db_path, ItpDatabase):
+            self.database = db_path
+            self.db_path = db_path.db_path
+        else:
+            self.database = None
+            self.db_path = Path(db_path)
         self.args = kwargs
         self._max_results = 5000
-        self._profiles = None
+        self._use_archive = True
+        self._cache = None
+        self._profiler = None
+        self._stats = NULL_STATS
+        self._qc = None
 
     def set_max_results(self, results):
         self._max_results = results
 
+    def set_use_archive(self, use_archive):
+        # By default searches are answered from the binary archive of the
+        # database (see itp.archive) when one exists and is up to date.
+        self._use_archive = use_archive
+
+    def set_cache(self, cache):
+        # Stores the results of fetch and fetch_batch in a QueryCache (see
+        # itp.cache) and returns them from it while the database is
+        # unchanged. None disables caching.
+        self._cache = cache
+
+    def set_profiler(self, callback, explain=True, trace_memory=False):
+        # After every search, callback is called with a QueryStats (see
+        # itp.instrumentation) recording where its time went. explain
+        # records the EXPLAIN QUERY PLAN of each distinct statement, which
+        # costs a little time the first time a statement is seen.
+        # trace_memory records the memory allocated, with tracemalloc,
+        # which slows the search down considerably. None disables
+        # profiling.
+        if callback is None:
+            self._profiler = None
+        else:
+            self._profiler = (callback, explain, trace_memory)
+
+    def set_qc(self, checks, action='mask', level=BAD):
+        # Runs quality control checks (see itp.qc) on the results of fetch,
+        # fetch_batch and iter_batches, and masks (replaces by NaN) or
+        # drops the samples flagged level or worse. Metadata only results
+        # and fetch_level are not checked. Cached results are stored
+        # unchecked, so changing the checks does not invalidate them. None
+        # disables quality control.
+        if checks is None:
+            self._qc = None
+            return
+        if action not in ACTIONS:
+            raise ValueError("action must be 'mask' or 'drop'")
+        if level not in (SUSPECT, BAD):
+            raise ValueError('level must be SUSPECT or BAD')
+        self._qc = (list(checks), action, level)
+
     def set_filter_dict(self, filter_dict):
         if type(filter_dict) is not dict:
             raise TypeError('filter_dict must be a dictionary')
@@ -23,58 +92,428 @@ class ItpQuery:
     def add_filter(self, param, value):
         self.args[param] = value
 
-    def fetch(self):
-        with sqlite3.connect(str(self.db_path.absolute())) as connection:
-            cursor = connection.cursor()
+    def fetch(self, metadata_only=False, workers=None):
+        with self._search('fetch'):
+            batch = self._search_batch(metadata_only, workers)
+            with self._stats.stage('profiles'):
+                return batch.to_profiles()
+
+    def fetch_batch(self, metadata_only=False, workers=None):
+        # With metadata_only, only the profiles table is read. The
+        # measurements of the returned profiles are loaded on first
+        # access, and max_results does not apply.
+        # With workers > 1, the CTD data are loaded by that many processes
+        # (see _load_parallel).
+        with self._search('fetch_batch'):
+            return self._search_batch(metadata_only, workers)
+
+    def _search_batch(self, metadata_only, workers):
+        # the search of fetch and fetch_batch, which subclasses may make
+        # coroutines
+        if workers is not None and (type(workers) is not int or workers < 1):
+            raise ValueError('workers must be a positive integer')
+        batch = self._cached_fetch_batch(metadata_only, workers)
+        if not metadata_only:
+            batch = self._quality_control(batch)
+        self._stats.add_result(batch)
+        return batch
+
+    def _cached_fetch_batch(self, metadata_only, workers):
+        if self._cache is None or metadata_only:
+            return self._fetch_batch(metadata_only, workers)
+        key = self._cache_key()
+        with self._stats.stage('cache'):
+            batch = self._cache.get(key)
+        if batch is not None:
+            self._check_max_results(len(batch))
+            return batch
+        batch = self._fetch_batch(workers=workers)
+        with self._stats.stage('cache'):
+            self._cache.put(key, batch)
+        return batch
+
+    def _fetch_batch(self, metadata_only=False, workers=None):
+        with self._connect() as connection:
+            cursor = self._cursor(connection)
 
             # make sure any "extra_variables" are valid
-            self._validate_extra_fields(cursor)
+            variable_ids = self._validate_extra_fields(cursor)
+
+            archive = self._open_archive(cursor)
+            if archive is not None:
+                with self._stats.stage('archive'):
+                    batch = self._archive_batch(archive, metadata_only)
+                    if metadata_only:
+                        return batch
+                    return self._remove_empty_profiles(batch)
 
             # build up the profiles
-            self._query_metadata(cursor)
-            self._query_profiles(cursor)
-            self._remove_empty_profiles()
-        return self._profiles
+            fields, rows = self._query_metadata(cursor, not metadata_only)
+            if metadata_only:
+                with self._stats.stage('numpy'):
+                    return self._metadata_batch(fields, rows)
+            if workers is None or workers == 1:
+                batch = self._query_profiles(
+                    cursor, fields, rows, variable_ids)
+        if workers is not None and workers > 1:
+            with self._stats.stage('parallel'):
+                batch = self._load_parallel(fields, rows, workers)
+        with self._stats.stage('numpy'):
+            return self._remove_empty_profiles(batch)
+
+    def _load_parallel(self, fields, rows, workers):
+        # The metadata rows are split into one contiguous range of profiles
+        # per worker. Each worker process opens the database read only and
+        # loads the samples of its range. Putting the ranges back in order
+        # gives exactly the result of _query_profiles.
+        profile_ids = [row[0] for row in rows]
+        bounds = np.linspace(0, len(profile_ids), workers + 1).astype(int)
+        partitions = [
+            profile_ids[start:end]
+            for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+        ]
+        if len(partitions) < 2:
+            with self._connect() as connection:
+                cursor = self._cursor(connection)
+                variable_ids = self._validate_extra_fields(cursor)
+                return self._query_profiles(
+                    cursor, fields, rows, variable_ids)
+        # imported here, as multiprocessing is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(len(partitions)) as executor:
+            results = list(executor.map(
+                _load_partition,
+                [self.db_path] * len(partitions),
+                [self.args] * len(partitions),
+                partitions
+            ))
+        sizes = np.concatenate([np.diff(offsets) for offsets, _ in results])
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        values = {
+            v: np.concatenate([partition[v] for _, partition in results])
+            for v in self._variables()
+        }
+        return ProfileBatch.from_rows(fields, rows, offsets, values)
+
+    def iter_batches(self, chunk_size=CHUNK_SIZE):
+        # Streams the results as ProfileBatch objects of at most
+        # chunk_size profiles. Only one chunk is held in memory at a time,
+        # so the max_results limit does not apply.
+        with self._search('iter_batches'), self._connect() as connection:
+            cursor = self._cursor(connection)
+            variable_ids = self._validate_extra_fields(cursor)
+            archive = self._open_archive(cursor)
+            if archive is not None:
+                for batch in self._archive_batches(archive, chunk_size):
+                    batch = self._quality_control(batch)
+                    if len(batch):
+                        self._stats.add_result(batch)
+                        yield batch
+                return
+            query = self._build_query(self._has_rtree(cursor))
+            results = cursor.execute(*query)
+            fields = self._metadata_fields(results)
+            ctd_cursor = self._cursor(connection)
+            while True:
+                with self._stats.stage('metadata'):
+                    rows = results.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    rows = self._refine(fields, rows)
+                if not rows:
+                    continue
+                batch = self._query_profiles(
+                    ctd_cursor, fields, rows, variable_ids)
+                with self._stats.stage('numpy'):
+                    batch = self._remove_empty_profiles(batch)
+                batch = self._quality_control(batch)
+                if len(batch):
+                    self._stats.add_result(batch)
+                    yield batch
+
+    def iter_profiles(self, chunk_size=CHUNK_SIZE):
+        for batch in self.iter_batches(chunk_size):
+            for profile in batch:
+                yield profile
+
+    def fetch_level(self, pressure, variables=None, method='nearest',
+                    window=10):
+        # The values of every matching profile at one pressure level, as a
+        # ProfileBatch with exactly one sample per profile, so e.g.
+        # batch.temperature[i] is the temperature of profile i. Only the
+        # samples on either side of the level are read.
+        #
+        # variables are measured variables (temperature, salinity, and
+        # extra variables); by default temperature, salinity and the
+        # extra_variables of the query. method 'nearest' takes the sample
+        # closest to the level, and batch.pressure is its pressure.
+        # 'interp' interpolates linearly between the samples on either
+        # side. Samples further than window dbar from the level are not
+        # used; the values are NaN where there are none.
+        # max_results does not apply, as only one sample per profile is
+        # loaded.
+        if method not in ('nearest', 'interp'):
+            raise ValueError("method must be 'nearest' or 'interp'")
+        if window < 0:
+            raise ValueError('window must not be negative')
+        if variables is None:
+            variables = ['temperature', 'salinity']
+            variables += self.args.get('extra_variables', [])
+        with self._search('fetch_level'):
+            batch = self._fetch_level(pressure, variables, method, window)
+            self._stats.add_result(batch)
+            return batch
+
+    def _fetch_level(self, pressure, variables, method, window):
+        with self._connect() as connection:
+            cursor = self._cursor(connection)
+            self._validate_extra_fields(cursor)
+            variable_ids = self._level_variable_ids(cursor, variables)
+            archive = self._open_archive(cursor)
+            if archive is not None:
+                with self._stats.stage('archive'):
+                    indices, _, _ = archive.select(self.args)
+                    metadata = archive.batch(
+                        self.args, indices, metadata_only=True).metadata
+                    below, above = _archive_brackets(
+                        archive, indices, pressure, window)
+                    names = ['pressure'] + variables
+                    below = [_take(archive.values[v], below) for v in names]
+                    above = [_take(archive.values[v], above) for v in names]
+                batch = ProfileBatch(metadata, np.arange(len(indices) + 1), {})
+            else:
+                fields, rows = self._query_metadata(cursor, False)
+                profile_ids = [row[0] for row in rows]
+                with self._stats.stage('levels'):
+                    below, above = self._query_brackets(
+                        cursor, profile_ids, pressure, window, variable_ids)
+                batch = ProfileBatch.from_rows(
+                    fields, rows, np.arange(len(rows) + 1), {})
+        values = _level_values(pressure, method, below, above)
+        batch.values = dict(zip(['pressure'] + variables, values))
+        return batch
+
+    def _level_variable_ids(self, cursor, variables):
+        # None for the columns of the ctd table, otherwise the
+        # variable_names id of each extra variable
+        if type(variables) is not list:
+            raise ValueError('variables must be a list')
+        if self.database is not None:
+            known = self.database.variable_ids()
+        else:
+            known = dict(cursor.execute('SELECT name, id FROM variable_names'))
+        variable_ids = {}
+        for var in variables:
+            if var in ('temperature', 'salinity'):
+                variable_ids[var] = None
+            elif var in known:
+                variable_ids[var] = known[var]
+            else:
+                raise ValueError('Unknown variable {}'.format(var))
+        return variable_ids
+
+    def _query_brackets(self, cursor, profile_ids, pressure, window,
+                        variable_ids):
+        # For every profile, the last sample at or above the level and the
+        # first at or below it, within the window. Each is found with an
+        # index seek per profile, by one statement per chunk of profiles.
+        # Returns [pressure, variables...] arrays for the samples above
+        # and below, NaN where there is none.
+        level, lowest, highest = [
+            int(round(p * 10000))
+            for p in (pressure, pressure - window, pressure + window)
+        ]
+        brackets = {}
+        for start in range(0, len(profile_ids), CHUNK_SIZE):
+            chunk = profile_ids[start:start + CHUNK_SIZE]
+            sql = 'SELECT id, ' \
+                '(SELECT id FROM ctd WHERE profile_id == profiles.id ' \
+                'AND pressure <= ? AND pressure >= ? ' \
+                'ORDER BY pressure DESC LIMIT 1), ' \
+                '(SELECT id FROM ctd WHERE profile_id == profiles.id ' \
+                'AND pressure >= ? AND pressure <= ? ' \
+                'ORDER BY pressure LIMIT 1) ' \
+                'FROM profiles WHERE id IN ('
+            sql += ','.join('?' * len(chunk)) + ')'
+            sql_args = [level, lowest, level, highest] + chunk
+            for profile_id, below, above in cursor.execute(sql, sql_args):
+                brackets[profile_id] = (below, above)
+        ctd_ids = sorted(
+            {i for pair in brackets.values() for i in pair if i is not None})
+        samples = {}
+        for start in range(0, len(ctd_ids), CHUNK_SIZE):
+            chunk = ctd_ids[start:start + CHUNK_SIZE]
+            sql, sql_args = _level_sample_query(chunk, variable_ids)
+            for row in cursor.execute(sql, sql_args):
+                samples[row[0]] = row[1:]
+        n_columns = len(variable_ids) + 1
+        missing = (None,) * n_columns
+        below = [samples.get(brackets[i][0], missing) for i in profile_ids]
+        above = [samples.get(brackets[i][1], missing) for i in profile_ids]
+        below = np.array(below, dtype=float).reshape(-1, n_columns).T
+        above = np.array(above, dtype=float).reshape(-1, n_columns).T
+        return below / 10000.0, above / 10000.0
+
+    @contextmanager
+    def _search(self, name):
+        # Profiles one search, if a profiler is set. A search made by
+        # another (fetch_batch within fetch) is part of the outer one.
+        if self._profiler is None or self._stats is not NULL_STATS:
+            yield
+            return
+        callback, explain, trace_memory = self._profiler
+        stats = QueryStats(name, dict(self.args), explain)
+        self._stats = stats
+        try:
+            with profile_search(stats, callback, trace_memory):
+                yield
+        finally:
+            self._stats = NULL_STATS
+
+    def _cursor(self, connection):
+        # a cursor whose statements are recorded when profiling
+        return self._stats.cursor(connection.cursor())
+
+    def _connect(self):
+        if self.database is not None:
+            return self.database.connection()
+        return closing(sqlite3.connect(str(self.db_path.absolute())))
 
     def _validate_extra_fields(self, cursor):
+        # returns the variable_names id of each requested extra variable
         if 'extra_variables' not in self.args:
-            return
+            return {}
         if type(self.args['extra_variables']) is not list:
             raise ValueError('extra_variables must by a list')
-        sql = 'SELECT name FROM variable_names'
-        known_extra_vars = cursor.execute(sql).fetchall()
-        known_extra_vars = [f[0] for f in known_extra_vars]
+        if self.database is not None:
+            known_extra_vars = self.database.variable_ids()
+        else:
+            sql = 'SELECT name, id FROM variable_names'
+            known_extra_vars = dict(cursor.execute(sql).fetchall())
         for var in self.args['extra_variables']:
             if var not in known_extra_vars:
                 raise ValueError(f'Unknown extra_variable {format(var)}')
+        return {var: known_extra_vars[var] for var in self.args['extra_variables']}
 
-    def _query_metadata(self, cursor):
-        results = cursor.execute(*self._build_query())
-        fields = [x[0] for x in results.description]
-        fields[0] = '_id'
-        rows = results.fetchall()
-        if len(rows) > self._max_results:
+    def _cache_key(self):
+        # The filters, the SQL they produce and the variables loaded, and
+        # the fingerprint of the database. Filter values are normalized
+        # to text so e.g. datetimes can be compared.
+        key = {
+            'filters': self.args,
+            'query': self._build_query(),
+            'variables': self._variables(),
+            'database': file_fingerprint(self.db_path),
+        }
+        return json.dumps(key, sort_keys=True, default=str)
+
+    def _open_archive(self, cursor):
+        if not self._use_archive:
+            return None
+        return open_archive(self.db_path, cursor)
+
+    def _archive_batch(self, archive, metadata_only):
+        indices, samples, sizes = archive.select(self.args)
+        if not metadata_only:
+            self._check_max_results(len(indices))
+        return archive.batch(
+            self.args, indices, samples, sizes, metadata_only)
+
+    def _archive_batches(self, archive, chunk_size):
+        indices, samples, sizes = archive.select(self.args)
+        if samples is not None:
+            bounds = np.concatenate([[0], np.cumsum(sizes)])
+        for start in range(0, len(indices), chunk_size):
+            end = start + chunk_size
+            if samples is None:
+                batch = archive.batch(self.args, indices[start:end])
+            else:
+                batch = archive.batch(
+                    self.args, indices[start:end],
+                    samples[bounds[start]:bounds[min(end, len(indices))]],
+                    sizes[start:end])
+            batch = self._remove_empty_profiles(batch)
+            if len(batch):
+                yield batch
+
+    def _has_rtree(self, cursor):
+        sql = 'SELECT 1 FROM sqlite_master WHERE name == ?'
+        return cursor.execute(sql, [RTREE_TABLE]).fetchone() is not None
+
+    def _query_metadata(self, cursor, limit_results=True):
+        with self._stats.stage('metadata'):
+            query = self._build_query(self._has_rtree(cursor))
+            results = cursor.execute(*query)
+            fields = self._metadata_fields(results)
+            rows = self._refine(fields, results.fetchall())
+        if limit_results:
+            self._check_max_results(len(rows))
+        return fields, rows
+
+    def _check_max_results(self, n_results):
+        if self._max_results is None:
+            return
+        if n_results > self._max_results:
             error_str = '{} results exceed maximum of {}'
             raise RuntimeError(
-                error_str.format(len(rows), self._max_results))
-        self._profiles = []
-        for row in rows:
-            this_profile = Profile()
-            for field, value in zip(fields, row):
-                setattr(this_profile, field, value)
-            self._profiles.append(this_profile)
-
-    def _build_query(self):
+                error_str.format(n_results, self._max_results))
+
+    def _metadata_batch(self, fields, rows):
+        # the query is copied so later changes to the filters don't
+        # affect what the profiles load
+        loader = _CtdLoader(
+            ItpQuery(self.database or self.db_path, **self.args),
+            [row[0] for row in rows])
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        return ProfileBatch.from_rows(fields, rows, offsets, {}, loader)
+
+    def _metadata_fields(self, results):
+        fields = [x[0] for x in results.description]
+        fields[0] = '_id'
+        return fields
+
+    def _refine(self, fields, rows):
+        # Some filters (e.g. radius) only select candidates in SQL. Their
+        # exact test is applied here, to all the candidate rows at once.
+        sql_filters = [
+            pre_filter_factory(argument, values)
+            for argument, values in self.args.items()
+        ]
+        sql_filters = [f for f in sql_filters if f and not f.exact]
+        if not sql_filters or not rows:
+            return rows
+        columns = list(zip(*rows))
+        latitude = np.array(columns[fields.index('latitude')], dtype=float)
+        longitude = np.array(columns[fields.index('longitude')], dtype=float)
+        keep = np.ones(len(rows), dtype=bool)
+        for sql_filter in sql_filters:
+            keep &= sql_filter.refine(latitude, longitude)
+        return [row for row, k in zip(rows, keep) if k]
+
+    def _build_query(self, use_rtree=False):
         query = 'SELECT * FROM profiles'
         sql_args = []
         if self.args:
             query += ' WHERE'
+        rtree_filters = []
         for argument, values in self.args.items():
             sql_filter = pre_filter_factory(argument, values)
-            if sql_filter:
+            if argument == 'pressure':
+                # only return profiles with samples in the pressure range
+                sql_filter = PressureFilter(values)
+                sql, these_args = sql_filter.profile_value()
+            elif sql_filter:
                 sql, these_args = sql_filter.value()
-                query += ' ' + sql + ' AND'
-                sql_args.extend(these_args)
+            else:
+                continue
+            query += ' ' + sql + ' AND'
+            sql_args.extend(these_args)
+            if sql_filter.rtree_ranges():
+                rtree_filters.append(sql_filter)
+        if use_rtree and rtree_filters:
+            sql, these_args = rtree_value(rtree_filters)
+            query += ' ' + sql + ' AND'
+            sql_args.extend(these_args)
         if query.endswith(' AND'):
             query = query[:-4]
         if query.endswith(' WHERE'):
@@ -82,43 +521,240 @@ class ItpQuery:
         query += ' ORDER BY system_number, profile_number'
         return query, sql_args
 
-    def _query_profiles(self, cursor):
-        for profile in self._profiles:
-            sql_args = [profile._id]
-            fields = ['pressure', 'temperature', 'salinity']
-            format_str = '{0}/10000.0 as {0}'
-            query = 'SELECT '
-            query += ', '.join([format_str.format(x) for x in fields])
-            query += ' FROM ctd'
-            query += ' WHERE profile_id = ?'
-            if 'pressure' in self.args:
-                sql, args = PressureFilter(self.args['pressure']).value()
-                query += ' AND ' + sql
-                sql_args.extend(args)
-            query += ' ORDER BY pressure'
-            results = cursor.execute(query, sql_args)
-
-            values = np.array(results.fetchall(), dtype=np.float)
-            if values.size == 0:
-                # the pressure filter may eliminate all the samples
-                # in that case, remove the profile
-                continue
-            for i, field in enumerate(fields):
-                setattr(profile, field, values[:, i])
-            if 'extra_variables' in self.args:
-                self._load_extra_variables(cursor, profile)
+    def _query_profiles(self, cursor, fields, rows, variable_ids):
+        profile_ids = [row[0] for row in rows]
+        offsets, values = self._query_samples(
+            cursor, profile_ids, variable_ids)
+        with self._stats.stage('numpy'):
+            return ProfileBatch.from_rows(fields, rows, offsets, values)
 
-    def _load_extra_variables(self, cursor, profile):
-        for var in self.args['extra_variables']:
-            sql = 'SELECT value/10000.0 val FROM ctd '
-            sql += 'LEFT JOIN other_variables '
-            sql += 'ON ctd.id == other_variables.ctd_id AND variable_id == '
-            sql += '(SELECT id FROM variable_names WHERE name == ?) '
-            sql += 'WHERE ctd.profile_id == ?'
-            sql += 'ORDER BY pressure'
-            results = cursor.execute(sql, [var, profile._id])
-            values = np.array(results.fetchall(), dtype=np.float)
-            setattr(profile, var, values[:, 0])
-
-    def _remove_empty_profiles(self):
-        self._profiles = [p for p in self._profiles if p.pressure is not None]
+    def _query_samples(self, cursor, profile_ids, variable_ids):
+        # CTD rows are pulled for many profiles at once and stored end to
+        # end in the order of profile_ids. Profiles are chunked so the IN
+        # list stays below SQLite's limit on the number of bound variables.
+        # Returns the offsets and a dict of values, as in ProfileBatch.
+        variables = self._variables()
+        sizes = []
+        values = []
+        for start in range(0, len(profile_ids), CHUNK_SIZE):
+            chunk = profile_ids[start:start + CHUNK_SIZE]
+            chunk_sizes, chunk_values = self._query_chunk(
+                cursor, chunk, variable_ids)
+            sizes.append(chunk_sizes)
+            values.append(chunk_values)
+        sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=int)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        values = np.hstack(values) if values else np.zeros((len(variables), 0))
+        return offsets, dict(zip(variables, values))
+
+    def _variables(self):
+        # the names of the measured variables a query returns
+        variables = ['pressure', 'temperature', 'salinity']
+        return variables + self.args.get('extra_variables', [])
+
+    def _query_chunk(self, cursor, profile_ids, variable_ids):
+        # returns the number of samples of each profile, and the samples
+        # (one row per variable) ordered by profile, then pressure
+        query, sql_args = self._build_ctd_query(profile_ids, variable_ids)
+        with self._stats.stage('ctd'):
+            rows = cursor.execute(query, sql_args).fetchall()
+        with self._stats.stage('numpy'):
+            return self._decode_chunk(profile_ids, rows)
+
+    def _decode_chunk(self, profile_ids, rows):
+        # np.fromiter reads the flattened rows about twice as fast as
+        # np.array(rows) builds an array from the tuples. NULL is NaN.
+        n_columns = len(self._variables()) + 1
+        values = np.fromiter(
+            chain.from_iterable(rows), dtype=float,
+            count=len(rows) * n_columns)
+        values = values.reshape(-1, n_columns).T
+        ids, values = values[0].astype(int), values[1:] / 10000.0
+        # position of each row's profile within this chunk
+        sorter = np.argsort(profile_ids)
+        position = sorter[np.searchsorted(profile_ids, ids, sorter=sorter)]
+        # rows come back grouped by profile, in index order. Sorting by
+        # pressure is cheaper here than in a SQLite temp b-tree.
+        order = np.lexsort((values[0], position))
+        sizes = np.bincount(position, minlength=len(profile_ids))
+        return sizes, values[:, order]
+
+    def _build_ctd_query(self, profile_ids, variable_ids):
+        # One statement returns the CTD samples of the profiles, with the
+        # pressure filter applied, and one column for each extra variable.
+        # Extra variables are joined by their id, which was looked up
+        # when the variable names were validated.
+        extra_variables = self.args.get('extra_variables', [])
+        sql_args = [variable_ids[var] for var in extra_variables]
+        sql_args.extend(profile_ids)
+        if 'pressure' in self.args:
+            sql_args.extend(PressureFilter(self.args['pressure']).value()[1])
+        query = _ctd_statement(
+            len(profile_ids), len(extra_variables), 'pressure' in self.args)
+        return query, sql_args
+
+    def _quality_control(self, batch):
+        if self._qc is None:
+            return batch
+        checks, action, level = self._qc
+        with self._stats.stage('qc'):
+            return quality_control(batch, checks, action, level)
+
+    def _remove_empty_profiles(self, batch):
+        # the pressure filter may eliminate all the samples of a profile
+        not_empty = batch.sizes() > 0
+        if not_empty.all():
+            return batch
+        return batch.take(not_empty)
+
+
+def _level_sample_query(ctd_ids, variable_ids):
+    # pressure and the variables of the given ctd rows, unscaled
+    query = 'SELECT ctd.id, ctd.pressure'
+    joins = ''
+    sql_args = []
+    for i, (var, variable_id) in enumerate(variable_ids.items()):
+        if variable_id is None:
+            query += ', ctd.' + var
+            continue
+        alias = 'v{}'.format(i)
+        query += ', {}.value'.format(alias)
+        joins += ' LEFT JOIN other_variables {0}'.format(alias)
+        joins += ' ON {0}.ctd_id == ctd.id'.format(alias)
+        joins += ' AND {0}.variable_id == ?'.format(alias)
+        sql_args.append(variable_id)
+    query += ' FROM ctd' + joins
+    query += ' WHERE ctd.id IN (' + ','.join('?' * len(ctd_ids)) + ')'
+    return query, sql_args + list(ctd_ids)
+
+
+def _archive_brackets(archive, indices, pressure, window):
+    # the indices of the samples on either side of the level, as in
+    # ItpQuery._query_brackets, or -1. Pressures are sorted within each
+    # profile, so counting the samples at or above the level finds them.
+    # Pressures are compared as scaled integers, like in SQL.
+    level, lowest, highest = [
+        round(p * 10000)
+        for p in (pressure, pressure - window, pressure + window)
+    ]
+    starts = archive.offsets[indices]
+    sizes = archive.offsets[indices + 1] - starts
+    scaled = np.rint(archive.values['pressure'] * 10000)
+    samples = _ranges(starts, sizes)
+    counted = np.concatenate([[0], np.cumsum(scaled[samples] <= level)])
+    ends = np.cumsum(sizes)
+    count = counted[ends] - counted[ends - sizes]
+    below = np.where(count > 0, starts + count - 1, -1)
+    above = np.where(count < sizes, starts + count, -1)
+    below[(below >= 0) & ~(_take(scaled, below) >= lowest)] = -1
+    above[(above >= 0) & ~(_take(scaled, above) <= highest)] = -1
+    # a sample exactly at the level is both
+    exact = (below >= 0) & (_take(scaled, below) == level)
+    above[exact] = below[exact]
+    return below, above
+
+
+def _take(values, indices):
+    # values[indices], with NaN where indices is -1
+    indices = np.asarray(indices)
+    result = np.asarray(values)[np.clip(indices, 0, None)].astype(float)
+    result[indices < 0] = np.nan
+    return result
+
+
+def _level_values(pressure, method, below, above):
+    # Combines the samples on either side of a level, given as
+    # [pressure, variables...] arrays, into the values at the level
+    p_below, p_above = below[0], above[0]
+    if method == 'nearest':
+        use_above = np.isnan(p_below) | (p_above - pressure < pressure - p_below)
+        return [np.where(use_above, a, b) for b, a in zip(below, above)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (pressure - p_below) / (p_above - p_below)
+    # a sample at the level is its own bracket
+    weight = np.where(p_above == p_below, 0.0, weight)
+    values = [b + weight * (a - b) for b, a in zip(below[1:], above[1:])]
+    level = np.where(np.isnan(weight), np.nan, float(pressure))
+    return [level] + values
+
+
+@lru_cache(maxsize=256)
+def _ctd_statement(n_profiles, n_extra_variables, pressure_filter):
+    # The text of the statement ItpQuery._build_ctd_query runs. It only
+    # depends on these counts, so it is built once per shape; the identical
+    # text also lets sqlite3 reuse the compiled statement on a connection
+    # (see ItpDatabase).
+    # Values are stored as integers scaled by 10000. They are returned
+    # unscaled, which sqlite3 decodes faster than floats, and scaled
+    # afterwards with NumPy.
+    fields = ['pressure', 'temperature', 'salinity']
+    query = 'SELECT ctd.profile_id, '
+    query += ', '.join(['ctd.' + x for x in fields])
+    joins = ''
+    for i in range(n_extra_variables):
+        alias = 'v{}'.format(i)
+        query += ', {}.value'.format(alias)
+        joins += ' LEFT JOIN other_variables {0}'.format(alias)
+        joins += ' ON {0}.ctd_id == ctd.id'.format(alias)
+        joins += ' AND {0}.variable_id == ?'.format(alias)
+    query += ' FROM ctd' + joins
+    query += ' WHERE ctd.profile_id IN ('
+    query += ','.join('?' * n_profiles) + ')'
+    if pressure_filter:
+        query += ' AND ' + PressureFilter([0, 0]).value()[0]
+    query += ' ORDER BY ctd.profile_id'
+    return query
+
+
+def _load_partition(db_path, args, profile_ids):
+    # runs in a worker process of ItpQuery._load_parallel
+    query = ItpQuery(db_path, **args)
+    uri = query.db_path.absolute().as_uri() + '?mode=ro'
+    with closing(sqlite3.connect(uri, uri=True)) as connection:
+        cursor = connection.cursor()
+        variable_ids = query._validate_extra_fields(cursor)
+        return query._query_samples(cursor, profile_ids, variable_ids)
+
+
+class _CtdLoader:
+    # Loads the measurements of the profiles of a metadata only query when
+    # they are first accessed. All the profiles share one connection, which
+    # is opened on first use, unless the query has an ItpDatabase to borrow
+    # connections from. It is closed once every profile has been loaded
+    # (and opened again if a profile is loaded twice, e.g. from another
+    # Profile object of the same batch), or when the loader is discarded.
+    def __init__(self, query, profile_ids):
+        self._query = query
+        self._connection = None
+        self._variable_ids = None
+        self._pending = set(profile_ids)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def profile_values(self, profile_id):
+        if self._query.database is not None:
+            with self._query._connect() as connection:
+                cursor = connection.cursor()
+                variable_ids = self._query._validate_extra_fields(cursor)
+                _, values = self._query._query_chunk(
+                    cursor, [profile_id], variable_ids)
+            return dict(zip(self._query._variables(), values))
+        if self._connection is None:
+            uri = self._query.db_path.absolute().as_uri() + '?mode=ro'
+            self._connection = sqlite3.connect(
+                uri, uri=True, check_same_thread=False)
+            cursor = self._connection.cursor()
+            self._variable_ids = self._query._validate_extra_fields(cursor)
+        cursor = self._connection.cursor()
+        _, values = self._query._query_chunk(
+            cursor, [profile_id], self._variable_ids)
+        self._pending.discard(profile_id)
+        if not self._pending:
+            self.close()
+        return dict(zip(self._query._variables(), values))
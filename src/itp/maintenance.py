@@ -0,0 +1,287 @@
+import argparse
+import shutil
+import sqlite3
+import numpy as np
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+from itp.itp_query import ItpQuery
+from itp.filters import RTREE_TABLE
+from itp.instrumentation import query_plan
+from itp import archive, track
+from itp.itp_query import CHUNK_SIZE
+
+
+# Indexes that serve the queries ItpQuery generates, as
+# (name, table, columns). The database as distributed only indexes
+# ctd(profile_id), other_variables(ctd_id) and
+# profile_extra_variables(variable_id).
+INDEXES = [
+    # the system filter, and the ORDER BY of every metadata query
+    ('idx_profiles_system_profile', 'profiles',
+        ['system_number', 'profile_number']),
+    ('idx_profiles_latitude', 'profiles', ['latitude']),
+    ('idx_profiles_longitude', 'profiles', ['longitude']),
+    ('idx_profiles_date_time', 'profiles', ['date_time']),
+    # pressure windows, both when selecting profiles and loading samples
+    ('idx_ctd_profile_pressure', 'ctd', ['profile_id', 'pressure']),
+    # covers the extra variable joins, so the table is never read
+    ('idx_other_variables_ctd_variable', 'other_variables',
+        ['ctd_id', 'variable_id', 'value']),
+    # covers the extra_variables filter
+    ('idx_profile_extra_variables_variable_profile',
+        'profile_extra_variables', ['variable_id', 'profile_id']),
+]
+
+# filters whose query plans are reported by explain()
+SAMPLE_QUERIES = {
+    'system': {'system': [1, 2]},
+    'latitude/longitude box': {'latitude': [70, 80], 'longitude': [-170, -140]},
+    'dateline longitude': {'longitude': [170, -170]},
+    'radius': {'radius': [78, -150, 200]},
+    'date range': {
+        'date_time': [datetime(2010, 1, 1), datetime(2010, 12, 31)]},
+    'pressure window': {'system': [1], 'pressure': [400, 402]},
+    'extra variables': {'extra_variables': ['dissolved_oxygen']},
+}
+
+
+def existing_indexes(db_path):
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        sql = "SELECT name FROM sqlite_master WHERE type == 'index'"
+        return [row[0] for row in connection.execute(sql)]
+
+
+def missing_indexes(db_path):
+    existing = existing_indexes(db_path)
+    return [index[0] for index in INDEXES if index[0] not in existing]
+
+
+def redundant_indexes(db_path):
+    # Other indexes of the tables of INDEXES whose columns are the first
+    # columns of one of INDEXES, e.g. other_variables(ctd_id) of the
+    # database as distributed. Queries can use the longer index instead,
+    # so they only cost time on every ingest and space in the file.
+    recommended = {name for name, _, _ in INDEXES}
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        redundant = []
+        for name, table in connection.execute(
+                "SELECT name, tbl_name FROM sqlite_master "
+                "WHERE type == 'index' AND sql IS NOT NULL "
+                "AND sql NOT LIKE 'CREATE UNIQUE%'").fetchall():
+            columns = [row[2] for row in connection.execute(
+                'PRAGMA index_info({})'.format(name))]
+            if name not in recommended and _is_prefix(table, columns):
+                redundant.append(name)
+        return redundant
+
+
+def optimize(db_path):
+    # creates the missing indexes, drops the indexes they make redundant
+    # and updates the query planner statistics. Returns the names of the
+    # indexes that were created.
+    created = missing_indexes(db_path)
+    redundant = redundant_indexes(db_path)
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        for name, table, columns in INDEXES:
+            sql = 'CREATE INDEX IF NOT EXISTS {} ON {}({})'
+            connection.execute(sql.format(name, table, ', '.join(columns)))
+        for name in redundant:
+            connection.execute('DROP INDEX {}'.format(name))
+        connection.execute('ANALYZE')
+        connection.commit()
+    return created
+
+
+def _is_prefix(table, columns):
+    # whether columns are the first columns of one of INDEXES on table
+    return any(
+        index_table == table and index_columns[:len(columns)] == columns
+        for _, index_table, index_columns in INDEXES)
+
+
+def build_rtree(db_path):
+    # (Re)builds the R*Tree index of profile latitude, longitude and
+    # POSIX time. ItpQuery uses it automatically once it exists, and
+    # itp.ingest keeps it up to date as profiles are added. Returns the
+    # number of profiles indexed.
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(RTREE_TABLE))
+        connection.execute(
+            'CREATE VIRTUAL TABLE {} USING rtree(id, '
+            'min_latitude, max_latitude, '
+            'min_longitude, max_longitude, '
+            'min_time, max_time)'.format(RTREE_TABLE))
+        # every profile is a point; missing values are indexed as 0, the
+        # exact filters reject them anyway
+        connection.execute(
+            'INSERT INTO {} SELECT id, '
+            'coalesce(latitude, 0), coalesce(latitude, 0), '
+            'coalesce(longitude, 0), coalesce(longitude, 0), '
+            "coalesce(strftime('%s', date_time), 0), "
+            "coalesce(strftime('%s', date_time), 0) "
+            'FROM profiles'.format(RTREE_TABLE))
+        count = connection.execute(
+            'SELECT count(*) FROM {}'.format(RTREE_TABLE)).fetchone()[0]
+        connection.commit()
+    return count
+
+
+def drop_rtree(db_path):
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(RTREE_TABLE))
+        connection.commit()
+
+
+def build_archive(db_path):
+    # (Re)writes the binary archive of the database (see itp.archive),
+    # which ItpQuery then uses instead of SQLite. Samples are decoded
+    # CHUNK_SIZE profiles at a time and written straight to the memory
+    # mapped files. Returns the path of the archive.
+    path = archive.archive_path(db_path)
+    partial = path.with_suffix('.archive-partial')
+    if partial.exists():
+        shutil.rmtree(str(partial))
+    query = ItpQuery(db_path)
+    query.set_use_archive(False)
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        cursor = connection.cursor()
+        fields, rows = query._query_metadata(cursor, limit_results=False)
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        counts = dict(cursor.execute(
+            'SELECT profile_id, count(*) FROM ctd GROUP BY profile_id'))
+        sizes = np.array([counts.get(i, 0) for i in ids], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        variable_ids = dict(cursor.execute(
+            'SELECT name, id FROM variable_names ORDER BY id'))
+        variables = list(variable_ids)
+        values = archive.write_archive(
+            partial, fields, rows, offsets,
+            archive.database_fingerprint(cursor), variables)
+
+        # the CTD queries load every extra variable
+        query.args = {'extra_variables': variables}
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE].tolist()
+            _, chunk_values = query._query_chunk(cursor, chunk, variable_ids)
+            begin, end = offsets[start], offsets[start + len(chunk)]
+            for name, column in zip(query._variables(), chunk_values):
+                values[name][begin:end] = column
+        for column in values.values():
+            column.flush()
+        del values
+
+        for name, variable_id in variable_ids.items():
+            sql = 'SELECT DISTINCT profile_id FROM profile_extra_variables ' \
+                'WHERE variable_id == ?'
+            listed = [row[0] for row in cursor.execute(sql, [variable_id])]
+            archive.write_has_variable(partial, name, np.isin(ids, listed))
+
+    if path.exists():
+        shutil.rmtree(str(path))
+    partial.rename(path)
+    return path
+
+
+def explain(db_path, queries=None):
+    # Returns the EXPLAIN QUERY PLAN of the statements ItpQuery runs for
+    # each filter dictionary, as {name: [(statement, [plan lines])]}.
+    if queries is None:
+        queries = SAMPLE_QUERIES
+    report = {}
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        cursor = connection.cursor()
+        for name, args in queries.items():
+            query = ItpQuery(db_path, **args)
+            variable_ids = query._validate_extra_fields(cursor)
+            statements = [
+                query._build_query(query._has_rtree(cursor)),
+                query._build_ctd_query([1, 2, 3], variable_ids),
+            ]
+            report[name] = [
+                (sql, query_plan(cursor, sql, sql_args))
+                for sql, sql_args in statements
+            ]
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='itp-maintenance',
+        description='Inspect and optimize an ITP SQLite database.')
+    parser.add_argument(
+        'command',
+        choices=list(COMMANDS),
+        help='check: list missing and redundant indexes. optimize: create '
+             'the missing ones, drop the redundant ones and run ANALYZE. '
+             'rtree: build the spatial/temporal R*Tree index. '
+             'archive: write the memory mapped binary archive. '
+             'tracks: store the drift of every profile. '
+             'explain: show the query plans of sample queries.')
+    parser.add_argument('db_path', help='path to the ITP database')
+    args = parser.parse_args(argv)
+
+    db_path = Path(args.db_path)
+    if not db_path.is_file():
+        parser.error('{} does not exist'.format(db_path))
+    COMMANDS[args.command](db_path)
+    return 0
+
+
+def _check_command(db_path):
+    missing = missing_indexes(db_path)
+    for name in missing:
+        print('missing index {}'.format(name))
+    if not missing:
+        print('all recommended indexes exist')
+    for name in redundant_indexes(db_path):
+        print('redundant index {}'.format(name))
+
+
+def _optimize_command(db_path):
+    redundant = redundant_indexes(db_path)
+    for name in optimize(db_path):
+        print('created index {}'.format(name))
+    for name in redundant:
+        print('dropped index {}'.format(name))
+    print('analyzed {}'.format(db_path))
+
+
+def _rtree_command(db_path):
+    count = build_rtree(db_path)
+    print('indexed {} profiles in {}'.format(count, RTREE_TABLE))
+
+
+def _archive_command(db_path):
+    print('wrote {}'.format(build_archive(db_path)))
+
+
+def _tracks_command(db_path):
+    count = track.build_track_table(db_path)
+    print('stored the drift of {} profiles in {}'.format(
+        count, track.TRACK_TABLE))
+
+
+def _explain_command(db_path):
+    for name, statements in explain(db_path).items():
+        print('== {} =='.format(name))
+        for sql, plan in statements:
+            print(sql)
+            for line in plan:
+                print('  ' + line)
+        print()
+
+
+# the function run by each command of main
+COMMANDS = {
+    'check': _check_command,
+    'optimize': _optimize_command,
+    'rtree': _rtree_command,
+    'archive': _archive_command,
+    'tracks': _tracks_command,
+    'explain': _explain_command,
+}
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
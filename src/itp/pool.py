@@ -0,0 +1,83 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# seconds to wait for a connection to be returned before giving up
+TIMEOUT = 60.0
+
+
+class ConnectionPool:
+    # A fixed number of read only connections to one database, shared by
+    # threads. connection() hands out an idle connection, opening one if
+    # fewer than size are open, and otherwise waits up to timeout seconds
+    # for one to be returned, then raises RuntimeError. Connections may be
+    # used by any thread, but only by one at a time, and a thread holding
+    # one must not ask for another. opener, if given, is called to open
+    # each connection instead of _open.
+    def __init__(self, db_path, size=4, opener=None, timeout=TIMEOUT):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        if timeout <= 0:
+            raise ValueError('timeout must be positive')
+        self.db_path = Path(db_path)
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._opener = opener or self._open
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._release(connection)
+
+    def open(self):
+        # a new connection like the pooled ones, outside the pool. The
+        # caller closes it.
+        return self._opener()
+
+    def close(self):
+        # closes the idle connections now, and the others when returned
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _acquire(self):
+        if self._closed:
+            raise RuntimeError('The connection pool is closed')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                connection = self._opener()
+                self._opened += 1
+                return connection
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError(
+                'No connection was returned to the pool within {} s'.format(
+                    self.timeout)) from None
+
+    def _release(self, connection):
+        if self._closed:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+    def _open(self):
+        uri = self.db_path.absolute().as_uri() + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
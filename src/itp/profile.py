@@ -1,73 +1,235 @@
 from datetime import datetime, timezone
-import gsw
 
 
-class Profile:
-    def __init__(self):
-        self._id = None
-        self.system_number = None
-        self.profile_number = None
-        self.date_time = None
-        self.latitude = None
-        self.longitude = None
-        self.pressure = None
-        self.salinity = None
-        self.temperature = None
-        self.source = None
+class DerivedValues:
+    # TEOS-10 derived values shared by Profile and ProfileBatch. Subclasses
+    # provide pressure, temperature and salinity arrays, and the latitude
+    # and longitude of the samples in a form that broadcasts against them.
+    # Results are cached, so e.g. absolute salinity is computed once no
+    # matter how many other values depend on it. Cached arrays are read
+    # only, and callers get a copy, which they may modify.
+    # gsw is only imported by the first derived value computed, as it is
+    # slow to import and many searches never need it.
+    __slots__ = ()
 
-    def python_datetime(self):
-        return datetime.strptime(self.date_time, '%Y-%m-%dT%H:%M:%S')
+    def _cached(self, key, func):
+        if key not in self._cache:
+            value = func()
+            if hasattr(value, 'setflags'):
+                value.setflags(write=False)
+            self._cache[key] = value
+        return self._cache[key]
 
-    def posix_time(self):
-        dt = self.python_datetime()
-        return dt.replace(tzinfo=timezone.utc).timestamp()
+    def _derived(self, key, func):
+        return self._cached(key, func).copy()
+
+    def _sample_latitude(self):
+        raise NotImplementedError
+
+    def _sample_longitude(self):
+        raise NotImplementedError
 
     def depth(self):
         return -self.height()
 
     def height(self):
-        return gsw.conversions.z_from_p(self.pressure, self.latitude)
+        return self._derived('height', lambda: _gsw().conversions.z_from_p(
+            self.pressure,
+            self._sample_latitude()
+        ))
 
     def absolute_salinity(self):
-        return gsw.conversions.SA_from_SP(
-            self.salinity,
-            self.pressure,
-            self.longitude,
-            self.latitude
-        )
+        return self._derived('absolute_salinity', lambda: (
+            _gsw().conversions.SA_from_SP(
+                self.salinity,
+                self.pressure,
+                self._sample_longitude(),
+                self._sample_latitude()
+            )
+        ))
 
     def conservative_temperature(self):
-        return gsw.conversions.CT_from_t(
-            self.absolute_salinity(),
-            self.temperature,
-            self.pressure
-        )
+        return self._derived('conservative_temperature', lambda: (
+            _gsw().conversions.CT_from_t(
+                self.absolute_salinity(),
+                self.temperature,
+                self.pressure
+            )
+        ))
 
     def density(self):
-        return gsw.rho(
+        return self._derived('density', lambda: _gsw().rho(
             self.absolute_salinity(),
             self.conservative_temperature(),
             self.pressure
-        )
+        ))
 
     def potential_temperature(self, p_ref=0):
-        return gsw.conversions.pt_from_t(
-            self.absolute_salinity(),
-            self.temperature,
-            self.pressure,
-            p_ref
-        )
+        return self._derived(('potential_temperature', p_ref), lambda: (
+            _gsw().conversions.pt_from_t(
+                self.absolute_salinity(),
+                self.temperature,
+                self.pressure,
+                p_ref
+            )
+        ))
 
     def freezing_temperature_zero_pressure(self):
-        return gsw.CT_freezing(
-            self.absolute_salinity(),
-            p=0,
-            saturation_fraction=1
-        )
+        return self._derived('freezing_temperature_zero_pressure', lambda: (
+            _gsw().CT_freezing(
+                self.absolute_salinity(),
+                p=0,
+                saturation_fraction=1
+            )
+        ))
 
     def heat_capacity(self):
-        return gsw.cp_t_exact(
+        return self._derived('heat_capacity', lambda: _gsw().cp_t_exact(
             self.absolute_salinity(),
             self.temperature,
             self.pressure
-        )
+        ))
+
+
+def _gsw():
+    import gsw
+    return gsw
+
+
+def _invalidating(name):
+    # a property that clears the derived value cache when it is assigned
+    attribute = '_' + name
+
+    def getter(self):
+        return getattr(self, attribute)
+
+    def setter(self, value):
+        setattr(self, attribute, value)
+        self._cache.clear()
+    return property(getter, setter)
+
+
+def _measured(name):
+    # like _invalidating, but the value is loaded on first access when
+    # the profile was created with a loader
+    attribute = '_' + name
+
+    def getter(self):
+        if self._loader is not None:
+            self._load()
+        return getattr(self, attribute)
+
+    def setter(self, value):
+        if self._loader is not None:
+            self._load()
+        setattr(self, attribute, value)
+        self._cache.clear()
+    return property(getter, setter)
+
+
+class Profile(DerivedValues):
+    # Profiles use __slots__ to keep large result sets small. Extra
+    # variables (e.g. dissolved_oxygen) and any other fields are kept in a
+    # dictionary and are readable as attributes.
+    __slots__ = (
+        '_id',
+        'system_number',
+        'profile_number',
+        'date_time',
+        'source',
+        'direction',
+        '_latitude',
+        '_longitude',
+        '_pressure',
+        '_salinity',
+        '_temperature',
+        '_extra',
+        '_cache',
+        '_loader',
+    )
+
+    latitude = _invalidating('latitude')
+    longitude = _invalidating('longitude')
+    pressure = _measured('pressure')
+    salinity = _measured('salinity')
+    temperature = _measured('temperature')
+
+    def __init__(self):
+        self._loader = None
+        self._cache = {}
+        self._extra = {}
+        self._id = None
+        self.system_number = None
+        self.profile_number = None
+        self.date_time = None
+        self.source = None
+        self.direction = None
+        self._latitude = None
+        self._longitude = None
+        self._pressure = None
+        self._salinity = None
+        self._temperature = None
+
+    def __getattr__(self, name):
+        # only called when normal attribute lookup fails
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._loader is not None:
+            self._load()
+        try:
+            return self._extra[name]
+        except KeyError:
+            raise AttributeError(
+                "'Profile' object has no attribute '{}'".format(name))
+
+    def __getstate__(self):
+        # Loads the measured values first, so a pickled profile holds only
+        # its own samples, not the batch or query they would be loaded
+        # from. The derived value cache is not kept.
+        if self._loader is not None:
+            self._load()
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def set_field(self, name, value):
+        # sets an attribute, or an extra variable if Profile has no
+        # attribute of that name
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            self._extra[name] = value
+
+    def extra_fields(self):
+        if self._loader is not None:
+            self._load()
+        return dict(self._extra)
+
+    def _set_loader(self, source, key):
+        # The measured values will be requested from
+        # source.profile_values(key) the first time they are accessed.
+        # It must return a dict of variable name to array.
+        self._loader = (source, key)
+
+    def _load(self):
+        source, key = self._loader
+        self._loader = None
+        for name, values in source.profile_values(key).items():
+            self.set_field(name, values)
+
+    def _sample_latitude(self):
+        return self.latitude
+
+    def _sample_longitude(self):
+        return self.longitude
+
+    def python_datetime(self):
+        return datetime.strptime(self.date_time, '%Y-%m-%dT%H:%M:%S')
+
+    def posix_time(self):
+        dt = self.python_datetime()
+        return dt.replace(tzinfo=timezone.utc).timestamp()
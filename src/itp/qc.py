@@ -0,0 +1,301 @@
+import numpy as np
+from itp.batch import ProfileBatch
+from itp.profile import _gsw
+
+
+# Quality flags, as in the QARTOD and Argo conventions. A sample's flag
+# is the worst of all the checks run on it.
+GOOD = 1
+SUSPECT = 3
+BAD = 4
+MISSING = 9
+
+ACTIONS = ['mask', 'drop']
+
+
+class Check:
+    # A quality control test run on all the samples of a ProfileBatch at
+    # once. flags(batch) returns {variable: flags}, an int8 array in the
+    # layout of the measured variables for each variable the test judges:
+    # GOOD where the test passed or could not be evaluated (e.g. the first
+    # sample of a profile for tests that need both neighbours), SUSPECT or
+    # BAD where it failed. Tests that compare neighbouring samples never
+    # compare samples of different profiles. Most tests take a threshold,
+    # beyond which samples are BAD, and optionally a lower suspect
+    # threshold, beyond which they are SUSPECT.
+    def flags(self, batch):
+        raise NotImplementedError
+
+
+class RangeCheck(Check):
+    # Values outside [minimum, maximum] are BAD; either bound may be None.
+    # suspect is an optional narrower (minimum, maximum) range, outside of
+    # which values are SUSPECT. variable may also be a derived value such
+    # as density (see ProfileGrid), in which case the temperature and
+    # salinity it is computed from are flagged.
+    def __init__(self, variable, minimum=None, maximum=None, suspect=None):
+        if minimum is None and maximum is None:
+            raise ValueError('RangeCheck needs a minimum or a maximum')
+        if minimum is not None and maximum is not None and minimum > maximum:
+            raise ValueError('minimum must not be greater than maximum')
+        if suspect is not None and len(suspect) != 2:
+            raise ValueError('suspect must be a (minimum, maximum) pair')
+        self.variable = variable
+        self.minimum = minimum
+        self.maximum = maximum
+        self.suspect = suspect
+
+    def flags(self, batch):
+        values = batch.variable_values(self.variable)
+        flags = np.full(len(values), GOOD, dtype=np.int8)
+        if self.suspect is not None:
+            flags[_outside(values, *self.suspect)] = SUSPECT
+        flags[_outside(values, self.minimum, self.maximum)] = BAD
+        return {self.variable: flags}
+
+
+class SpikeCheck(Check):
+    # The Argo spike test: a sample is a spike by
+    # |v - (v_prev + v_next) / 2| - |(v_next - v_prev) / 2|, which is how
+    # far it sticks out of the line between its neighbours.
+    def __init__(self, variable, threshold, suspect=None):
+        self.variable = variable
+        self.threshold = _threshold(threshold, suspect)
+        self.suspect = suspect
+
+    def flags(self, batch):
+        values = batch.variable_values(self.variable)
+        previous, following = _neighbours(batch, values)
+        spike = np.abs(values - (previous + following) / 2) \
+            - np.abs((following - previous) / 2)
+        return {self.variable: _grade(spike, self.threshold, self.suspect)}
+
+
+class GradientCheck(Check):
+    # The Argo gradient test: |v - (v_prev + v_next) / 2|, the difference
+    # between a sample and the mean of its neighbours.
+    def __init__(self, variable, threshold, suspect=None):
+        self.variable = variable
+        self.threshold = _threshold(threshold, suspect)
+        self.suspect = suspect
+
+    def flags(self, batch):
+        values = batch.variable_values(self.variable)
+        previous, following = _neighbours(batch, values)
+        gradient = np.abs(values - (previous + following) / 2)
+        return {self.variable: _grade(gradient, self.threshold, self.suspect)}
+
+
+class DensityInversionCheck(Check):
+    # Flags the temperature and salinity of both samples of a pair of
+    # neighbouring samples whose density decreases with pressure by more
+    # than threshold (kg/m^3). Both densities are computed at the mean
+    # pressure of the pair, from the same absolute salinity and
+    # conservative temperature as ProfileBatch.density, so compressibility
+    # does not hide inversions as it would comparing in situ densities.
+    def __init__(self, threshold=0.03, suspect=None):
+        self.threshold = _threshold(threshold, suspect)
+        self.suspect = suspect
+
+    def flags(self, batch):
+        pressure = batch.variable_values('pressure')
+        flags = np.full(len(pressure), GOOD, dtype=np.int8)
+        if len(pressure) < 2:
+            return {'temperature': flags, 'salinity': flags}
+        gsw = _gsw()
+        salinity = batch.absolute_salinity()
+        temperature = batch.conservative_temperature()
+        middle = (pressure[:-1] + pressure[1:]) / 2
+        upper = gsw.rho(salinity[:-1], temperature[:-1], middle)
+        lower = gsw.rho(salinity[1:], temperature[1:], middle)
+        # the decrease of density with pressure, whichever way the profile
+        # is sorted
+        inversion = (upper - lower) * np.sign(pressure[1:] - pressure[:-1])
+        inversion[_profile_breaks(batch, len(pressure))] = np.nan
+        pair_flags = _grade(inversion, self.threshold, self.suspect)
+        flags[:-1] = pair_flags
+        flags[1:] = np.maximum(flags[1:], pair_flags)
+        return {'temperature': flags, 'salinity': flags.copy()}
+
+
+class StuckValueCheck(Check):
+    # Flags runs of at least length consecutive samples of a profile whose
+    # values differ by at most tolerance from the previous one, as from a
+    # sensor that stopped updating. Runs of at least suspect samples are
+    # SUSPECT.
+    def __init__(self, variable, length, suspect=None, tolerance=0):
+        if length < 2:
+            raise ValueError('length must be at least 2')
+        if suspect is not None and not 2 <= suspect <= length:
+            raise ValueError('suspect must be between 2 and length')
+        self.variable = variable
+        self.length = length
+        self.suspect = suspect
+        self.tolerance = tolerance
+
+    def flags(self, batch):
+        values = batch.variable_values(self.variable)
+        same = np.zeros(len(values), dtype=bool)
+        same[1:] = np.abs(np.diff(values)) <= self.tolerance
+        same[1:][_profile_breaks(batch, len(values))] = False
+        # number the runs of equal values, and count the samples of each
+        run = np.cumsum(~same) - 1
+        lengths = np.bincount(run)[run] if len(run) else run
+        flags = np.full(len(values), GOOD, dtype=np.int8)
+        if self.suspect is not None:
+            flags[lengths >= self.suspect] = SUSPECT
+        flags[lengths >= self.length] = BAD
+        return {self.variable: flags}
+
+
+class DuplicateLevelCheck(Check):
+    # Flags as BAD the pressure of every sample at the same pressure (to
+    # within tolerance dbar) as the previous sample of its profile, and so
+    # all its values (see run_checks).
+    def __init__(self, tolerance=0):
+        self.tolerance = tolerance
+
+    def flags(self, batch):
+        pressure = batch.variable_values('pressure')
+        duplicate = np.zeros(len(pressure), dtype=bool)
+        duplicate[1:] = np.abs(np.diff(pressure)) <= self.tolerance
+        duplicate[1:][_profile_breaks(batch, len(pressure))] = False
+        flags = np.full(len(pressure), GOOD, dtype=np.int8)
+        flags[duplicate] = BAD
+        return {'pressure': flags}
+
+
+def default_checks():
+    # The Argo real time tests that apply to ITP profiles, with the Argo
+    # global ranges and the spike and gradient thresholds of the upper
+    # 500 dbar
+    return [
+        RangeCheck('pressure', minimum=-5),
+        RangeCheck('temperature', -2.5, 40),
+        RangeCheck('salinity', 2, 41),
+        DuplicateLevelCheck(),
+        SpikeCheck('temperature', 6.0),
+        SpikeCheck('salinity', 0.9),
+        GradientCheck('temperature', 9.0),
+        GradientCheck('salinity', 1.5),
+        DensityInversionCheck(0.03),
+    ]
+
+
+def run_checks(batch, checks):
+    # Runs the checks on a batch, and returns the flags of each measured
+    # variable: the worst flag any check gave, or MISSING where the value
+    # is missing. Flags of a derived variable (e.g. a RangeCheck of
+    # density) apply to temperature and salinity, and SUSPECT or BAD
+    # pressures to every variable of the sample.
+    flags = {}
+    for variable, values in batch.values.items():
+        flags[variable] = np.where(
+            np.isnan(values), MISSING, GOOD).astype(np.int8)
+    for check in checks:
+        for variable, check_flags in check.flags(batch).items():
+            if variable in flags:
+                targets = [variable]
+            else:
+                targets = ['temperature', 'salinity']
+            for target in targets:
+                np.maximum(flags[target], check_flags, out=flags[target])
+    pressure = flags.get('pressure')
+    if pressure is not None:
+        pressure = np.where(pressure == MISSING, GOOD, pressure)
+        for variable in flags:
+            if variable != 'pressure':
+                flags[variable] = np.where(
+                    flags[variable] == MISSING, MISSING,
+                    np.maximum(flags[variable], pressure)).astype(np.int8)
+    return flags
+
+
+def apply_flags(batch, flags, action='mask', level=BAD):
+    # A new batch without the values flagged level or worse (MISSING
+    # aside). With action 'mask' they are replaced by NaN; with 'drop'
+    # every sample with a flagged value is removed, and then every profile
+    # left without samples.
+    if action not in ACTIONS:
+        raise ValueError("action must be 'mask' or 'drop'")
+    if level not in (SUSPECT, BAD):
+        raise ValueError('level must be SUSPECT or BAD')
+    flagged = {
+        variable: (variable_flags >= level) & (variable_flags != MISSING)
+        for variable, variable_flags in flags.items()
+    }
+    if action == 'mask':
+        values = dict(batch.values)
+        for variable, mask in flagged.items():
+            if mask.any():
+                values[variable] = np.where(mask, np.nan, values[variable])
+        return ProfileBatch(
+            batch.metadata, batch.offsets, values, batch.ctd_loader)
+
+    keep = np.ones(batch.offsets[-1], dtype=bool)
+    for mask in flagged.values():
+        keep &= ~mask
+    if keep.all():
+        return batch
+    sizes = np.bincount(batch.profile_index()[keep], minlength=len(batch))
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    values = {k: v[keep] for k, v in batch.values.items()}
+    batch = ProfileBatch(batch.metadata, offsets, values, batch.ctd_loader)
+    if (sizes > 0).all():
+        return batch
+    return batch.take(sizes > 0)
+
+
+def quality_control(batch, checks, action='mask', level=BAD):
+    # runs the checks and masks or drops the flagged values
+    return apply_flags(batch, run_checks(batch, checks), action, level)
+
+
+def _threshold(threshold, suspect):
+    if threshold < 0:
+        raise ValueError('threshold must not be negative')
+    if suspect is not None and not 0 <= suspect <= threshold:
+        raise ValueError('suspect must be between 0 and threshold')
+    return threshold
+
+
+def _grade(values, threshold, suspect):
+    # BAD above threshold, SUSPECT above suspect. NaN is GOOD, as it is
+    # where the test could not be evaluated.
+    flags = np.full(len(values), GOOD, dtype=np.int8)
+    if suspect is not None:
+        flags[values > suspect] = SUSPECT
+    flags[values > threshold] = BAD
+    return flags
+
+
+def _outside(values, minimum, maximum):
+    outside = np.zeros(len(values), dtype=bool)
+    if minimum is not None:
+        outside |= values < minimum
+    if maximum is not None:
+        outside |= values > maximum
+    return outside
+
+
+def _neighbours(batch, values):
+    # the previous and the next sample of every sample, NaN at the ends of
+    # its profile
+    previous = np.full(len(values), np.nan)
+    following = np.full(len(values), np.nan)
+    previous[1:] = values[:-1]
+    following[:-1] = values[1:]
+    breaks = _profile_breaks(batch, len(values))
+    previous[1:][breaks] = np.nan
+    following[:-1][breaks] = np.nan
+    return previous, following
+
+
+def _profile_breaks(batch, n_samples):
+    # a mask of the n_samples - 1 pairs of consecutive samples (i, i + 1)
+    # that belong to different profiles
+    breaks = np.zeros(max(n_samples - 1, 0), dtype=bool)
+    starts = batch.offsets[1:-1]
+    starts = starts[(starts > 0) & (starts < n_samples)]
+    breaks[starts - 1] = True
+    return breaks
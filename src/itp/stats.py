@@ -0,0 +1,344 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from itp.database import ItpDatabase
+from itp.itp_query import ItpQuery, CHUNK_SIZE
+
+
+class BinnedStatistics:
+    # Count, mean, variance, minimum and maximum of variables in bins of
+    # latitude, longitude, pressure and month, accumulated one batch at a
+    # time so any amount of data takes one pass and a fixed amount of
+    # memory. Bins are [edge[i], edge[i + 1]); samples outside the edges
+    # and missing values are skipped. Months are calendar months of the
+    # profile time (one bin if by_month is False).
+    #
+    # The mean and variance are kept as Welford's running mean and sum of
+    # squared differences, combined with Chan's formula, so the statistics
+    # of separate batches, processes or runs can be merged exactly.
+    #
+    # Percentiles need a histogram of each variable in every bin, given as
+    # histogram_edges {variable: edges}. They are estimated by linear
+    # interpolation within the histogram, so their resolution is that of
+    # the edges; values outside the edges count in the first or last
+    # histogram bin. Each variable with a histogram takes
+    # 8 * (len(edges) - 1) bytes per bin.
+    def __init__(self, latitude_edges, longitude_edges, pressure_edges,
+                 variables=('temperature', 'salinity'), by_month=True,
+                 histogram_edges=None):
+        self.latitude_edges = _edges(latitude_edges, 'latitude_edges')
+        self.longitude_edges = _edges(longitude_edges, 'longitude_edges')
+        self.pressure_edges = _edges(pressure_edges, 'pressure_edges')
+        self.variables = list(variables)
+        self.by_month = by_month
+        self.histogram_edges = {
+            name: _edges(edges, 'histogram_edges')
+            for name, edges in (histogram_edges or {}).items()
+        }
+        for name in self.histogram_edges:
+            if name not in self.variables:
+                raise ValueError('{} is not one of the variables'.format(name))
+        self.shape = (
+            len(self.latitude_edges) - 1,
+            len(self.longitude_edges) - 1,
+            len(self.pressure_edges) - 1,
+            12 if by_month else 1,
+        )
+        n_bins = int(np.prod(self.shape))
+        self._count = {v: np.zeros(n_bins, dtype=np.int64)
+                       for v in self.variables}
+        self._mean = {v: np.zeros(n_bins) for v in self.variables}
+        self._m2 = {v: np.zeros(n_bins) for v in self.variables}
+        self._min = {v: np.full(n_bins, np.inf) for v in self.variables}
+        self._max = {v: np.full(n_bins, -np.inf) for v in self.variables}
+        self._histogram = {
+            v: np.zeros((n_bins, len(edges) - 1), dtype=np.int64)
+            for v, edges in self.histogram_edges.items()
+        }
+
+    def add(self, batch):
+        # adds the samples of a ProfileBatch. variables may also name
+        # derived value methods (e.g. 'potential_temperature').
+        bins = self._bins(batch)
+        for variable in self.variables:
+            values = batch.variable_values(variable)
+            valid = (bins >= 0) & ~np.isnan(values)
+            if valid.any():
+                self._add(variable, bins[valid], values[valid])
+        return self
+
+    def merge(self, other):
+        # adds the statistics of another BinnedStatistics with the same bins
+        if (other.shape != self.shape
+                or other.variables != self.variables
+                or set(other.histogram_edges) != set(self.histogram_edges)
+                or not _same_edges(self, other)):
+            raise ValueError('the statistics have different bins')
+        for variable in self.variables:
+            used = np.flatnonzero(other._count[variable])
+            self._combine(
+                variable, used, other._count[variable][used],
+                other._mean[variable][used], other._m2[variable][used],
+                other._min[variable][used], other._max[variable][used])
+            if variable in self._histogram:
+                self._histogram[variable] += other._histogram[variable]
+        return self
+
+    def count(self, variable):
+        return self._result(self._count, variable)
+
+    def mean(self, variable):
+        return self._masked(self._mean, variable)
+
+    def variance(self, variable, ddof=1):
+        count = self._count[self._check(variable)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self._m2[variable] / (count - ddof)
+        variance[count <= ddof] = np.nan
+        return variance.reshape(self.shape)
+
+    def std(self, variable, ddof=1):
+        return np.sqrt(self.variance(variable, ddof))
+
+    def minimum(self, variable):
+        return self._masked(self._min, variable)
+
+    def maximum(self, variable):
+        return self._masked(self._max, variable)
+
+    def percentile(self, variable, q):
+        # the q-th percentile (0-100) of every bin, from the histogram
+        if variable not in self._histogram:
+            raise ValueError('no histogram_edges for {}'.format(variable))
+        if not 0 <= q <= 100:
+            raise ValueError('q must be between 0 and 100')
+        edges = self.histogram_edges[variable]
+        histogram = self._histogram[variable]
+        cumulative = histogram.cumsum(axis=1)
+        total = cumulative[:, -1]
+        target = q / 100.0 * total
+        # the histogram bin holding the target rank, and the fraction of
+        # its samples below it
+        index = (cumulative < target[:, None]).sum(axis=1)
+        index = np.minimum(index, histogram.shape[1] - 1)
+        rows = np.arange(len(histogram))
+        below = cumulative[rows, index] - histogram[rows, index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = (target - below) / histogram[rows, index]
+        fraction = np.clip(np.nan_to_num(fraction), 0, 1)
+        result = edges[index] + fraction * (edges[index + 1] - edges[index])
+        result[total == 0] = np.nan
+        return result.reshape(self.shape)
+
+    def save(self, file):
+        # writes the accumulators to an .npz file, to be merged later
+        arrays = {
+            'latitude_edges': self.latitude_edges,
+            'longitude_edges': self.longitude_edges,
+            'pressure_edges': self.pressure_edges,
+            'by_month': np.array(self.by_month),
+            'variables': np.array(self.variables, dtype=str),
+        }
+        for variable in self.variables:
+            arrays['count.' + variable] = self._count[variable]
+            arrays['mean.' + variable] = self._mean[variable]
+            arrays['m2.' + variable] = self._m2[variable]
+            arrays['min.' + variable] = self._min[variable]
+            arrays['max.' + variable] = self._max[variable]
+        for variable, edges in self.histogram_edges.items():
+            arrays['histogram_edges.' + variable] = edges
+            arrays['histogram.' + variable] = self._histogram[variable]
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as arrays:
+            variables = arrays['variables'].tolist()
+            histogram_edges = {
+                name.partition('.')[2]: arrays[name]
+                for name in arrays.files
+                if name.startswith('histogram_edges.')
+            }
+            stats = cls(
+                arrays['latitude_edges'], arrays['longitude_edges'],
+                arrays['pressure_edges'], variables,
+                bool(arrays['by_month']), histogram_edges)
+            for variable in variables:
+                stats._count[variable] = arrays['count.' + variable]
+                stats._mean[variable] = arrays['mean.' + variable]
+                stats._m2[variable] = arrays['m2.' + variable]
+                stats._min[variable] = arrays['min.' + variable]
+                stats._max[variable] = arrays['max.' + variable]
+            for variable in histogram_edges:
+                stats._histogram[variable] = arrays['histogram.' + variable]
+        return stats
+
+    def _bins(self, batch):
+        # the flat bin index of every sample, -1 outside the grid
+        sizes = batch.sizes()
+        index = np.zeros(int(sizes.sum()), dtype=np.int64)
+        inside = np.ones(len(index), dtype=bool)
+        # metadata are binned once per profile
+        profile_axes = [
+            (batch.metadata['latitude'], self.latitude_edges),
+            (batch.metadata['longitude'], self.longitude_edges),
+        ]
+        for axis, (values, edges) in enumerate(profile_axes):
+            bins = np.repeat(_digitize(values, edges), sizes)
+            inside &= bins >= 0
+            index += bins * int(np.prod(self.shape[axis + 1:]))
+        bins = _digitize(batch.values['pressure'], self.pressure_edges)
+        inside &= bins >= 0
+        index += bins * self.shape[3]
+        if self.by_month:
+            months = batch.metadata['date_time'].astype('datetime64[M]')
+            months = months.astype(np.int64) % 12
+            index += np.repeat(months, sizes)
+        return np.where(inside, index, -1)
+
+    def _add(self, variable, bins, values):
+        # the statistics of this chunk per bin, computed by sorting the
+        # samples by bin, then merged into the totals
+        order = np.argsort(bins, kind='stable')
+        bins, values = bins[order], values[order]
+        starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+        used = bins[starts]
+        count = np.diff(np.concatenate([starts, [len(bins)]]))
+        mean = np.add.reduceat(values, starts) / count
+        deviation = values - np.repeat(mean, count)
+        m2 = np.add.reduceat(deviation * deviation, starts)
+        self._combine(
+            variable, used, count, mean, m2,
+            np.minimum.reduceat(values, starts),
+            np.maximum.reduceat(values, starts))
+        if variable in self._histogram:
+            edges = self.histogram_edges[variable]
+            n_columns = len(edges) - 1
+            column = np.clip(
+                np.searchsorted(edges, values, side='right') - 1,
+                0, n_columns - 1)
+            cells = np.repeat(np.arange(len(used)), count) * n_columns + column
+            counts = np.bincount(cells, minlength=len(used) * n_columns)
+            self._histogram[variable][used] += counts.reshape(-1, n_columns)
+
+    def _combine(self, variable, used, count, mean, m2, minimum, maximum):
+        # Chan et al.'s parallel update of count, mean and M2
+        count_a = self._count[variable][used]
+        mean_a = self._mean[variable][used]
+        total = count_a + count
+        delta = mean - mean_a
+        self._mean[variable][used] = mean_a + delta * count / total
+        self._m2[variable][used] += m2 + delta ** 2 * count_a * count / total
+        self._count[variable][used] = total
+        self._min[variable][used] = np.minimum(
+            self._min[variable][used], minimum)
+        self._max[variable][used] = np.maximum(
+            self._max[variable][used], maximum)
+
+    def _check(self, variable):
+        if variable not in self._count:
+            raise ValueError('Unknown variable {}'.format(variable))
+        return variable
+
+    def _result(self, accumulators, variable):
+        return accumulators[self._check(variable)].reshape(self.shape)
+
+    def _masked(self, accumulators, variable):
+        # NaN in the bins without samples
+        result = accumulators[self._check(variable)].astype(float)
+        result[self._count[variable] == 0] = np.nan
+        return result.reshape(self.shape)
+
+
+def climatology(query, latitude_edges, longitude_edges, pressure_edges,
+                variables=('temperature', 'salinity'), by_month=True,
+                histogram_edges=None, chunk_size=CHUNK_SIZE, workers=None):
+    # Accumulates the BinnedStatistics of every profile an ItpQuery
+    # returns, streaming them chunk_size profiles at a time (see
+    # iter_batches), so the max_results limit does not apply. With
+    # workers > 1, the systems are divided between that many processes,
+    # whose statistics are merged. Each runs the query with the same
+    # quality control, archive and ItpDatabase settings.
+    def empty():
+        return BinnedStatistics(
+            latitude_edges, longitude_edges, pressure_edges, variables,
+            by_month, histogram_edges)
+
+    if workers is not None and (type(workers) is not int or workers < 1):
+        raise ValueError('workers must be a positive integer')
+    if workers is None or workers == 1:
+        stats = empty()
+        for batch in query.iter_batches(chunk_size):
+            stats.add(batch)
+        return stats
+
+    systems = np.unique(
+        query.fetch_batch(metadata_only=True).metadata['system_number'])
+    database = None
+    if query.database is not None:
+        database = {
+            'immutable': query.database.immutable,
+            'cache_size_kib': query.database.cache_size_kib,
+            'mmap_size': query.database.mmap_size,
+            'timeout': query.database.timeout,
+        }
+    groups = [g.tolist() for g in np.array_split(systems, workers) if len(g)]
+    stats = empty()
+    if not groups:
+        return stats
+    with ProcessPoolExecutor(len(groups)) as executor:
+        futures = [
+            executor.submit(
+                _climatology_partition, query.db_path,
+                dict(query.args, system=group), query._use_archive,
+                query._qc, database, empty(), chunk_size)
+            for group in groups
+        ]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+
+def _climatology_partition(db_path, args, use_archive, qc, database, stats,
+                           chunk_size):
+    # runs in a worker process of climatology. database is the settings of
+    # the ItpDatabase of the query, if it has one, which can't be pickled.
+    if database is not None:
+        db_path = ItpDatabase(db_path, pool_size=1, **database)
+    try:
+        query = ItpQuery(db_path, **args)
+        query.set_use_archive(use_archive)
+        if qc is not None:
+            query.set_qc(*qc)
+        for batch in query.iter_batches(chunk_size):
+            stats.add(batch)
+    finally:
+        if database is not None:
+            db_path.close()
+    return stats
+
+
+def _edges(edges, name):
+    edges = np.asarray(edges, dtype=float)
+    if edges.ndim != 1 or edges.size < 2 or np.any(np.diff(edges) <= 0):
+        raise ValueError('{} must contain increasing values'.format(name))
+    return edges
+
+
+def _same_edges(a, b):
+    pairs = [
+        (a.latitude_edges, b.latitude_edges),
+        (a.longitude_edges, b.longitude_edges),
+        (a.pressure_edges, b.pressure_edges),
+    ]
+    pairs += [(a.histogram_edges[v], b.histogram_edges[v])
+              for v in a.histogram_edges]
+    return a.by_month == b.by_month and all(
+        np.array_equal(x, y) for x, y in pairs)
+
+
+def _digitize(values, edges):
+    # the bin of each value, -1 outside the edges or missing
+    values = np.asarray(values, dtype=float)
+    bins = np.searchsorted(edges, values, side='right') - 1
+    outside = (bins < 0) | (bins >= len(edges) - 1) | np.isnan(values)
+    return np.where(outside, -1, bins)
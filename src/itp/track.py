@@ -0,0 +1,234 @@
+import sqlite3
+import numpy as np
+from contextlib import closing
+from itp.itp_query import ItpQuery
+
+
+# table of precomputed drift values, written by build_track_table
+TRACK_TABLE = 'profile_tracks'
+# the drift values of every profile, in the order of the table columns
+TRACK_COLUMNS = ['distance', 'cumulative_distance', 'speed', 'heading']
+
+# WGS-84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+SEMI_MINOR_AXIS = (1 - FLATTENING) * SEMI_MAJOR_AXIS
+
+# Vincenty's iteration converges to this (radians, ~0.006 mm) within a
+# few steps for the short legs between profiles
+TOLERANCE = 1e-12
+MAX_ITERATIONS = 200
+
+
+def geodesic(lat1, lon1, lat2, lon2):
+    # Distance (km) and initial heading (degrees clockwise from north)
+    # along the WGS-84 ellipsoid from each point 1 to the matching point 2,
+    # for whole arrays at once. This is Vincenty's inverse solution, the
+    # same to within millimeters as geopy.distance. The heading is NaN
+    # between identical points. The iteration does not converge for nearly
+    # antipodal points; those fall back to a great circle.
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *[np.radians(np.asarray(x, dtype=float))
+          for x in (lat1, lon1, lat2, lon2)])
+    f = FLATTENING
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    difference = lon2 - lon1
+    lam = difference
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        converged = np.zeros(lam.shape, dtype=bool)
+        for _ in range(MAX_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cos_u2 * sin_lam,
+                cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            # identical points have sin_sigma == 0
+            sin_alpha = np.where(
+                sin_sigma == 0, 0,
+                cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # points on the equator have cos2_alpha == 0
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0,
+                cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            previous = lam
+            lam = difference + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (
+                    cos_2sigma_m + c * cos_sigma
+                    * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - previous) <= TOLERANCE
+            if converged.all():
+                break
+
+        u_squared = cos2_alpha * (SEMI_MAJOR_AXIS ** 2
+                                  - SEMI_MINOR_AXIS ** 2) / SEMI_MINOR_AXIS ** 2
+        a = 1 + u_squared / 16384 * (
+            4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+        b = u_squared / 1024 * (
+            256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+        delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2)
+            * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = SEMI_MINOR_AXIS * a * (sigma - delta_sigma) / 1000
+        heading = np.degrees(np.arctan2(
+            cos_u2 * np.sin(lam),
+            cos_u1 * sin_u2 - sin_u1 * cos_u2 * np.cos(lam))) % 360
+
+    heading = np.where(distance == 0, np.nan, heading)
+    failed = ~converged & ~np.isnan(lam)
+    if failed.any():
+        distance = np.where(failed, _great_circle(
+            lat1, lon1, lat2, lon2), distance)
+    return distance, heading
+
+
+def _great_circle(lat1, lon1, lat2, lon2):
+    # haversine distance (km) on the sphere of the WGS-84 mean radius
+    radius = (2 * SEMI_MAJOR_AXIS + SEMI_MINOR_AXIS) / 3 / 1000
+    h = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def drift(batch):
+    # The drift of every profile of a batch (metadata only is enough),
+    # computed for all systems at once, as {name: array} in the order of
+    # the batch:
+    #   distance: km from the previous profile of the same system
+    #   cumulative_distance: km drifted since the first profile of the
+    #       system in the batch
+    #   speed: m/s from the previous profile
+    #   heading: degrees clockwise from north, from the previous profile
+    # The first profile of each system has a distance of 0 and no speed
+    # or heading (NaN). Profiles without a position are NaN throughout and
+    # are skipped, so the next leg starts at the last known position.
+    n_profiles = len(batch)
+    result = {
+        'distance': np.full(n_profiles, np.nan),
+        'cumulative_distance': np.full(n_profiles, np.nan),
+        'speed': np.full(n_profiles, np.nan),
+        'heading': np.full(n_profiles, np.nan),
+    }
+    latitude = np.asarray(batch.metadata['latitude'], dtype=float)
+    longitude = np.asarray(batch.metadata['longitude'], dtype=float)
+    system = np.asarray(batch.metadata['system_number'])
+    date_time = np.asarray(batch.metadata['date_time'], dtype='datetime64[s]')
+    known = np.flatnonzero(~np.isnan(latitude) & ~np.isnan(longitude))
+    if len(known) == 0:
+        return result
+
+    # chronological within each system
+    order = known[np.lexsort((date_time[known], system[known]))]
+    latitude, longitude = latitude[order], longitude[order]
+    system, date_time = system[order], date_time[order]
+    first = np.concatenate([[True], system[1:] != system[:-1]])
+
+    distance = np.zeros(len(order))
+    heading = np.full(len(order), np.nan)
+    distance[1:], heading[1:] = geodesic(
+        latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    distance[first] = 0
+    heading[first] = np.nan
+    seconds = np.zeros(len(order))
+    seconds[1:] = (date_time[1:] - date_time[:-1]).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        speed = np.where(seconds > 0, distance * 1000 / seconds, np.nan)
+    speed[first] = np.nan
+
+    # the running total, restarted at the first profile of each system
+    total = np.cumsum(distance)
+    starts = np.flatnonzero(first)
+    lengths = np.diff(np.concatenate([starts, [len(order)]]))
+    cumulative = total - np.repeat(total[starts], lengths)
+
+    result['distance'][order] = distance
+    result['cumulative_distance'][order] = cumulative
+    result['speed'][order] = speed
+    result['heading'][order] = heading
+    return result
+
+
+def drift_tracks(db_path, systems=None):
+    # The drift tracks of every system, or of a list of system numbers, in
+    # one call. Returns a metadata only ProfileBatch (see
+    # ItpQuery.fetch_batch) with the drift() columns added to its
+    # metadata. db_path may also be an ItpDatabase. The values are read
+    # from the table written by build_track_table when it is up to date,
+    # and computed otherwise.
+    query = ItpQuery(db_path) if systems is None \
+        else ItpQuery(db_path, system=list(systems))
+    query.set_max_results(None)
+    batch = query.fetch_batch(metadata_only=True)
+    with query._connect() as connection:
+        columns = _read_track_table(
+            connection.cursor(), batch.metadata['_id'])
+    if columns is None:
+        columns = drift(batch)
+    batch.metadata.update(columns)
+    return batch
+
+
+def _read_track_table(cursor, profile_ids):
+    # the stored columns for profile_ids, or None if the table is missing
+    # or does not cover every profile
+    sql = "SELECT count(*) FROM sqlite_master WHERE type == 'table' " \
+        'AND name == ?'
+    if cursor.execute(sql, [TRACK_TABLE]).fetchone()[0] == 0:
+        return None
+    sql = 'SELECT profile_id, {} FROM {} ORDER BY profile_id'.format(
+        ', '.join(TRACK_COLUMNS), TRACK_TABLE)
+    rows = cursor.execute(sql).fetchall()
+    if not rows:
+        return None if len(profile_ids) else _empty_columns()
+    stored = np.array(rows, dtype=np.float64)
+    stored_ids = stored[:, 0].astype(np.int64)
+    position = np.searchsorted(stored_ids, profile_ids)
+    position = np.clip(position, 0, len(stored_ids) - 1)
+    if not np.array_equal(stored_ids[position], profile_ids):
+        return None
+    return {
+        name: stored[position, i + 1]
+        for i, name in enumerate(TRACK_COLUMNS)
+    }
+
+
+def _empty_columns():
+    return {name: np.zeros(0) for name in TRACK_COLUMNS}
+
+
+def build_track_table(db_path):
+    # (Re)writes the drift of every profile to the profile_tracks table,
+    # which drift_tracks then reads instead of computing. It is ignored
+    # once profiles are added, until it is built again. Returns the number
+    # of profiles written.
+    query = ItpQuery(db_path)
+    query.set_max_results(None)
+    query.set_use_archive(False)
+    batch = query.fetch_batch(metadata_only=True)
+    columns = drift(batch)
+    ids = batch.metadata['_id'].tolist()
+    rows = zip(ids, *[columns[name].tolist() for name in TRACK_COLUMNS])
+    # SQLite stores NaN as NULL, which reads back as None
+    rows = [[None if x != x else x for x in row] for row in rows]
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(TRACK_TABLE))
+        connection.execute(
+            'CREATE TABLE {} (profile_id INTEGER PRIMARY KEY, {})'.format(
+                TRACK_TABLE, ', '.join(c + ' REAL' for c in TRACK_COLUMNS)))
+        connection.executemany(
+            'INSERT INTO {} VALUES (?, ?, ?, ?, ?)'.format(TRACK_TABLE), rows)
+        connection.commit()
+    return len(rows)
+
+
+def drop_track_table(db_path):
+    with closing(sqlite3.connect(str(db_path))) as connection:
+        connection.execute('DROP TABLE IF EXISTS {}'.format(TRACK_TABLE))
+        connection.commit()
@@ -0,0 +1,135 @@
+import shutil
+import sqlite3
+import pytest
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from itp import maintenance
+from itp.archive import Archive, archive_path, open_archive
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture(scope='module')
+def db_path(tmp_path_factory):
+    # work on a copy so the test database is never modified
+    path = tmp_path_factory.mktemp('archive') / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    maintenance.build_archive(path)
+    return path
+
+
+def _both(db_path, args):
+    archived = ItpQuery(db_path, **args)
+    sql = ItpQuery(db_path, **args)
+    sql.set_use_archive(False)
+    return archived, sql
+
+
+def test_archive_files(db_path):
+    archive = Archive(archive_path(db_path))
+    assert len(archive) == 60
+    assert archive.offsets[-1] == archive.values['pressure'].size
+    assert 'vert' in archive.manifest['variables']
+
+
+@pytest.mark.parametrize('args', [
+    {},
+    {'system': [1, 100]},
+    {'system': [100], 'pressure': [10, 20]},
+    {'pressure': [0, 100], 'extra_variables': ['vert', 'dissolved_oxygen']},
+    {'latitude': [78, 80], 'longitude': [-149, -140]},
+    {'date_time': [datetime(2005, 8, 16, 6), datetime(2010, 1, 1)]},
+    {'radius': [78, -145, 150]},
+    {'system': [999]},
+])
+def test_archive_matches_sqlite(db_path, args):
+    archived, sql = _both(db_path, args)
+    expected = sql.fetch()
+    results = archived.fetch()
+    assert len(results) == len(expected)
+    for a, b in zip(results, expected):
+        assert a._id == b._id
+        assert a.date_time == b.date_time
+        assert a.source == b.source
+        assert np.array_equal(a.pressure, b.pressure, equal_nan=True)
+        assert np.array_equal(a.salinity, b.salinity, equal_nan=True)
+        for variable in args.get('extra_variables', []):
+            assert np.array_equal(
+                getattr(a, variable), getattr(b, variable), equal_nan=True)
+
+
+def test_archive_metadata_only(db_path):
+    archived, sql = _both(db_path, {'system': [100], 'pressure': [10, 20]})
+    results = archived.fetch(metadata_only=True)
+    expected = sql.fetch(metadata_only=True)
+    assert [p._id for p in results] == [p._id for p in expected]
+    assert results[2].pressure == pytest.approx(expected[2].pressure)
+
+
+def test_archive_iter_batches(db_path):
+    archived, sql = _both(db_path, {'pressure': [10, 20]})
+    batches = list(archived.iter_batches(chunk_size=7))
+    assert max(len(b) for b in batches) == 7
+    expected = sql.fetch_batch()
+    assert np.concatenate([b.pressure for b in batches]) == \
+        pytest.approx(expected.pressure)
+
+
+def test_archive_zero_copy(db_path):
+    # a contiguous run of profiles is a view of the memory mapped file
+    batch = ItpQuery(db_path, system=[1]).fetch_batch()
+    base = batch.pressure
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert base is not None
+    assert not batch.pressure.flags.writeable
+
+
+@pytest.mark.parametrize('systems', [[1], [1, 3]])
+def test_archive_writable_profiles(db_path, systems):
+    # contiguous and scattered selections behave the same: batches are
+    # read only, profiles can be modified as those from SQLite
+    query = ItpQuery(db_path, system=systems)
+    assert not query.fetch_batch().temperature.flags.writeable
+    for profiles in (query.fetch(), query.fetch(metadata_only=True)):
+        profile = profiles[0]
+        profile.temperature[0] = 100
+        assert profile.temperature[0] == 100
+    assert query.fetch()[0].temperature[0] != 100
+
+
+def test_archive_max_results(db_path):
+    query = ItpQuery(db_path)
+    query.set_max_results(10)
+    with pytest.raises(RuntimeError):
+        query.fetch()
+
+
+def test_archive_unknown_variable(db_path):
+    query = ItpQuery(db_path, extra_variables=['chipmunk'])
+    with pytest.raises(ValueError):
+        query.fetch()
+
+
+def test_stale_archive_is_ignored(tmp_path):
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    maintenance.build_archive(path)
+    with sqlite3.connect(str(path)) as connection:
+        assert open_archive(path, connection.cursor()) is not None
+        connection.execute('DELETE FROM profiles WHERE id == 1')
+        connection.commit()
+        assert open_archive(path, connection.cursor()) is None
+    assert len(ItpQuery(path).fetch()) == 59
+
+
+@pytest.mark.parametrize('method', ['nearest', 'interp'])
+def test_archive_fetch_level(db_path, method):
+    archived, sql = _both(db_path, {'extra_variables': ['vert']})
+    results = archived.fetch_level(20, method=method, window=1)
+    expected = sql.fetch_level(20, method=method, window=1)
+    assert results.metadata['_id'].tolist() == expected.metadata['_id'].tolist()
+    for variable in expected.variables():
+        assert np.array_equal(
+            results.values[variable], expected.values[variable],
+            equal_nan=True)
@@ -0,0 +1,41 @@
+import argparse
+import pytest
+from datetime import datetime
+from itp.arguments import add_filter_arguments, filters_from_arguments
+
+
+def parse(argv):
+    parser = argparse.ArgumentParser()
+    add_filter_arguments(parser)
+    return filters_from_arguments(parser.parse_args(argv))
+
+
+def test_filters():
+    filters = parse([
+        '--system', '1', '2', '--latitude', '70', '80',
+        '--longitude', '170', '-170',
+        '--date-time', '2010-01-01', '2010-06-30T12:00:00',
+        '--pressure', '0', '100', '--radius', '78', '-150', '200',
+        '--extra-variables', 'dissolved_oxygen'])
+    assert filters == {
+        'system': [1, 2],
+        'latitude': [70.0, 80.0],
+        'longitude': [170.0, -170.0],
+        'date_time': [datetime(2010, 1, 1), datetime(2010, 6, 30, 12)],
+        'pressure': [0.0, 100.0],
+        'radius': [78.0, -150.0, 200.0],
+        'extra_variables': ['dissolved_oxygen'],
+    }
+    assert parse([]) == {}
+
+
+def test_polygon():
+    filters = parse(['--polygon', '70', '-150', '80', '-150', '75', '-140'])
+    assert filters['polygon'] == [[70, -150], [80, -150], [75, -140]]
+    with pytest.raises(ValueError):
+        parse(['--polygon', '70', '-150', '80'])
+
+
+def test_invalid_date():
+    with pytest.raises(SystemExit):
+        parse(['--date-time', '2010-13-01', '2011-01-01'])
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import pytest
+from pathlib import Path
+from itp.async_query import AsyncItpQuery, QueryExecutor
+from itp.database import ItpDatabase
+from itp.itp_query import ItpQuery
+from itp.pool import ConnectionPool
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def executor():
+    executor = QueryExecutor(max_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+def test_fetch(executor):
+    query = AsyncItpQuery(DB_PATH, pressure=[0, 100], extra_variables=['vert'])
+    query.set_executor(executor)
+    profiles = run(query.fetch())
+    expected = ItpQuery(
+        DB_PATH, pressure=[0, 100], extra_variables=['vert']).fetch()
+    assert len(profiles) == len(expected) == 10
+    for a, b in zip(profiles, expected):
+        assert a._id == b._id
+        assert a.vert == pytest.approx(b.vert, nan_ok=True)
+
+
+def test_fetch_batch_metadata_only(executor):
+    query = AsyncItpQuery(DB_PATH, system=[1])
+    query.set_executor(executor)
+    batch = run(query.fetch_batch(metadata_only=True))
+    assert len(batch) == 10
+
+
+def test_fetch_level(executor):
+    query = AsyncItpQuery(DB_PATH, system=[1, 2])
+    query.set_executor(executor)
+    batch = run(query.fetch_level(100, method='interp'))
+    expected = ItpQuery(DB_PATH, system=[1, 2]).fetch_level(
+        100, method='interp')
+    assert len(batch) == len(expected) == 20
+    assert batch.temperature == pytest.approx(
+        expected.temperature, nan_ok=True)
+    with pytest.raises(ValueError):
+        run(query.fetch_level(100, method='cubic'))
+
+
+def test_concurrent_fetches(executor):
+    async def fetch_all():
+        queries = []
+        for system in [1, 2, 3, 4, 100, 104, 1, 2]:
+            query = AsyncItpQuery(DB_PATH, system=[system])
+            query.set_executor(executor)
+            queries.append(query.fetch())
+        return await asyncio.gather(*queries)
+    results = run(fetch_all())
+    assert [len(r) for r in results] == [10, 10, 10, 10, 10, 10, 10, 10]
+    # no more connections than workers were opened
+    assert executor.pool(DB_PATH)._opened <= 2
+
+
+def test_iter_profiles(executor):
+    async def collect():
+        query = AsyncItpQuery(DB_PATH, system=[1, 2])
+        query.set_executor(executor)
+        return [p.system_number async for p in query.iter_profiles(3)]
+    assert run(collect()) == [1] * 10 + [2] * 10
+
+
+def test_iter_batches_closed_early(executor):
+    async def first():
+        query = AsyncItpQuery(DB_PATH)
+        query.set_executor(executor)
+        batches = query.iter_batches(5)
+        async for batch in batches:
+            await batches.aclose()
+            return len(batch)
+    assert run(first()) == 5
+
+
+def test_fetch_is_profiled(executor):
+    stats = []
+    query = AsyncItpQuery(DB_PATH, system=[1])
+    query.set_executor(executor)
+    query.set_profiler(stats.append)
+    assert len(run(query.fetch())) == 10
+    assert [s.search for s in stats] == ['fetch']
+    assert stats[0].profiles == 10
+    assert 'profiles' in stats[0].stages
+
+
+def test_concurrent_searches_are_profiled_apart(executor):
+    # each callback waits for the other, so the searches overlap
+    stats = []
+    barrier = threading.Barrier(2, timeout=10)
+
+    def callback(search_stats):
+        stats.append(search_stats)
+        barrier.wait()
+
+    async def search(query):
+        return await asyncio.gather(query.fetch(), query.fetch_batch())
+
+    query = AsyncItpQuery(DB_PATH, system=[1])
+    query.set_executor(executor)
+    query.set_profiler(callback)
+    profiles, batch = run(search(query))
+    assert len(profiles) == len(batch) == 10
+    assert sorted(s.search for s in stats) == ['fetch', 'fetch_batch']
+    assert [s.profiles for s in stats] == [10, 10]
+    assert all(s.statements for s in stats)
+
+
+def test_iteration_connection_settings(executor):
+    # an iteration opens its connection like the pooled ones
+    async def collect(query):
+        query.set_executor(executor)
+        return [len(b) async for b in query.iter_batches(4)]
+
+    with ItpDatabase(DB_PATH) as database:
+        opened = []
+        open_connection = database.open
+        database.open = lambda: opened.append(1) or open_connection()
+        assert run(collect(AsyncItpQuery(database, system=[1]))) == [4, 4, 2]
+        assert opened == [1]
+
+    pool = executor.pool(DB_PATH)
+    opened = []
+    open_connection = pool.open
+    pool.open = lambda: opened.append(1) or open_connection()
+    assert run(collect(AsyncItpQuery(DB_PATH, system=[1]))) == [4, 4, 2]
+    assert opened == [1]
+
+
+def test_errors_are_raised(executor):
+    query = AsyncItpQuery(DB_PATH, extra_variables=['chipmunk'])
+    query.set_executor(executor)
+    with pytest.raises(ValueError):
+        run(query.fetch())
+
+
+def test_pool_reuses_connections():
+    pool = ConnectionPool(DB_PATH, size=1)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+
+    # a second thread waits until the connection is returned
+    used = []
+
+    def worker():
+        with pool.connection() as connection:
+            used.append(connection)
+    with pool.connection():
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+    thread.join()
+    assert used == [first]
+    pool.close()
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            pass
+
+
+def test_pool_timeout():
+    pool = ConnectionPool(DB_PATH, size=1, timeout=0.1)
+    with pool.connection():
+        with pytest.raises(RuntimeError):
+            with pool.connection():
+                pass
+    with pool.connection():
+        pass
+    pool.close()
+    with pytest.raises(ValueError):
+        ConnectionPool(DB_PATH, timeout=0)
+
+
+def test_pool_is_read_only():
+    import sqlite3
+    pool = ConnectionPool(DB_PATH)
+    with pool.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute('DELETE FROM profiles')
+    connection = pool.open()
+    with pytest.raises(sqlite3.OperationalError):
+        connection.execute('DELETE FROM profiles')
+    connection.close()
+    pool.close()
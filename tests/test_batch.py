@@ -0,0 +1,196 @@
+import pickle
+import pytest
+import numpy as np
+from pathlib import Path
+from itp.batch import ProfileBatch, concatenate
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture
+def batch():
+    metadata = {
+        '_id': np.array([7, 8, 9]),
+        'system_number': np.array([1, 1, 2]),
+        'profile_number': np.array([1, 2, 1]),
+        'date_time': np.array(
+            ['2005-08-16T06:00:00', '2005-08-16T12:00:00', '2006-01-01T00:00:00'],
+            dtype='datetime64[s]'),
+        'latitude': np.array([78.0, 78.1, 80.0]),
+        'longitude': np.array([-150.0, -150.1, 10.0]),
+    }
+    offsets = [0, 2, 5, 6]
+    values = {
+        'pressure': np.array([1.0, 2.0, 1.0, 2.0, 3.0, 10.0]),
+        'temperature': np.array([-1.0, -1.1, -1.2, -1.3, -1.4, 0.5]),
+    }
+    return ProfileBatch(metadata, offsets, values)
+
+
+@pytest.fixture
+def query():
+    path = Path(__file__).parent / 'testdb.db'
+    return ItpQuery(path)
+
+
+def test_len(batch):
+    assert len(batch) == 3
+
+
+def test_columns(batch):
+    assert batch.system_number.tolist() == [1, 1, 2]
+    assert batch.pressure.size == 6
+    with pytest.raises(AttributeError):
+        batch.chipmunk
+
+
+def test_sizes_and_profile_index(batch):
+    assert batch.sizes().tolist() == [2, 3, 1]
+    assert batch.profile_index().tolist() == [0, 0, 1, 1, 1, 2]
+
+
+def test_get_is_a_view(batch):
+    temperature = batch.get('temperature', 1)
+    assert temperature.tolist() == [-1.2, -1.3, -1.4]
+    assert np.shares_memory(temperature, batch.temperature)
+
+
+def test_getitem(batch):
+    profile = batch[1]
+    assert profile._id == 8
+    assert profile.profile_number == 2
+    assert type(profile.system_number) is int
+    assert profile.date_time == '2005-08-16T12:00:00'
+    assert profile.pressure.tolist() == [1.0, 2.0, 3.0]
+    assert np.shares_memory(profile.pressure, batch.pressure)
+    assert batch[-1].latitude == 80.0
+    with pytest.raises(IndexError):
+        batch[3]
+
+
+def test_iter(batch):
+    assert [p.profile_number for p in batch] == [1, 2, 1]
+
+
+def test_take(batch):
+    subset = batch.take([2, 0])
+    assert subset.offsets.tolist() == [0, 1, 3]
+    assert subset.pressure.tolist() == [10.0, 1.0, 2.0]
+    assert subset.system_number.tolist() == [2, 1]
+    masked = batch.take(np.array([False, True, False]))
+    assert len(masked) == 1
+    assert masked.temperature.tolist() == [-1.2, -1.3, -1.4]
+
+
+def test_take_nothing(batch):
+    empty = batch.take([])
+    assert len(empty) == 0
+    assert empty.pressure.size == 0
+
+
+def test_concatenate(batch):
+    combined = concatenate([batch, batch.take([1])])
+    assert len(combined) == 4
+    assert combined.offsets.tolist() == [0, 2, 5, 6, 9]
+    assert combined.get('pressure', 3).tolist() == [1.0, 2.0, 3.0]
+
+
+def test_fetch_batch_matches_fetch(query):
+    query.set_filter_dict({'pressure': [0, 100], 'extra_variables': ['vert']})
+    batch = query.fetch_batch()
+    profiles = query.fetch()
+    assert len(batch) == len(profiles) == 10
+    assert batch.offsets[-1] == batch.pressure.size
+    for i, profile in enumerate(profiles):
+        assert batch.latitude[i] == profile.latitude
+        assert batch.get('pressure', i) == pytest.approx(profile.pressure)
+        assert batch.get('vert', i) == pytest.approx(profile.vert, nan_ok=True)
+
+
+def test_fetch_batch_metadata_types(query):
+    query.set_filter_dict({'system': [1]})
+    batch = query.fetch_batch()
+    assert batch.date_time.dtype == np.dtype('datetime64[s]')
+    assert batch.date_time[0] == np.datetime64('2005-08-16T06:00:00')
+    assert batch.system_number.dtype == np.int64
+    assert batch.latitude[0] == pytest.approx(78.8267)
+
+
+def test_fetch_batch_no_results(query):
+    query.set_filter_dict({'system': [999]})
+    batch = query.fetch_batch()
+    assert len(batch) == 0
+    assert batch.temperature.size == 0
+    assert query.fetch() == []
+
+
+@pytest.mark.parametrize('method', [
+    'height',
+    'depth',
+    'absolute_salinity',
+    'conservative_temperature',
+    'density',
+    'potential_temperature',
+    'freezing_temperature_zero_pressure',
+    'heat_capacity'
+])
+def test_batch_derived_values(query, method):
+    query.set_filter_dict({'system': [1, 100]})
+    batch = query.fetch_batch()
+    values = getattr(batch, method)()
+    assert values.shape == batch.pressure.shape
+    for profile, expected in zip(query.fetch(), batch.split(values)):
+        assert expected == pytest.approx(
+            getattr(profile, method)(), nan_ok=True)
+
+
+def test_from_profiles(query):
+    query.set_filter_dict({'system': [1]})
+    profiles = query.fetch()
+    batch = ProfileBatch.from_profiles(profiles)
+    assert len(batch) == 10
+    assert batch.system_number.tolist() == [1] * 10
+    assert batch.get('pressure', 3) == pytest.approx(profiles[3].pressure)
+    assert batch.density() == pytest.approx(
+        np.concatenate([p.density() for p in profiles]), nan_ok=True)
+
+
+@pytest.mark.parametrize('metadata_only', [False, True])
+def test_pickled_profile(query, metadata_only):
+    # a profile is pickled with its own samples only, not the whole batch
+    profiles = query.fetch(metadata_only=metadata_only)
+    data = pickle.dumps(profiles[3])
+    expected = query.fetch()[3]
+    samples = expected.pressure.nbytes * 3
+    assert len(data) < samples + 2000
+    profile = pickle.loads(data)
+    assert profile.system_number == expected.system_number
+    assert profile.pressure.tolist() == expected.pressure.tolist()
+    assert profile.salinity.tolist() == expected.salinity.tolist()
+    assert profile.density() == pytest.approx(expected.density())
+
+
+def test_split(batch):
+    parts = batch.split(batch.temperature)
+    assert [p.tolist() for p in parts] == [
+        [-1.0, -1.1], [-1.2, -1.3, -1.4], [0.5]]
+
+
+def test_variable_values(batch):
+    assert batch.variable_values('temperature').tolist() == \
+        batch.temperature.tolist()
+    assert batch.variable_values('depth') == pytest.approx(batch.depth())
+    for name in ('unknown', 'sizes', 'variable_values', '_sample_latitude'):
+        with pytest.raises(ValueError):
+            batch.variable_values(name)
+
+
+def test_save_and_load(batch, tmp_path):
+    batch.metadata['direction'] = np.array(['up', None, 'down'], dtype=object)
+    path = tmp_path / 'batch.npz'
+    batch.save(str(path))
+    loaded = ProfileBatch.load(str(path))
+    assert loaded.offsets.tolist() == batch.offsets.tolist()
+    assert loaded.pressure.tolist() == batch.pressure.tolist()
+    assert loaded.date_time.tolist() == batch.date_time.tolist()
+    assert loaded.direction.tolist() == ['up', None, 'down']
+    assert loaded.variables() == batch.variables()
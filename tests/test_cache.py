@@ -0,0 +1,105 @@
+import os
+import shutil
+import pytest
+from datetime import datetime
+from pathlib import Path
+from itp.cache import QueryCache, file_fingerprint
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # work on a copy so the test database is never modified
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return QueryCache(tmp_path / 'cache')
+
+
+def test_cache_hit(db_path, cache):
+    args = {'pressure': [0, 100], 'extra_variables': ['vert']}
+    query = ItpQuery(db_path, **args)
+    query.set_cache(cache)
+    expected = query.fetch_batch()
+    assert len(list(cache.directory.glob('*.npz'))) == 1
+    query._fetch_batch = None  # a hit must not touch the database
+    results = query.fetch()
+    assert len(results) == len(expected) == 10
+    for i, profile in enumerate(results):
+        assert profile.source == expected.source[i]
+        assert profile.pressure == pytest.approx(expected.get('pressure', i))
+        assert profile.vert == pytest.approx(
+            expected.get('vert', i), nan_ok=True)
+
+
+def test_cache_key_depends_on_filters(db_path, cache):
+    for system in ([1], [2], [1]):
+        query = ItpQuery(db_path, system=system)
+        query.set_cache(cache)
+        query.fetch_batch()
+    assert len(list(cache.directory.glob('*.npz'))) == 2
+    query = ItpQuery(db_path, system=[1], date_time=[
+        datetime(2005, 1, 1), datetime(2006, 1, 1)])
+    query.set_cache(cache)
+    assert len(query.fetch_batch()) == 10
+
+
+def test_cache_invalidated_by_new_database(db_path, cache):
+    query = ItpQuery(db_path, system=[1])
+    query.set_cache(cache)
+    query.fetch_batch()
+    before = file_fingerprint(db_path)
+    stat = db_path.stat()
+    os.utime(str(db_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert file_fingerprint(db_path) != before
+    query.fetch_batch()
+    assert len(list(cache.directory.glob('*.npz'))) == 2
+
+
+def test_cache_max_results(db_path, cache):
+    query = ItpQuery(db_path)
+    query.set_cache(cache)
+    query.fetch_batch()
+    query.set_max_results(10)
+    with pytest.raises(RuntimeError):
+        query.fetch_batch()
+
+
+def test_cache_metadata_only_not_cached(db_path, cache):
+    query = ItpQuery(db_path, system=[1])
+    query.set_cache(cache)
+    assert len(query.fetch(metadata_only=True)) == 10
+    assert cache.size() == 0
+
+
+def test_lru_eviction(db_path, cache):
+    batch = ItpQuery(db_path, system=[1]).fetch_batch()
+    cache.put('first', batch)
+    entry_size = cache.size()
+    cache.max_bytes = entry_size * 2
+    cache.put('second', batch)
+    # use the first entry, so the second is the least recently used
+    os.utime(str(cache._path('first')), ns=(0, 0))
+    os.utime(str(cache._path('second')), ns=(0, 0))
+    assert cache.get('first') is not None
+    cache.put('third', batch)
+    assert cache.get('second') is None
+    assert cache.get('first') is not None
+    assert cache.get('third') is not None
+    assert cache.size() <= cache.max_bytes
+
+
+def test_corrupt_entry_is_a_miss(db_path, cache):
+    query = ItpQuery(db_path, system=[1])
+    query.set_cache(cache)
+    cache._path(query._cache_key()).write_bytes(b'not a zip file')
+    assert len(query.fetch_batch()) == 10
+
+
+def test_max_bytes_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        QueryCache(tmp_path, max_bytes=0)
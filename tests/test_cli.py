@@ -0,0 +1,118 @@
+import csv
+import io
+import json
+import pytest
+import numpy as np
+from pathlib import Path
+from itp.batch import ProfileBatch
+from itp.cli import main
+from itp.itp_query import ItpQuery
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+def run(capsys, *args):
+    assert main([str(DB_PATH)] + list(args)) == 0
+    return capsys.readouterr().out
+
+
+def expected_batch(**filters):
+    query = ItpQuery(DB_PATH, **filters)
+    query.set_max_results(None)
+    return query.fetch_batch()
+
+
+def test_csv(capsys):
+    expected = expected_batch(system=[1], pressure=[10, 20])
+    out = run(capsys, '--system', '1', '--pressure', '10', '20',
+              '--chunk-size', '2')
+    rows = list(csv.DictReader(io.StringIO(out)))
+    # one header, one line per sample, across several chunks
+    assert len(rows) == len(expected.pressure)
+    assert rows[0]['system_number'] == '1'
+    assert rows[0]['date_time'] == '2005-08-16T06:00:00'
+    assert [float(r['temperature']) for r in rows] == pytest.approx(
+        expected.temperature)
+
+
+def test_csv_missing_values(capsys):
+    expected = expected_batch(
+        system=[100], extra_variables=['dissolved_oxygen'])
+    out = run(capsys, '--system', '100',
+              '--extra-variables', 'dissolved_oxygen')
+    rows = list(csv.DictReader(io.StringIO(out)))
+    assert 'dissolved_oxygen' in rows[0]
+    missing = [r['salinity'] == '' for r in rows]
+    assert missing == np.isnan(expected.salinity).tolist()
+
+
+def test_csv_empty(capsys):
+    out = run(capsys, '--system', '999')
+    assert out.splitlines() == [
+        'system_number,profile_number,source,date_time,latitude,longitude,'
+        'direction,pressure,temperature,salinity']
+
+
+def test_jsonl(capsys):
+    expected = expected_batch(system=[1, 2], pressure=[0, 50])
+    out = run(capsys, '--format', 'jsonl', '--system', '1', '2',
+              '--pressure', '0', '50', '--chunk-size', '3')
+    records = [json.loads(line) for line in out.splitlines()]
+    assert len(records) == len(expected)
+    assert [r['profile_number'] for r in records] == \
+        expected.profile_number.tolist()
+    assert records[1]['pressure'] == expected.get('pressure', 1).tolist()
+
+
+def test_metadata_only(capsys):
+    out = run(capsys, '--metadata-only', '--format', 'jsonl',
+              '--latitude', '70', '80')
+    records = [json.loads(line) for line in out.splitlines()]
+    assert len(records) == 40
+    assert 'pressure' not in records[0]
+    assert all(70 <= r['latitude'] <= 80 for r in records)
+
+    out = run(capsys, '--metadata-only', '--latitude', '70', '80')
+    assert len(out.splitlines()) == 41
+    assert out.splitlines()[0].endswith('longitude,direction')
+
+
+def test_count(capsys):
+    assert run(capsys, '--count', '--latitude', '70', '80') == '40\n'
+
+
+def test_npz(tmp_path, capsys):
+    expected = expected_batch(system=[1])
+    path = tmp_path / 'itp.npz'
+    run(capsys, '--format', 'npz', '--output', str(path), '--system', '1',
+        '--chunk-size', '4')
+    batch = ProfileBatch.load(str(path))
+    assert len(batch) == len(expected)
+    assert batch.offsets.tolist() == expected.offsets.tolist()
+    assert batch.temperature == pytest.approx(expected.temperature)
+
+    run(capsys, '--format', 'npz', '--output', str(path), '--metadata-only',
+        '--system', '999')
+    assert len(ProfileBatch.load(str(path))) == 0
+
+
+def test_output_file(tmp_path, capsys):
+    path = tmp_path / 'itp.csv'
+    assert run(capsys, '--output', str(path), '--system', '1') == ''
+    lines = path.read_text().splitlines()
+    assert lines[0].startswith('system_number')
+    assert len(lines) == len(expected_batch(system=[1]).pressure) + 1
+
+
+@pytest.mark.parametrize('args', [
+    ['--format', 'npz'],
+    ['--polygon', '70', '-150', '80'],
+    ['--chunk-size', '0'],
+    ['--extra-variables', 'unknown'],
+])
+def test_invalid(args):
+    with pytest.raises(SystemExit):
+        main([str(DB_PATH)] + args)
+    with pytest.raises(SystemExit):
+        main(['missing.db'])
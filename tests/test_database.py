@@ -0,0 +1,88 @@
+import shutil
+import sqlite3
+import pytest
+import numpy as np
+from pathlib import Path
+from itp.database import ItpDatabase
+from itp.itp_query import ItpQuery
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+@pytest.fixture
+def database():
+    database = ItpDatabase(DB_PATH, pool_size=2)
+    yield database
+    database.close()
+
+
+def test_query_with_database(database):
+    args = {'pressure': [0, 100], 'extra_variables': ['vert']}
+    expected = ItpQuery(DB_PATH, **args).fetch_batch()
+    query = ItpQuery(database, **args)
+    assert query.db_path == DB_PATH
+    batch = query.fetch_batch()
+    assert batch.offsets.tolist() == expected.offsets.tolist()
+    assert np.array_equal(batch.vert, expected.vert, equal_nan=True)
+
+
+def test_connections_are_reused(database):
+    for system in [1, 2, 3]:
+        ItpQuery(database, system=[system]).fetch()
+    assert database._pool._opened == 1
+
+
+def test_variable_ids_are_cached(database):
+    with pytest.raises(ValueError):
+        ItpQuery(database, extra_variables=['chipmunk']).fetch()
+    assert database.variable_ids()['vert'] == 2
+    database.close()
+    # no connection is needed any more
+    assert database.variable_ids()['dissolved_oxygen'] == 1
+
+
+def test_single_connection_pool():
+    # a query never asks for a second connection while it holds one, so
+    # one is enough. The short timeout fails the test instead of hanging.
+    args = {'system': [100], 'extra_variables': ['dissolved_oxygen']}
+    expected = ItpQuery(DB_PATH, **args).fetch_batch()
+    with ItpDatabase(DB_PATH, pool_size=1, timeout=5) as database:
+        query = ItpQuery(database, **args)
+        batch = query.fetch_batch()
+        assert len(batch) == len(expected) > 0
+        assert batch.offsets.tolist() == expected.offsets.tolist()
+        level = query.fetch_level(100, ['temperature', 'dissolved_oxygen'])
+        assert len(level) == len(expected)
+        profiles = query.fetch(metadata_only=True)
+        assert profiles[0].dissolved_oxygen == pytest.approx(
+            expected.get('dissolved_oxygen', 0), nan_ok=True)
+
+
+def test_metadata_only_loads_from_pool(database):
+    profiles = ItpQuery(database, system=[1]).fetch(metadata_only=True)
+    expected = ItpQuery(DB_PATH, system=[1]).fetch()
+    assert profiles[3].pressure == pytest.approx(expected[3].pressure)
+
+
+def test_connections_are_read_only(database):
+    with database.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute('DELETE FROM profiles')
+        cache_size = connection.execute('PRAGMA cache_size').fetchone()[0]
+        assert cache_size == -database.cache_size_kib
+
+
+def test_missing_database(tmp_path):
+    with pytest.raises(ValueError):
+        ItpDatabase(tmp_path / 'missing.db')
+
+
+def test_mutable_database_sees_changes(tmp_path):
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(DB_PATH), str(path))
+    with ItpDatabase(path, immutable=False) as database:
+        assert len(ItpQuery(database, system=[1]).fetch()) == 10
+        with sqlite3.connect(str(path)) as connection:
+            connection.execute('DELETE FROM profiles WHERE system_number == 1')
+        assert len(ItpQuery(database, system=[1]).fetch()) == 0
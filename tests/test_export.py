@@ -0,0 +1,82 @@
+import pytest
+import numpy as np
+from pathlib import Path
+from itp.export import export, main
+from itp.itp_query import ItpQuery
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+@pytest.fixture
+def query():
+    query = ItpQuery(DB_PATH, system=[100, 104], pressure=[0, 200])
+    query.set_max_results(None)
+    return query
+
+
+def test_netcdf(query, tmp_path):
+    netCDF4 = pytest.importorskip('netCDF4')
+    query.add_filter('extra_variables', ['dissolved_oxygen'])
+    expected = query.fetch_batch()
+    path = tmp_path / 'itp.nc'
+    # several chunks, appended along the unlimited dimensions
+    assert export(query, path, chunk_size=3) == len(expected)
+    with netCDF4.Dataset(str(path)) as dataset:
+        assert dataset.Conventions == 'CF-1.8'
+        assert dataset.featureType == 'profile'
+        assert dataset['row_size'].sample_dimension == 'obs'
+        assert dataset['profile'].cf_role == 'profile_id'
+        assert dataset['row_size'][:].tolist() == expected.sizes().tolist()
+        assert dataset['system_number'][:].tolist() == \
+            expected.system_number.tolist()
+        assert dataset['profile'][0] == 'itp100-1'
+        assert dataset['source'][0] == expected.source[0]
+        seconds = expected.date_time.astype('datetime64[s]').astype(float)
+        assert dataset['time'][:].tolist() == seconds.tolist()
+        assert dataset['lat'][:].tolist() == pytest.approx(expected.latitude)
+        for variable in ('pressure', 'temperature', 'dissolved_oxygen'):
+            values = dataset[variable][:].filled(np.nan)
+            assert values == pytest.approx(
+                expected.values[variable], nan_ok=True)
+        assert dataset['temperature'].standard_name == \
+            'sea_water_temperature'
+
+
+def test_parquet(query, tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    expected = query.fetch_batch()
+    path = tmp_path / 'itp.parquet'
+    assert export(query, path, chunk_size=3, row_group_size=1000) == \
+        len(expected)
+    parquet = pq.ParquetFile(str(path))
+    assert parquet.metadata.num_row_groups > 1
+    table = parquet.read()
+    assert table.num_rows == len(expected.pressure)
+    assert table.column('pressure').to_numpy() == pytest.approx(
+        expected.pressure)
+    assert table.column('salinity').to_numpy() == pytest.approx(
+        expected.salinity, nan_ok=True)
+    sizes = expected.sizes()
+    assert table.column('system_number').to_numpy().tolist() == \
+        np.repeat(expected.system_number, sizes).tolist()
+    assert table.column('source').to_pylist() == \
+        np.repeat(expected.source, sizes).tolist()
+
+
+def test_unknown_format(query, tmp_path):
+    with pytest.raises(ValueError):
+        export(query, tmp_path / 'itp.csv')
+    with pytest.raises(ValueError):
+        export(query, tmp_path / 'itp.nc', file_format='hdf')
+
+
+def test_main(tmp_path, capsys):
+    pytest.importorskip('pyarrow')
+    path = tmp_path / 'itp.parquet'
+    argv = [str(DB_PATH), str(path), '--system', '1', '--pressure', '0', '50']
+    assert main(argv) == 0
+    assert 'wrote 10 profiles' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / 'missing.db'), str(path)])
@@ -1,4 +1,5 @@
 import pytest
+import numpy as np
 from itp.filters import (
     SqlFilter,
     SystemFilter,
@@ -7,7 +8,10 @@ from itp.filters import (
     DateTimeFilter,
     PressureFilter,
     ExtraVariableFilter,
-    pre_filter_factory
+    RadiusFilter,
+    PolygonFilter,
+    pre_filter_factory,
+    rtree_value
 )
 from datetime import datetime
 
@@ -39,6 +43,14 @@ def test_factory(name, klass):
     )
 
 
+def test_factory_spatial():
+    assert isinstance(
+        pre_filter_factory('radius', [78, -150, 100]), RadiusFilter)
+    assert isinstance(
+        pre_filter_factory('polygon', [[70, 0], [80, 0], [80, 10]]),
+        PolygonFilter)
+
+
 def test_factory_pressure():
     assert pre_filter_factory('pressure', [1, 2, 3]) is None
 
@@ -166,3 +178,93 @@ def test_extra_variable_filter():
         '(?,?))'
     assert sql == expected
     assert return_args == args
+
+
+def test_pressure_filter_profile_value():
+    args = [1, 2]
+    sql, return_args = PressureFilter(args).profile_value()
+    expected = '(EXISTS (SELECT 1 FROM ctd WHERE ctd.profile_id == profiles.id ' \
+        'AND (pressure >= ? AND pressure <= ?)))'
+    assert sql == expected
+    assert return_args == pytest.approx([10000, 20000])
+
+
+def test_rtree_ranges():
+    assert LatitudeFilter([70, 80]).rtree_ranges() == {'latitude': [(70, 80)]}
+    assert LongitudeFilter([170, -170]).rtree_ranges() == {
+        'longitude': [(170, 180), (-180, -170)]}
+    times = DateTimeFilter([datetime(1970, 1, 1), datetime(1970, 1, 2)])
+    assert times.rtree_ranges() == {'time': [(0, 86400)]}
+    assert PressureFilter([1, 2]).rtree_ranges() is None
+
+
+def test_rtree_value_dateline():
+    sql, args = rtree_value([
+        LatitudeFilter([70, 80]), LongitudeFilter([170, -170])])
+    assert sql.count('SELECT id FROM profiles_rtree') == 2
+    assert ' OR ' in sql
+    assert args == [70, 80, 170, 180, 70, 80, -180, -170]
+
+
+def test_rtree_value_no_ranges():
+    assert rtree_value([PressureFilter([1, 2])]) is None
+
+
+def test_radius_filter_bad_args():
+    with pytest.raises(ValueError):
+        RadiusFilter([78, -150])
+    with pytest.raises(ValueError):
+        RadiusFilter([91, -150, 10])
+    with pytest.raises(ValueError):
+        RadiusFilter([78, -150, 0])
+
+
+def test_radius_filter_bounds():
+    south, north, west, east = RadiusFilter([0, 0, 111.19]).bounds()
+    assert south == pytest.approx(-1, abs=1e-3)
+    assert north == pytest.approx(1, abs=1e-3)
+    assert west == pytest.approx(-1, abs=1e-3)
+    assert east == pytest.approx(1, abs=1e-3)
+    # the box crosses the dateline
+    sql, args = RadiusFilter([70, 179.5, 100]).value()
+    assert '(longitude >= ? OR longitude <= ?)' in sql
+    assert args[2] > args[3]
+    # the circle contains the pole
+    sql, args = RadiusFilter([89, 0, 200]).value()
+    assert 'longitude' not in sql
+    assert args[1] == 90
+
+
+def test_radius_filter_refine():
+    radius = RadiusFilter([0, 0, 200])
+    mask = radius.refine(np.array([0, 0, 1.5, 1.5]), np.array([1, 179, 1.5, 0]))
+    assert mask.tolist() == [True, False, False, True]
+    near_pole = RadiusFilter([90, 0, 200])
+    assert near_pole.refine(np.array([88.5, 88.5]), np.array([0, 180])).all()
+
+
+def test_polygon_filter_bad_args():
+    with pytest.raises(ValueError):
+        PolygonFilter([[70, 0], [80, 0]])
+    with pytest.raises(ValueError):
+        PolygonFilter([[70, 0], [80, 0], [80]])
+    with pytest.raises(ValueError):
+        PolygonFilter([[70, 0], [80, 0], [80, 190]])
+
+
+def test_polygon_filter_refine():
+    square = PolygonFilter([[70, -150], [80, -150], [80, -140], [70, -140]])
+    sql, args = square.value()
+    assert args == [70, 80, -150, -140]
+    mask = square.refine(np.array([75, 75, 85]), np.array([-145, -130, -145]))
+    assert mask.tolist() == [True, False, False]
+
+
+def test_polygon_filter_dateline():
+    polygon = PolygonFilter([[70, 170], [80, 170], [80, -170], [70, -170]])
+    sql, args = polygon.value()
+    assert '(longitude >= ? OR longitude <= ?)' in sql
+    assert args == [70, 80, 170, -170]
+    assert polygon.rtree_ranges()['longitude'] == [(170, 180), (-180, -170)]
+    mask = polygon.refine(np.array([75, 75, 75]), np.array([179, -175, 0]))
+    assert mask.tolist() == [True, True, False]
@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+from pathlib import Path
+from itp.batch import ProfileBatch
+from itp.grid import ProfileGrid
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture
+def batch():
+    metadata = {
+        '_id': np.array([1, 2, 3]),
+        'latitude': np.array([78.0, 78.1, 80.0]),
+        'longitude': np.array([-150.0, -150.1, 10.0]),
+    }
+    offsets = [0, 3, 3, 6]
+    values = {
+        'pressure': np.array([1.0, 2.0, 4.0, 3.0, 1.0, 2.0]),
+        'temperature': np.array([-1.0, -2.0, -4.0, np.nan, 1.0, 2.0]),
+        'salinity': np.array([30.0, 31.0, 32.0, 33.0, 34.0, 35.0]),
+    }
+    return ProfileBatch(metadata, offsets, values)
+
+
+def test_interpolate(batch):
+    grid = ProfileGrid.from_profiles(batch, [0, 1, 1.5, 3, 4, 5])
+    assert grid.levels.tolist() == [0, 1, 1.5, 3, 4, 5]
+    assert grid.variables() == ['temperature', 'salinity']
+    assert grid.temperature.shape == (3, 6)
+    assert grid.temperature[0] == pytest.approx(
+        [np.nan, -1.0, -1.5, -3.0, -4.0, np.nan], nan_ok=True)
+    # an empty profile
+    assert np.isnan(grid.temperature[1]).all()
+    # unordered samples, and a missing value, which is skipped
+    assert grid.temperature[2] == pytest.approx(
+        [np.nan, 1.0, 1.5, np.nan, np.nan, np.nan], nan_ok=True)
+    assert grid.salinity[2] == pytest.approx(
+        [np.nan, 34.0, 34.5, 33.0, np.nan, np.nan], nan_ok=True)
+    assert grid.latitude.tolist() == [78.0, 78.1, 80.0]
+
+
+def test_bin_average(batch):
+    grid = ProfileGrid.from_profiles(
+        batch, [0, 2, 4], variables=['salinity'], method='bin')
+    assert grid.levels.tolist() == [1, 3]
+    assert grid.salinity.tolist()[0] == [30.0, 31.0]
+    assert grid.salinity[2].tolist() == [34.0, 34.0]
+    assert np.isnan(grid.salinity[1]).all()
+
+
+@pytest.mark.parametrize('axis', ['pressure', 'depth'])
+def test_matches_np_interp(axis):
+    batch = ItpQuery(Path(__file__).parent / 'testdb.db').fetch_batch()
+    levels = np.arange(0, 801, 5.0)
+    variables = ['temperature', 'potential_temperature', 'density']
+    grid = ProfileGrid.from_profiles(batch, levels, variables, axis=axis)
+    for i, profile in enumerate(batch):
+        x = profile.pressure if axis == 'pressure' else profile.depth()
+        for variable in variables:
+            y = getattr(profile, variable)
+            y = y if variable == 'temperature' else y()
+            valid = ~np.isnan(x) & ~np.isnan(y)
+            expected = np.interp(
+                levels, x[valid], y[valid], left=np.nan, right=np.nan)
+            assert grid.values[variable][i] == pytest.approx(
+                expected, nan_ok=True)
+
+
+def test_from_profile_list():
+    query = ItpQuery(
+        Path(__file__).parent / 'testdb.db', system=[104], extra_variables=['vert'])
+    profiles = query.fetch()
+    grid = ProfileGrid.from_profiles(
+        profiles, np.arange(10, 100), ['vert', 'heat_capacity'])
+    assert grid.vert.shape == grid.heat_capacity.shape == (10, 90)
+    assert not np.isnan(grid.heat_capacity).all()
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'grid': [0, 0, 1]},
+    {'grid': [[0, 1]]},
+    {'grid': [0, 1], 'axis': 'height'},
+    {'grid': [0, 1], 'method': 'nearest'},
+    {'grid': [0, 1], 'variables': ['chipmunk']},
+    {'grid': [0, 1], 'variables': ['_cached']},
+])
+def test_bad_arguments(batch, kwargs):
+    with pytest.raises(ValueError):
+        ProfileGrid.from_profiles(batch, **kwargs)
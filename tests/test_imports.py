@@ -0,0 +1,80 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+
+SRC = str(Path(__file__).parents[1] / 'src')
+
+# slow imports that only some features need
+HEAVY = ['gsw', 'multiprocessing', 'concurrent.futures.process', 'netCDF4',
+         'pyarrow']
+
+# import time of itp.itp_query, not counting NumPy and SQLite, which it
+# can't do without. It takes about 0.1 s.
+MAX_IMPORT_SECONDS = 1.0
+
+
+def run(code):
+    # runs code in a fresh interpreter and returns what it printed as JSON
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC] + [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return json.loads(out.decode())
+
+
+def test_package_is_light():
+    modules = run(
+        'import itp, json, sys\n'
+        'print(json.dumps(sorted(sys.modules)))')
+    assert 'numpy' not in modules
+    assert 'sqlite3' not in modules
+    assert not [m for m in modules if m.startswith('itp.')]
+
+
+def test_lazy_attributes():
+    result = run(
+        'import itp, json, sys\n'
+        'before = "itp.itp_query" in sys.modules\n'
+        'query = itp.ItpQuery\n'
+        'from itp.itp_query import ItpQuery\n'
+        'print(json.dumps([before, query is ItpQuery, "ItpQuery" in dir(itp)]))')
+    assert result == [False, True, True]
+    import itp
+    with pytest.raises(AttributeError):
+        itp.NotAClass
+
+
+def test_query_does_not_import_heavy_modules():
+    modules = run(
+        'import itp.itp_query, json, sys\n'
+        'print(json.dumps(sorted(sys.modules)))')
+    assert [m for m in HEAVY if m in modules] == []
+
+
+def test_gsw_imported_on_first_derived_value():
+    result = run(
+        'import json, sys\n'
+        'from itp.profile import Profile\n'
+        'before = "gsw" in sys.modules\n'
+        'p = Profile()\n'
+        'p.latitude, p.longitude = 80.0, -150.0\n'
+        'p.pressure = [10.0]\n'
+        'p.temperature = [-1.5]\n'
+        'p.salinity = [30.0]\n'
+        'density = p.density().tolist()\n'
+        'print(json.dumps([before, "gsw" in sys.modules, density]))')
+    assert result[:2] == [False, True]
+    assert result[2][0] == pytest.approx(1024.1, abs=0.1)
+
+
+def test_import_time():
+    seconds = run(
+        'import json, time, numpy, sqlite3\n'
+        'start = time.perf_counter()\n'
+        'import itp.itp_query\n'
+        'print(json.dumps(time.perf_counter() - start))')
+    assert seconds < MAX_IMPORT_SECONDS
@@ -0,0 +1,146 @@
+import shutil
+import sqlite3
+import pytest
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from itp import maintenance
+from itp.ingest import ingest
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # work on a copy so the test database is never modified
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    return path
+
+
+def new_profile(profile_number, **values):
+    profile = {
+        'system_number': 200,
+        'profile_number': profile_number,
+        'source': 'itp200grd{:04d}.dat'.format(profile_number),
+        'date_time': datetime(2021, 1, profile_number, 6),
+        'latitude': 85.5,
+        'longitude': 20.25,
+        'direction': 'up',
+        'pressure': np.array([10.0, 11.0, 12.0]),
+        'temperature': np.array([-1.5, -1.51234, np.nan]),
+        'salinity': np.array([30.1, 30.2, 30.3]),
+    }
+    profile.update(values)
+    return profile
+
+
+def test_ingest(db_path):
+    profiles = [
+        new_profile(1),
+        new_profile(2, dissolved_oxygen=np.array([300.0, np.nan, 301.5])),
+        new_profile(3, turbidity=np.array([0.5, 0.6, 0.7])),
+    ]
+    assert ingest(db_path, profiles, batch_size=2) == 3
+
+    query = ItpQuery(db_path, system=[200])
+    results = query.fetch()
+    assert [p.profile_number for p in results] == [1, 2, 3]
+    assert results[0].date_time == '2021-01-01T06:00:00'
+    assert results[0].latitude == 85.5
+    assert results[0].pressure.tolist() == [10.0, 11.0, 12.0]
+    assert results[0].temperature[:2].tolist() == [-1.5, -1.5123]
+    assert np.isnan(results[0].temperature[2])
+
+    query = ItpQuery(
+        db_path, system=[200], extra_variables=['dissolved_oxygen'])
+    results = query.fetch()
+    assert [p.profile_number for p in results] == [2]
+    assert results[0].dissolved_oxygen == pytest.approx(
+        [300.0, np.nan, 301.5], nan_ok=True)
+    # a new variable is added to variable_names
+    results = ItpQuery(db_path, extra_variables=['turbidity']).fetch()
+    assert results[0].turbidity.tolist() == [0.5, 0.6, 0.7]
+
+    # the existing profiles are untouched
+    original = ItpQuery(str(Path(__file__).parent / 'testdb.db')).fetch()
+    assert len(ItpQuery(db_path).fetch()) == len(original) + 3
+
+
+def test_ingest_is_idempotent(db_path):
+    assert ingest(db_path, [new_profile(1), new_profile(1)]) == 1
+    with sqlite3.connect(str(db_path)) as connection:
+        counts = _counts(connection)
+    assert ingest(db_path, [new_profile(1), new_profile(2)]) == 1
+    assert ingest(db_path, [new_profile(1), new_profile(2)]) == 0
+    with sqlite3.connect(str(db_path)) as connection:
+        assert _counts(connection)[0] == counts[0] + 1
+        assert _counts(connection)[1] == counts[1] + 3
+    # a different source is a different profile
+    assert ingest(db_path, [new_profile(1, source='itp200cor0001.dat')]) == 1
+
+
+def test_ingest_journal_mode(db_path):
+    ingest(db_path, [new_profile(1)])
+    with sqlite3.connect(str(db_path)) as connection:
+        mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+    assert mode == 'delete'
+    assert not Path(str(db_path) + '-wal').exists()
+
+
+def test_ingest_defer_indexes(db_path):
+    maintenance.optimize(db_path)
+    existing = maintenance.existing_indexes(db_path)
+    ingest(db_path, [new_profile(1)], defer_indexes=True)
+    assert maintenance.missing_indexes(db_path) == []
+    assert sorted(maintenance.existing_indexes(db_path)) == sorted(existing)
+    assert len(ItpQuery(db_path, system=[200]).fetch()) == 1
+
+
+def test_ingest_updates_rtree(db_path):
+    maintenance.build_rtree(db_path)
+    ingest(db_path, [new_profile(1)])
+    query = ItpQuery(db_path, latitude=[85, 86], longitude=[20, 21])
+    assert [p.system_number for p in query.fetch()] == [200]
+
+
+def test_ingest_mismatched_variable(db_path):
+    with pytest.raises(ValueError):
+        ingest(db_path, [new_profile(1, turbidity=np.array([0.5]))])
+    with pytest.raises(ValueError):
+        ingest(db_path, [new_profile(1)], batch_size=0)
+
+
+def test_ingest_missing_field(db_path):
+    profile = new_profile(1)
+    del profile['salinity']
+    with pytest.raises(ValueError, match='salinity'):
+        ingest(db_path, [profile])
+    # source is optional, like the rest of the metadata
+    profile = new_profile(1)
+    del profile['source']
+    assert ingest(db_path, [profile]) == 1
+    assert ingest(db_path, [profile]) == 0
+
+
+def test_ingest_failed_batch_adds_no_variable(db_path):
+    # the first profile introduces a variable, the second fails the batch
+    profiles = [
+        new_profile(1, turbidity=np.array([0.5, 0.6, 0.7])),
+        new_profile(2, turbidity=np.array([0.5])),
+    ]
+    with sqlite3.connect(str(db_path)) as connection:
+        before = _counts(connection)
+    with pytest.raises(ValueError):
+        ingest(db_path, profiles)
+    with sqlite3.connect(str(db_path)) as connection:
+        assert _counts(connection) == before
+        sql = "SELECT count(*) FROM variable_names WHERE name == 'turbidity'"
+        assert connection.execute(sql).fetchone()[0] == 0
+    assert ingest(db_path, profiles[:1]) == 1
+
+
+def _counts(connection):
+    return [
+        connection.execute('SELECT count(*) FROM {}'.format(t)).fetchone()[0]
+        for t in ['profiles', 'ctd']
+    ]
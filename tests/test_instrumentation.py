@@ -0,0 +1,96 @@
+import json
+import logging
+import pytest
+from pathlib import Path
+from itp.instrumentation import QueryStats
+from itp.itp_query import ItpQuery
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+@pytest.fixture
+def profiled():
+    # a query on SQLite whose stats are collected in a list
+    query = ItpQuery(DB_PATH, system=[100], pressure=[10, 100])
+    query.set_use_archive(False)
+    stats = []
+    query.set_profiler(stats.append)
+    return query, stats
+
+
+def test_fetch_stats(profiled):
+    query, stats = profiled
+    profiles = query.fetch()
+    assert len(stats) == 1
+    stats = stats[0]
+    assert stats.search == 'fetch'
+    assert stats.profiles == len(profiles) == 10
+    assert list(stats.stages) == ['metadata', 'ctd', 'numpy', 'profiles']
+    assert stats.seconds >= sum(stats.stages.values())
+    assert stats.result_bytes > 0
+    assert stats.error is None
+    # the metadata and CTD statements, with their plans
+    ctd = [s for s in stats.statements if s.startswith('SELECT ctd')]
+    assert len(ctd) == 1
+    record = stats.statements[ctd[0]]
+    assert record['executions'] == 1
+    assert record['rows'] == sum(len(p.pressure) for p in profiles)
+    assert any('ctd' in line for line in record['plan'])
+    assert stats.rows > record['rows']
+
+
+def test_searches_are_profiled(profiled):
+    query, stats = profiled
+    query.fetch_batch(metadata_only=True)
+    query.fetch_level(50)
+    batches = list(query.iter_batches(chunk_size=3))
+    assert [s.search for s in stats] == [
+        'fetch_batch', 'fetch_level', 'iter_batches']
+    assert 'ctd' not in stats[0].stages
+    assert 'levels' in stats[1].stages
+    assert stats[2].profiles == sum(len(b) for b in batches) == 10
+
+
+def test_stats_on_error(profiled):
+    query, stats = profiled
+    query.set_max_results(1)
+    with pytest.raises(RuntimeError):
+        query.fetch()
+    assert 'RuntimeError' in stats[0].error
+
+
+def test_profiler_options(profiled):
+    query, stats = profiled
+    query.set_profiler(stats.append, explain=False, trace_memory=True)
+    query.fetch_batch()
+    assert all(s['plan'] is None for s in stats[0].statements.values())
+    assert stats[0].peak_bytes > 0
+    query.set_profiler(None)
+    query.fetch_batch()
+    assert len(stats) == 1
+
+
+def test_export(profiled, caplog):
+    query, stats = profiled
+    query.fetch_batch()
+    exported = json.loads(stats[0].to_json())
+    assert exported['search'] == 'fetch_batch'
+    assert exported['filters'] == {'system': [100], 'pressure': [10, 100]}
+    assert exported['profiles'] == 10
+    assert len(exported['statements']) == len(stats[0].statements)
+    with caplog.at_level(logging.INFO, logger='itp.query'):
+        stats[0].log()
+    record = caplog.records[0]
+    assert record.getMessage().startswith('fetch_batch of 10 profiles')
+    assert record.itp_stats['rows'] == stats[0].rows
+
+
+def test_stage():
+    stats = QueryStats('fetch', {})
+    with stats.stage('ctd'):
+        pass
+    with stats.stage('ctd'):
+        pass
+    assert list(stats.stages) == ['ctd']
+    assert stats.stages['ctd'] >= 0
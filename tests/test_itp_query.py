@@ -1,5 +1,7 @@
 import pytest
+import numpy as np
 from pathlib import Path
+from itp import itp_query
 from itp.itp_query import ItpQuery
 
 
@@ -111,3 +113,233 @@ def test_pressure_filter(connection):
 def test_query_no_args(connection):
     results = connection.fetch()
     assert len(results) == 60
+
+
+def test_chunked_ctd_query(connection, monkeypatch):
+    # profiles are split over several CTD queries when the result set is
+    # larger than the chunk size. The results must not depend on it.
+    args = {'pressure': [0, 100], 'extra_variables': ['vert', 'north']}
+    connection.set_filter_dict(args)
+    expected = connection.fetch()
+    monkeypatch.setattr(itp_query, 'CHUNK_SIZE', 3)
+    results = connection.fetch()
+    assert len(results) == len(expected)
+    for a, b in zip(results, expected):
+        assert a.profile_number == b.profile_number
+        for field in ['pressure', 'temperature', 'vert', 'north']:
+            assert getattr(a, field) == pytest.approx(getattr(b, field), nan_ok=True)
+
+
+def test_max_results_disabled(connection):
+    connection.set_max_results(None)
+    assert len(connection.fetch()) == 60
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 500])
+def test_iter_profiles(connection, chunk_size):
+    args = {'pressure': [0, 100]}
+    connection.set_filter_dict(args)
+    expected = connection.fetch()
+    results = list(connection.iter_profiles(chunk_size=chunk_size))
+    assert len(results) == len(expected) == 58
+    for a, b in zip(results, expected):
+        assert a.system_number == b.system_number
+        assert a.profile_number == b.profile_number
+        assert a.salinity == pytest.approx(b.salinity, nan_ok=True)
+
+
+def test_iter_profiles_ignores_max_results(connection):
+    connection.set_max_results(5)
+    assert len(list(connection.iter_profiles(chunk_size=5))) == 60
+
+
+def test_iter_batches(connection):
+    batches = list(connection.iter_batches(chunk_size=25))
+    assert [len(b) for b in batches] == [25, 25, 10]
+    assert batches[0].system_number[0] == 1
+    assert batches[-1].system_number[-1] == 104
+
+
+def test_iter_batches_validates_extra_fields(connection):
+    connection.set_filter_dict({'extra_variables': ['chipmunk']})
+    with pytest.raises(ValueError):
+        next(connection.iter_batches())
+
+
+def test_metadata_only(connection):
+    connection.set_max_results(5)
+    results = connection.fetch(metadata_only=True)
+    assert len(results) == 60
+    assert results[0].system_number == 1
+    assert results[0].direction == 'up'
+    assert results[0]._loader is not None
+
+
+def test_metadata_only_batch(connection):
+    batch = connection.fetch_batch(metadata_only=True)
+    assert len(batch) == 60
+    assert batch.values == {}
+    assert batch.latitude.size == 60
+
+
+def test_metadata_only_loads_on_access(connection):
+    args = {'system': [100], 'pressure': [50, 100], 'extra_variables': ['dissolved_oxygen']}
+    connection.set_filter_dict(args)
+    expected = connection.fetch()
+    results = connection.fetch(metadata_only=True)
+    # later changes to the query don't affect profiles already returned
+    connection.set_filter_dict({})
+    assert len(results) == len(expected) == 10
+    for a, b in zip(results, expected):
+        assert a.pressure == pytest.approx(b.pressure)
+        assert a.salinity == pytest.approx(b.salinity, nan_ok=True)
+        assert a.dissolved_oxygen == pytest.approx(b.dissolved_oxygen, nan_ok=True)
+
+
+def test_metadata_only_loader_closes_connection(connection):
+    connection.set_filter_dict({'system': [1]})
+    profiles = connection.fetch(metadata_only=True)
+    loader = profiles[0]._loader[0]
+    for profile in profiles[:-1]:
+        assert len(profile.pressure) > 0
+    assert loader._connection is not None
+    assert len(profiles[-1].pressure) > 0
+    # closed once every profile is loaded
+    assert loader._connection is None
+    # open while other profiles are still to be loaded, until closed
+    profile = connection.fetch_batch(metadata_only=True)[0]
+    loader = profile._loader[0]
+    assert len(profile.pressure) > 0
+    assert loader._connection is not None
+    loader.close()
+    assert loader._connection is None
+
+
+def test_pressure_filter_applies_to_metadata(connection):
+    # profiles without samples in the pressure range are excluded by the
+    # metadata query itself
+    args = {'system': [100], 'pressure': [10, 20]}
+    connection.set_filter_dict(args)
+    assert len(connection.fetch(metadata_only=True)) == 4
+    connection.set_max_results(4)
+    assert len(connection.fetch()) == 4
+
+
+def test_radius_filter(connection):
+    # 50 km around system 1 excludes every other system
+    connection.set_filter_dict({'radius': [78.75, -150.0, 50]})
+    profiles = connection.fetch()
+    assert len(profiles) == 10
+    assert {p.system_number for p in profiles} == {1}
+
+
+def test_radius_filter_is_exact(connection):
+    import gsw
+    center = [78.0, -145.0]
+    radius = 150
+    everything = connection.fetch(metadata_only=True)
+    expected = [
+        p._id for p in everything
+        if gsw.distance(
+            [center[1], p.longitude], [center[0], p.latitude])[0] <= radius * 1000
+    ]
+    connection.set_filter_dict({'radius': center + [radius]})
+    results = connection.fetch(metadata_only=True)
+    assert 0 < len(results) < len(everything)
+    assert [p._id for p in results] == expected
+
+
+def test_radius_filter_counts_toward_max_results(connection):
+    connection.set_filter_dict({'radius': [78.75, -150.0, 50]})
+    connection.set_max_results(10)
+    assert len(connection.fetch()) == 10
+
+
+def test_polygon_filter(connection):
+    # a triangle containing systems 1 and 4 but not its bounding box corner
+    # where system 100 is
+    polygon = [[78.0, -151.0], [79.0, -151.0], [78.0, -147.0]]
+    connection.set_filter_dict({'polygon': polygon})
+    profiles = connection.fetch()
+    assert {p.system_number for p in profiles} == {1, 4}
+    batches = list(connection.iter_batches(chunk_size=3))
+    assert sum(len(b) for b in batches) == len(profiles)
+
+
+@pytest.mark.parametrize('args', [
+    {},
+    {'pressure': [10, 20], 'extra_variables': ['vert', 'dissolved_oxygen']},
+])
+def test_parallel_fetch_matches_serial(connection, args):
+    connection.set_filter_dict(args)
+    expected = connection.fetch_batch()
+    batch = connection.fetch_batch(workers=3)
+    assert batch.offsets.tolist() == expected.offsets.tolist()
+    assert batch.profile_number.tolist() == expected.profile_number.tolist()
+    for variable in expected.variables():
+        assert np.array_equal(
+            batch.values[variable], expected.values[variable], equal_nan=True)
+    profiles = connection.fetch(workers=2)
+    assert [p._id for p in profiles] == expected.metadata['_id'].tolist()
+
+
+def test_parallel_fetch_more_workers_than_profiles(connection):
+    connection.set_filter_dict({'system': [100], 'pressure': [10, 20]})
+    assert len(connection.fetch(workers=8)) == 4
+
+
+@pytest.mark.parametrize('workers', [0, -1, 1.5])
+def test_parallel_fetch_bad_workers(connection, workers):
+    with pytest.raises(ValueError):
+        connection.fetch(workers=workers)
+
+
+def _brute_force_level(profile, pressure, window, method):
+    near = (profile.pressure >= pressure - window) & \
+        (profile.pressure <= pressure + window)
+    below = np.flatnonzero(near & (profile.pressure <= pressure))
+    above = np.flatnonzero(near & (profile.pressure >= pressure))
+    if method == 'nearest':
+        candidates = np.flatnonzero(near)
+        if not len(candidates):
+            return np.nan
+        distance = np.abs(profile.pressure[candidates] - pressure)
+        return profile.temperature[candidates[np.argmin(distance)]]
+    if not len(below) or not len(above):
+        return np.nan
+    pair = [below[-1], above[0]]
+    return np.interp(pressure, profile.pressure[pair], profile.temperature[pair])
+
+
+@pytest.mark.parametrize('method', ['nearest', 'interp'])
+def test_fetch_level(connection, method):
+    batch = connection.fetch_level(401.3, method=method, window=3)
+    profiles = connection.fetch()
+    assert len(batch) == len(profiles) == 60
+    assert batch.sizes().tolist() == [1] * 60
+    assert batch.variables() == ['pressure', 'temperature', 'salinity']
+    expected = [_brute_force_level(p, 401.3, 3, method) for p in profiles]
+    assert batch.temperature == pytest.approx(expected, nan_ok=True)
+    assert 0 < np.isnan(batch.temperature).sum() < 60
+    # derived values work on the level too
+    assert batch.density().shape == (60,)
+
+
+def test_fetch_level_variables(connection):
+    connection.set_filter_dict({'system': [104]})
+    batch = connection.fetch_level(
+        20, variables=['vert', 'salinity'], method='interp')
+    assert batch.variables() == ['pressure', 'vert', 'salinity']
+    assert np.isfinite(batch.vert).any()
+    assert batch.pressure[np.isfinite(batch.vert)].tolist()[0] == 20
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'method': 'cubic'},
+    {'window': -1},
+    {'variables': ['chipmunk']},
+    {'variables': 'temperature'},
+])
+def test_fetch_level_bad_arguments(connection, kwargs):
+    with pytest.raises(ValueError):
+        connection.fetch_level(400, **kwargs)
@@ -0,0 +1,121 @@
+import shutil
+import sqlite3
+import pytest
+from datetime import datetime
+from pathlib import Path
+from itp import maintenance
+from itp.itp_query import ItpQuery
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # work on a copy so the test database is never modified
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    return path
+
+
+def test_missing_indexes(db_path):
+    expected = [index[0] for index in maintenance.INDEXES]
+    assert maintenance.missing_indexes(db_path) == expected
+
+
+def test_optimize(db_path):
+    created = maintenance.optimize(db_path)
+    assert created == [index[0] for index in maintenance.INDEXES]
+    assert maintenance.missing_indexes(db_path) == []
+    assert 'sqlite_stat1' in _tables(db_path)
+    # running again is harmless
+    assert maintenance.optimize(db_path) == []
+
+
+def test_optimize_drops_redundant_indexes(db_path):
+    # the indexes of the database as distributed are the first columns of
+    # recommended ones
+    redundant = ['idx_profile_id', 'idx_variable_name_pid', 'idx_variable_id']
+    assert maintenance.redundant_indexes(db_path) == redundant
+    maintenance.optimize(db_path)
+    assert maintenance.redundant_indexes(db_path) == []
+    existing = maintenance.existing_indexes(db_path)
+    assert not set(redundant) & set(existing)
+    # the unique index of variable_names is kept
+    assert 'sqlite_autoindex_variable_names_1' in existing
+
+
+def test_optimized_results_unchanged(db_path):
+    args = {'pressure': [0, 100], 'extra_variables': ['vert']}
+    expected = ItpQuery(db_path, **args).fetch()
+    maintenance.optimize(db_path)
+    results = ItpQuery(db_path, **args).fetch()
+    assert len(results) == len(expected)
+    for a, b in zip(results, expected):
+        assert a.pressure == pytest.approx(b.pressure)
+        assert a.vert == pytest.approx(b.vert, nan_ok=True)
+
+
+@pytest.mark.parametrize('args', [
+    {'latitude': [75, 80], 'longitude': [-160, -140]},
+    {'longitude': [170, -140]},
+    {'date_time': [datetime(2005, 8, 16, 6), datetime(2006, 1, 1)]},
+    {'system': [1], 'latitude': [70, 90], 'pressure': [0, 100]},
+    {'radius': [78.0, -145.0, 150]},
+])
+def test_rtree_results_unchanged(db_path, args):
+    expected = ItpQuery(db_path, **args).fetch(metadata_only=True)
+    assert maintenance.build_rtree(db_path) == 60
+    query = ItpQuery(db_path, **args)
+    with sqlite3.connect(str(db_path)) as connection:
+        sql, _ = query._build_query(query._has_rtree(connection.cursor()))
+    assert 'profiles_rtree' in sql
+    results = query.fetch(metadata_only=True)
+    assert results
+    assert [p._id for p in results] == [p._id for p in expected]
+
+
+def test_drop_rtree(db_path):
+    maintenance.build_rtree(db_path)
+    maintenance.drop_rtree(db_path)
+    assert 'profiles_rtree' not in _tables(db_path)
+
+
+def test_explain(db_path):
+    maintenance.optimize(db_path)
+    report = maintenance.explain(db_path, {'system': {'system': [1]}})
+    (metadata_sql, metadata_plan), (ctd_sql, ctd_plan) = report['system']
+    assert metadata_sql.startswith('SELECT * FROM profiles')
+    assert 'idx_profiles_system_profile' in metadata_plan[0]
+    assert ctd_sql.startswith('SELECT ctd.profile_id')
+    assert ctd_plan
+
+
+def test_explain_sample_queries(db_path):
+    report = maintenance.explain(db_path)
+    assert list(report) == list(maintenance.SAMPLE_QUERIES)
+
+
+@pytest.mark.parametrize('command, expected', [
+    ('check', 'missing index idx_profiles_latitude'),
+    ('check', 'redundant index idx_variable_name_pid'),
+    ('optimize', 'created index idx_profiles_latitude'),
+    ('optimize', 'dropped index idx_variable_name_pid'),
+    ('rtree', 'indexed 60 profiles'),
+    ('archive', 'itp.archive'),
+    ('tracks', 'drift of 60 profiles'),
+    ('explain', '== system =='),
+])
+def test_main(db_path, capsys, command, expected):
+    assert maintenance.main([command, str(db_path)]) == 0
+    assert expected in capsys.readouterr().out
+
+
+def test_main_missing_file(tmp_path):
+    with pytest.raises(SystemExit):
+        maintenance.main(['check', str(tmp_path / 'missing.db')])
+
+
+def _tables(db_path):
+    connection = sqlite3.connect(str(db_path))
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type == 'table'")]
+    connection.close()
+    return tables
@@ -75,3 +75,82 @@ def test_heat_capacity(profile):
     heat_cap = profile.heat_capacity()
     expected = [4080.2, 4053.5, 4028.2, 4004.2, 3981.4, 3959.6]
     assert heat_cap == pytest.approx(expected, abs=1e-1)
+
+
+def test_derived_values_are_cached(profile):
+    density = profile.density()
+    cached = dict(profile._cache)
+    assert 'absolute_salinity' in cached
+    assert profile.density().tolist() == density.tolist()
+    assert profile.absolute_salinity().tolist() == \
+        cached['absolute_salinity'].tolist()
+    assert all(profile._cache[key] is value for key, value in cached.items())
+
+
+def test_derived_values_can_be_modified(profile):
+    density = profile.density()
+    expected = density[0]
+    density[0] = 0
+    assert profile.density()[0] == expected
+    assert profile.density() is not profile.density()
+
+
+def test_cache_invalidated_on_assignment(profile):
+    density = profile.density()
+    profile.salinity = [30, 30, 30, 30, 30, 30]
+    assert profile.density()[0] != pytest.approx(density[0])
+
+
+def test_p_temp_cached_per_reference_pressure(profile):
+    p_temp = profile.potential_temperature()
+    p_temp_1000 = profile.potential_temperature(p_ref=1000)
+    assert p_temp_1000.tolist() != p_temp.tolist()
+    assert profile.potential_temperature().tolist() == p_temp.tolist()
+    assert ('potential_temperature', 0) in profile._cache
+    assert ('potential_temperature', 1000) in profile._cache
+
+
+def test_profile_has_no_dict(profile):
+    assert not hasattr(profile, '__dict__')
+    with pytest.raises(AttributeError):
+        profile.chipmunk = 1
+
+
+def test_extra_fields(profile):
+    profile.set_field('dissolved_oxygen', [1, 2, 3, 4, 5, 6])
+    profile.set_field('latitude', 81)
+    assert profile.dissolved_oxygen == [1, 2, 3, 4, 5, 6]
+    assert profile.latitude == 81
+    assert profile.extra_fields() == {'dissolved_oxygen': [1, 2, 3, 4, 5, 6]}
+    with pytest.raises(AttributeError):
+        profile.chipmunk
+
+
+class DummyLoader:
+    def __init__(self):
+        self.calls = 0
+
+    def profile_values(self, key):
+        self.calls += 1
+        return {'pressure': [key], 'temperature': [2], 'par': [3]}
+
+
+def test_lazy_loading():
+    loader = DummyLoader()
+    profile = Profile()
+    profile._set_loader(loader, 1)
+    assert loader.calls == 0
+    assert profile.pressure == [1]
+    assert profile.temperature == [2]
+    assert profile.par == [3]
+    assert loader.calls == 1
+
+
+def test_assignment_before_lazy_load():
+    loader = DummyLoader()
+    profile = Profile()
+    profile._set_loader(loader, 1)
+    profile.pressure = [10]
+    assert profile.pressure == [10]
+    assert profile.temperature == [2]
+    assert loader.calls == 1
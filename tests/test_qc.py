@@ -0,0 +1,205 @@
+import pytest
+import numpy as np
+from pathlib import Path
+from itp import qc
+from itp.batch import ProfileBatch
+from itp.itp_query import ItpQuery
+from itp.qc import GOOD, SUSPECT, BAD, MISSING
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+
+
+def make_batch(temperatures, salinities=None, pressures=None):
+    # one profile per list of temperatures, 1 dbar apart from 10 dbar
+    sizes = [len(t) for t in temperatures]
+    temperature = np.concatenate([np.asarray(t, float) for t in temperatures])
+    if salinities is None:
+        salinity = np.full(len(temperature), 30.0)
+    else:
+        salinity = np.concatenate(
+            [np.asarray(s, float) for s in salinities])
+    if pressures is None:
+        pressure = np.concatenate(
+            [10.0 + np.arange(n, dtype=float) for n in sizes])
+    else:
+        pressure = np.concatenate([np.asarray(p, float) for p in pressures])
+    metadata = {
+        'system_number': np.arange(len(sizes)) + 1,
+        'latitude': np.full(len(sizes), 80.0),
+        'longitude': np.full(len(sizes), -150.0),
+    }
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    values = {
+        'pressure': pressure, 'temperature': temperature,
+        'salinity': salinity,
+    }
+    return ProfileBatch(metadata, offsets, values)
+
+
+def test_range():
+    batch = make_batch([[-3, -2.2, 0, 5, 45]])
+    check = qc.RangeCheck('temperature', -2.5, 40, suspect=(-2, 4))
+    assert check.flags(batch)['temperature'].tolist() == [
+        BAD, SUSPECT, GOOD, SUSPECT, BAD]
+    check = qc.RangeCheck('pressure', minimum=11)
+    assert check.flags(batch)['pressure'].tolist() == [
+        BAD, GOOD, GOOD, GOOD, GOOD]
+    with pytest.raises(ValueError):
+        qc.RangeCheck('temperature')
+    with pytest.raises(ValueError):
+        qc.RangeCheck('temperature', 1, 0)
+
+
+def test_range_of_derived_value():
+    batch = make_batch([[-1, -1, 10]], [[30, 30, 20]])
+    flags = qc.run_checks(batch, [qc.RangeCheck('density', minimum=1020)])
+    assert flags['temperature'].tolist() == [GOOD, GOOD, BAD]
+    assert flags['salinity'].tolist() == [GOOD, GOOD, BAD]
+    assert flags['pressure'].tolist() == [GOOD, GOOD, GOOD]
+    with pytest.raises(ValueError):
+        qc.RangeCheck('unknown', 0, 1).flags(batch)
+
+
+def test_spike():
+    batch = make_batch([[0, 0, 3, 0, 0], [1, 2, 3, 4]])
+    flags = qc.SpikeCheck('temperature', 2.0).flags(batch)['temperature']
+    assert flags.tolist() == [GOOD, GOOD, BAD, GOOD, GOOD] + [GOOD] * 4
+    flags = qc.SpikeCheck('temperature', 4.0, suspect=2.0).flags(batch)
+    assert flags['temperature'][2] == SUSPECT
+
+
+def test_neighbours_stay_in_profile():
+    # the last sample of one profile and the first of the next would be
+    # spikes if the profiles were one
+    batch = make_batch([[0, 0, 5], [0, 0, 0]])
+    flags = qc.SpikeCheck('temperature', 1.0).flags(batch)['temperature']
+    assert (flags == GOOD).all()
+    flags = qc.GradientCheck('temperature', 3.0).flags(batch)['temperature']
+    assert (flags == GOOD).all()
+
+
+def test_gradient():
+    # a step: the gradient test flags it, the spike test does not
+    batch = make_batch([[0, 0, 0, 4, 4, 4]])
+    flags = qc.GradientCheck('temperature', 1.5).flags(batch)['temperature']
+    assert flags.tolist() == [GOOD, GOOD, BAD, BAD, GOOD, GOOD]
+    flags = qc.SpikeCheck('temperature', 1.5).flags(batch)['temperature']
+    assert (flags == GOOD).all()
+
+
+def test_density_inversion():
+    # warm, light water below cold water
+    batch = make_batch(
+        [[-1.5, -1.5, 5, -1.5, -1.5], [-1.5, -1.4, -1.3]],
+        [[30, 30, 30, 30, 30], [30, 30.1, 30.2]])
+    flags = qc.DensityInversionCheck(0.03).flags(batch)
+    assert flags['temperature'].tolist() == \
+        [GOOD, BAD, BAD, GOOD, GOOD] + [GOOD] * 3
+    assert flags['salinity'].tolist() == flags['temperature'].tolist()
+
+    # a stable profile sorted by decreasing pressure is not inverted
+    batch = make_batch(
+        [[-1.5, -1.4, -1.3]], [[30.2, 30.1, 30]], [[12, 11, 10]])
+    flags = qc.DensityInversionCheck(0.03).flags(batch)
+    assert (flags['temperature'] == GOOD).all()
+
+
+def test_stuck_value():
+    batch = make_batch([[1, 2, 2, 2, 2, 3], [2, 2, 2]])
+    check = qc.StuckValueCheck('temperature', 4, suspect=3)
+    assert check.flags(batch)['temperature'].tolist() == \
+        [GOOD, BAD, BAD, BAD, BAD, GOOD, SUSPECT, SUSPECT, SUSPECT]
+    with pytest.raises(ValueError):
+        qc.StuckValueCheck('temperature', 1)
+
+
+def test_duplicate_level():
+    batch = make_batch(
+        [[0, 1, 2, 3], [4, 5]], pressures=[[10, 11, 11, 12], [12, 13]])
+    flags = qc.run_checks(batch, [qc.DuplicateLevelCheck()])
+    assert flags['pressure'].tolist() == [GOOD, GOOD, BAD, GOOD, GOOD, GOOD]
+    # a bad pressure makes the whole sample bad
+    assert flags['temperature'].tolist() == flags['pressure'].tolist()
+
+
+def test_run_checks():
+    batch = make_batch(
+        [[0, 0, 9, 0, 0, np.nan]], [[30, 30, 30, 30, np.nan, 30]])
+    checks = [
+        qc.RangeCheck('temperature', -2, 5, suspect=(-2, 1)),
+        qc.SpikeCheck('temperature', 20, suspect=2),
+    ]
+    flags = qc.run_checks(batch, checks)
+    # the worst flag of all the checks
+    assert flags['temperature'].tolist() == \
+        [GOOD, GOOD, BAD, GOOD, GOOD, MISSING]
+    assert flags['salinity'].tolist() == [GOOD] * 4 + [MISSING, GOOD]
+    assert all(f.dtype == np.int8 for f in flags.values())
+
+
+def test_mask():
+    batch = make_batch([[0, 0, 9, 0], [0, 3, 0]])
+    checks = [qc.SpikeCheck('temperature', 5, suspect=2)]
+    masked = qc.quality_control(batch, checks)
+    assert np.isnan(masked.temperature).tolist() == \
+        [False, False, True, False] + [False] * 3
+    assert masked.salinity is batch.salinity
+    assert masked.offsets.tolist() == batch.offsets.tolist()
+    masked = qc.quality_control(batch, checks, level=SUSPECT)
+    assert np.isnan(masked.temperature).sum() == 2
+    # the batch itself is unchanged
+    assert not np.isnan(batch.temperature).any()
+
+
+def test_drop():
+    batch = make_batch([[0, 0, 9, 0], [9], [0, 3, 0]])
+    checks = [qc.RangeCheck('temperature', maximum=5)]
+    dropped = qc.quality_control(batch, checks, 'drop')
+    # the sample is removed, and the profile left without samples
+    assert len(dropped) == 2
+    assert dropped.sizes().tolist() == [3, 3]
+    assert dropped.system_number.tolist() == [1, 3]
+    assert dropped.temperature.tolist() == [0, 0, 0, 0, 3, 0]
+    assert dropped.pressure.tolist() == [10, 11, 13, 10, 11, 12]
+    with pytest.raises(ValueError):
+        qc.quality_control(batch, checks, 'delete')
+
+
+def test_empty_batch():
+    batch = make_batch([[]])
+    flags = qc.run_checks(batch, qc.default_checks() + [
+        qc.StuckValueCheck('salinity', 3)])
+    assert all(len(f) == 0 for f in flags.values())
+    dropped = qc.quality_control(batch, qc.default_checks(), 'drop')
+    assert dropped.offsets[-1] == 0
+
+
+def test_query_qc():
+    query = ItpQuery(DB_PATH, system=[1, 2])
+    query.set_max_results(None)
+    unchecked = query.fetch_batch()
+    checks = [qc.RangeCheck('temperature', maximum=-1.5)]
+    query.set_qc(checks)
+    masked = query.fetch_batch()
+    too_warm = unchecked.temperature > -1.5
+    assert too_warm.any()
+    assert np.isnan(masked.temperature).tolist() == too_warm.tolist()
+
+    query.set_qc(checks, action='drop')
+    dropped = query.fetch_batch()
+    assert len(dropped.temperature) == (~too_warm).sum()
+    batches = list(query.iter_batches(chunk_size=3))
+    assert sum(len(b.temperature) for b in batches) == (~too_warm).sum()
+    profiles = query.fetch()
+    assert sum(len(p.temperature) for p in profiles) == (~too_warm).sum()
+
+    # metadata only results are not checked
+    assert len(query.fetch_batch(metadata_only=True)) == len(unchecked)
+
+    query.set_qc(None)
+    assert len(query.fetch_batch().temperature) == len(unchecked.temperature)
+    with pytest.raises(ValueError):
+        query.set_qc(checks, action='delete')
+    with pytest.raises(ValueError):
+        query.set_qc(checks, level=GOOD)
@@ -0,0 +1,192 @@
+import pytest
+import numpy as np
+from pathlib import Path
+from itp import qc
+from itp.batch import ProfileBatch, concatenate
+from itp.database import ItpDatabase
+from itp.itp_query import ItpQuery
+from itp.stats import BinnedStatistics, climatology
+
+
+DB_PATH = Path(__file__).parent / 'testdb.db'
+LATITUDE = [70, 75, 80, 85]
+LONGITUDE = [-180, -150, -120, 180]
+PRESSURE = [0, 100, 250, 500]
+
+
+@pytest.fixture
+def query():
+    query = ItpQuery(DB_PATH)
+    query.set_use_archive(False)
+    return query
+
+
+def make_stats(**kwargs):
+    return BinnedStatistics(LATITUDE, LONGITUDE, PRESSURE, **kwargs)
+
+
+def test_statistics():
+    metadata = {
+        'date_time': np.array(
+            ['2010-01-15', '2010-01-20', '2011-07-01'], dtype='datetime64[s]'),
+        'latitude': np.array([71.0, 72.0, 81.0]),
+        'longitude': np.array([-160.0, -155.0, 0.0]),
+    }
+    values = {
+        'pressure': np.array([10.0, 20.0, 150.0, 30.0, 600.0, 90.0]),
+        'temperature': np.array([1.0, 3.0, 5.0, np.nan, 9.0, 7.0]),
+        'salinity': np.array([30.0, 31.0, 32.0, 33.0, 34.0, 35.0]),
+    }
+    batch = ProfileBatch(metadata, [0, 3, 5, 6], values)
+    stats = make_stats().add(batch)
+    assert stats.count('temperature').shape == (3, 3, 3, 12)
+    # profiles 0 and 1 share a January bin; NaN and 600 dbar are skipped
+    assert stats.count('temperature')[0, 0, 0, 0] == 2
+    assert stats.count('salinity')[0, 0, 0, 0] == 3
+    assert stats.mean('temperature')[0, 0, 0, 0] == 2.0
+    assert stats.variance('temperature')[0, 0, 0, 0] == 2.0
+    assert stats.minimum('salinity')[0, 0, 0, 0] == 30.0
+    assert stats.maximum('salinity')[0, 0, 0, 0] == 33.0
+    assert stats.mean('temperature')[0, 0, 1, 0] == 5.0
+    assert stats.mean('temperature')[2, 2, 0, 6] == 7.0
+    assert stats.count('temperature').sum() == 4
+    # empty bins
+    assert np.isnan(stats.mean('temperature')[1, 1, 1, 1])
+    assert np.isnan(stats.variance('temperature')[0, 0, 1, 0])
+
+
+def test_against_numpy(query):
+    batch = query.fetch_batch()
+    stats = make_stats(by_month=False).add(batch)
+    latitude = np.repeat(batch.latitude, batch.sizes())
+    longitude = np.repeat(batch.longitude, batch.sizes())
+    selected = (
+        (latitude >= 75) & (latitude < 80)
+        & (longitude >= -150) & (longitude < -120)
+        & (batch.pressure >= 250) & (batch.pressure < 500)
+        & ~np.isnan(batch.salinity))
+    expected = batch.salinity[selected]
+    assert stats.count('salinity')[1, 1, 2, 0] == len(expected) > 0
+    assert stats.mean('salinity')[1, 1, 2, 0] == pytest.approx(
+        expected.mean())
+    assert stats.std('salinity')[1, 1, 2, 0] == pytest.approx(
+        expected.std(ddof=1))
+    assert stats.minimum('salinity')[1, 1, 2, 0] == expected.min()
+
+
+def test_merge_and_streaming(query):
+    batch = query.fetch_batch()
+    whole = make_stats().add(batch)
+    streamed = climatology(query, LATITUDE, LONGITUDE, PRESSURE, chunk_size=7)
+    halves = make_stats().add(batch.take(np.arange(20)))
+    halves.merge(make_stats().add(batch.take(np.arange(20, len(batch)))))
+    for stats in (streamed, halves):
+        for variable in ('temperature', 'salinity'):
+            assert np.array_equal(
+                stats.count(variable), whole.count(variable))
+            assert stats.mean(variable) == pytest.approx(
+                whole.mean(variable), nan_ok=True)
+            assert stats.variance(variable) == pytest.approx(
+                whole.variance(variable), nan_ok=True)
+            assert np.array_equal(
+                stats.maximum(variable), whole.maximum(variable),
+                equal_nan=True)
+    with pytest.raises(ValueError):
+        whole.merge(BinnedStatistics(LATITUDE, LONGITUDE, [0, 1000]))
+
+
+def test_climatology_workers(query):
+    query.add_filter('pressure', [0, 200])
+    serial = climatology(
+        query, LATITUDE, LONGITUDE, PRESSURE, ['potential_temperature'])
+    parallel = climatology(
+        query, LATITUDE, LONGITUDE, PRESSURE, ['potential_temperature'],
+        workers=2)
+    assert np.array_equal(
+        serial.count('potential_temperature'),
+        parallel.count('potential_temperature'))
+    assert serial.mean('potential_temperature') == pytest.approx(
+        parallel.mean('potential_temperature'), nan_ok=True)
+    assert serial.count('potential_temperature')[:, :, 2].sum() == 0
+
+
+def test_climatology_workers_settings(query):
+    # the workers run the quality control of the query, and open the
+    # database with the settings of its ItpDatabase
+    checks = [qc.RangeCheck('temperature', maximum=-1.5)]
+    unchecked = climatology(query, LATITUDE, LONGITUDE, PRESSURE)
+    query.set_qc(checks, action='drop')
+    serial = climatology(query, LATITUDE, LONGITUDE, PRESSURE)
+    with ItpDatabase(DB_PATH, immutable=False) as database:
+        parallel_query = ItpQuery(database)
+        parallel_query.set_use_archive(False)
+        parallel_query.set_qc(checks, action='drop')
+        parallel = climatology(
+            parallel_query, LATITUDE, LONGITUDE, PRESSURE, workers=2)
+    for variable in ('temperature', 'salinity'):
+        assert np.array_equal(
+            serial.count(variable), parallel.count(variable))
+        assert serial.mean(variable) == pytest.approx(
+            parallel.mean(variable), nan_ok=True)
+    assert serial.count('temperature').sum() < \
+        unchecked.count('temperature').sum()
+    assert np.nanmax(parallel.maximum('temperature')) <= -1.5
+
+
+def test_climatology_workers_extra_variables():
+    args = {'system': [100, 104], 'extra_variables': ['dissolved_oxygen']}
+    variables = ['temperature', 'dissolved_oxygen']
+    serial_query = ItpQuery(DB_PATH, **args)
+    serial_query.set_use_archive(False)
+    serial = climatology(
+        serial_query, LATITUDE, LONGITUDE, PRESSURE, variables)
+    with ItpDatabase(DB_PATH, pool_size=1, timeout=5) as database:
+        query = ItpQuery(database, **args)
+        query.set_use_archive(False)
+        parallel = climatology(
+            query, LATITUDE, LONGITUDE, PRESSURE, variables, workers=2)
+    assert serial.count('dissolved_oxygen').sum() > 0
+    for variable in variables:
+        assert np.array_equal(
+            serial.count(variable), parallel.count(variable))
+        assert serial.mean(variable) == pytest.approx(
+            parallel.mean(variable), nan_ok=True)
+
+
+def test_percentile(query):
+    batch = concatenate([query.fetch_batch()])
+    edges = {'salinity': np.arange(25, 36, 0.01)}
+    stats = BinnedStatistics(
+        [-90, 90], [-180, 180], [0, 10000], ['salinity'], by_month=False,
+        histogram_edges=edges).add(batch)
+    salinity = batch.salinity[~np.isnan(batch.salinity)]
+    for q in (5, 50, 95):
+        assert stats.percentile('salinity', q)[0, 0, 0, 0] == pytest.approx(
+            np.percentile(salinity, q), abs=0.02)
+    with pytest.raises(ValueError):
+        stats.percentile('temperature', 50)
+
+
+def test_save_load(query, tmp_path):
+    edges = {'temperature': np.linspace(-2, 2, 41)}
+    stats = make_stats(histogram_edges=edges).add(query.fetch_batch())
+    stats.save(str(tmp_path / 'stats.npz'))
+    loaded = BinnedStatistics.load(str(tmp_path / 'stats.npz'))
+    assert loaded.variables == stats.variables
+    assert np.array_equal(
+        loaded.count('temperature'), stats.count('temperature'))
+    assert loaded.percentile('temperature', 50) == pytest.approx(
+        stats.percentile('temperature', 50), nan_ok=True)
+    # a saved run can be merged into a new one
+    loaded.merge(stats)
+    assert np.array_equal(
+        loaded.count('salinity'), 2 * stats.count('salinity'))
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        BinnedStatistics([80, 70], LONGITUDE, PRESSURE)
+    with pytest.raises(ValueError):
+        make_stats(histogram_edges={'oxygen': [0, 1]})
+    with pytest.raises(ValueError):
+        make_stats().mean('oxygen')
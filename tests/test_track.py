@@ -0,0 +1,99 @@
+import shutil
+import sqlite3
+import pytest
+import numpy as np
+from pathlib import Path
+from itp import track
+from itp.batch import ProfileBatch
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # work on a copy so the test database is never modified
+    path = tmp_path / 'itp.db'
+    shutil.copy(str(Path(__file__).parent / 'testdb.db'), str(path))
+    return path
+
+
+def test_geodesic():
+    # Flinders Peak to Buninyong, Vincenty's published example
+    distance, heading = track.geodesic(
+        -37.95103342, 144.42486789, -37.65282114, 143.92649554)
+    assert distance == pytest.approx(54.972271, abs=1e-6)
+    assert heading == pytest.approx(306.868158, abs=1e-5)
+
+
+def test_geodesic_arrays():
+    distance, heading = track.geodesic(
+        [80, 80, 0], [179.5, 10, 0], [80, 80, 0], [-179.5, 10, 180])
+    # across the dateline, identical points, and antipodal points
+    assert distance[0] == pytest.approx(19.4, abs=0.1)
+    assert heading[0] == pytest.approx(90, abs=0.5)
+    assert distance[1] == 0
+    assert np.isnan(heading[1])
+    assert distance[2] == pytest.approx(20015, abs=5)
+
+
+def test_drift():
+    metadata = {
+        # two systems, out of chronological order, one profile without a
+        # position
+        'system_number': np.array([2, 1, 1, 2, 1]),
+        'date_time': np.array([
+            '2010-01-02', '2010-01-02', '2010-01-01', '2010-01-01',
+            '2010-01-03'], dtype='datetime64[s]'),
+        'latitude': np.array([80.1, 75.0, 75.0, 80.0, np.nan]),
+        'longitude': np.array([0.0, 10.0, 0.0, 0.0, 0.0]),
+    }
+    batch = ProfileBatch(metadata, np.zeros(6, dtype=int), {})
+    result = track.drift(batch)
+    leg_1, _ = track.geodesic(75, 0, 75, 10)
+    leg_2, _ = track.geodesic(80, 0, 80.1, 0)
+    assert result['distance'] == pytest.approx(
+        [leg_2, leg_1, 0, 0, np.nan], nan_ok=True)
+    assert result['cumulative_distance'] == pytest.approx(
+        [leg_2, leg_1, 0, 0, np.nan], nan_ok=True)
+    assert result['speed'] == pytest.approx(
+        [leg_2 * 1000 / 86400, leg_1 * 1000 / 86400, np.nan, np.nan, np.nan],
+        nan_ok=True)
+    assert result['heading'][0] == pytest.approx(0)
+    assert result['heading'][1] == pytest.approx(85.2, abs=0.1)
+    assert np.isnan(result['heading'][2:]).all()
+
+
+def test_drift_tracks(db_path):
+    tracks = track.drift_tracks(db_path)
+    assert len(tracks) == 60
+    for system in np.unique(tracks.system_number):
+        one = tracks.take(tracks.system_number == system)
+        assert one.cumulative_distance[0] == 0
+        assert one.cumulative_distance == pytest.approx(
+            np.cumsum(one.distance))
+    subset = track.drift_tracks(db_path, systems=[1])
+    assert set(subset.system_number) == {1}
+    assert subset.cumulative_distance == pytest.approx(
+        tracks.cumulative_distance[tracks.system_number == 1])
+
+
+def test_track_table(db_path):
+    computed = track.drift_tracks(db_path)
+    assert track.build_track_table(db_path) == 60
+    stored = track.drift_tracks(db_path)
+    for name in track.TRACK_COLUMNS:
+        assert stored.metadata[name] == pytest.approx(
+            computed.metadata[name], nan_ok=True)
+
+    # the table is ignored once it misses profiles
+    with sqlite3.connect(str(db_path)) as connection:
+        connection.execute(
+            'UPDATE {} SET distance = -1'.format(track.TRACK_TABLE))
+        connection.execute('DELETE FROM {} WHERE profile_id == ?'.format(
+            track.TRACK_TABLE), [int(computed.metadata['_id'][0])])
+    assert track.drift_tracks(db_path).distance == pytest.approx(
+        computed.distance, nan_ok=True)
+
+    track.drop_track_table(db_path)
+    with sqlite3.connect(str(db_path)) as connection:
+        sql = "SELECT name FROM sqlite_master WHERE type == 'table'"
+        tables = [row[0] for row in connection.execute(sql)]
+    assert track.TRACK_TABLE not in tables